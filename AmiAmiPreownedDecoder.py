@@ -0,0 +1,384 @@
+import re
+import sys
+import logging
+import traceback
+from multiprocessing.dummy import Pool
+
+import requests  # pip3 install requests
+from bs4 import BeautifulSoup  # pip3 install beautifulsoup4
+
+import Decoding
+from Decoding import Decoder, FigureData, FigureDataCorrupt
+
+
+class AmiAmiPreownedDecoder(Decoder):
+    service = Decoder.amiami_preowned
+    conditionBase = "http://amiami.co.jp"
+    conditionS = "conditionicon_s_en.gif"
+    conditionA = "conditionicon_a_en.gif"
+    conditionB = "conditionicon_b_en.gif"
+    conditionDecode = {conditionS: 'Sealed', conditionA: 'A', conditionB: 'B'}
+    currency = 'JPY'
+
+    def __new__(cls, service):
+        pass
+
+    def __init__(self, service, get_next_pages=True, max_buffered_bytes=Decoder.max_buffered_bytes, snapshots=None):
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.get_next_pages = get_next_pages  # type: bool
+        self.max_buffered_bytes = max_buffered_bytes  # type: int
+        self.snapshots = snapshots  # type: StockChecker.PageSnapshots
+        self._product_phtml = None
+        self._parsed_html = None
+        self._figures = []  # type: list[FigureData]
+        self._extended_name_figures = []  # type: list[FigureData]
+
+    def _condition(self, value):
+        # TODO: Standardise all _condition() functions
+        """
+        Deciphers the condition from the string passed to it. If the conditon is part of other pertinent data (such as
+        the Figure name) we will return it.
+        @param value: The string we need to get the condition from. (inside extended Name of figure)
+        @type value: str
+        @return: This version will return the name of the figure with the condition striped out.
+        @rtype: str
+        """
+
+        #  (Pre-owned ITEM:A-/BOX:B)EX Cute Otogi no Kuni / Sleeping Beauty Lien Complete Doll(Released)
+        # r'\(Pre-owned ITEM:(\S+)\/BOx:(\S+)\)\b'
+        # extract the item condition and box condition
+        condition = None
+        extended_name = None
+        try:
+            item_condition, box_condition = re.search(r'\(Pre-owned ITEM:(.*)\/.*?BOx:(.*)\)(?=.)', value, re.I).groups()
+            condition = ("Item : " + item_condition + " Box: " + box_condition)
+            extended_name = re.sub(r'\(Pre-owned ITEM:(.*)\/.*?BOx:(.*)\)(?=.)', '', value, flags=re.I)
+            return condition, extended_name
+        except:
+            self._log.error(traceback.format_exc())
+            return condition, extended_name
+
+    def _get_next_page(self, html_soup=None):
+        """
+        Scrapes the webpage for the next page URL and returns it if found. If it can not be found, return None
+        @return: Next Page URL or None
+        @rtype: str | None
+        """
+        if self.get_next_pages is False:
+            return None
+        product_tags = self._parsed_html.find(id='products')  # .find_all('span')  # type: list[tag]
+        if product_tags is not None:
+            next_page_element = product_tags.find('a', string='Next>>')  # _class='sp04_pl20')  #.find('a').get('href')
+            if next_page_element is not None:
+                next_page_url = next_page_element.get('href')
+                return next_page_url
+                # return None
+        return None
+
+    def _get_pages(self, html_soup=None, prototype_url=None, results=False):
+        """
+        Scrapes the webpage for the all page urls and returns them if found. If they can not be found, return None
+        @return: Next Page URLs or None
+        @rtype: list[str] | None
+        """
+
+        if html_soup is not None:
+            product_tags = html_soup.find(id='products')  # .find_all('span')  # type: list[tag]
+            if product_tags is not None:
+                max_page_num = float("-inf")
+                for link in product_tags.find_all('a'):
+                    # TODO: Add Try/Except
+                    page_num = re.search(r'\[(\d{1,2})\]$', link.text)
+                    if page_num is not None:
+                        page_num = page_num.groups()[0]
+                        try:
+                            page_num = int(page_num)
+                            if page_num > max_page_num:
+                                max_page_num = page_num
+
+                        except ValueError:
+                            self._log.error("Unable to get URLs in parallel. Switching to sequence mode.")
+                            return None
+
+                urls = []
+                # Assume we already have page one.
+                for current_page in range(2, (max_page_num + 1)):
+                    page_url = re.sub(r'-~PAGENUMBER~-', str(current_page), prototype_url)
+                    urls.append(page_url)
+
+                return urls
+        return None
+
+    def get_figures(self, html=None, _url=None, prototype_url=None):
+
+        if prototype_url is not None and len(self._figures) < 1:
+            self._figures.extend(self.iter_figures(html, _url, prototype_url))
+            return self._figures
+
+        if html is not None and len(self._figures) < 1 and _url is not None:
+
+            # TODO: I think the code below is broken.....
+            self._log.warning("Executing broken code!")
+            # Only parse if html is given and the figures array is empty
+            more_figures = True  # Flag indicating we still have more figs to parse
+            next_page_url = None  # Stores the URL for the next page. Needs to be initialized to None.
+            current_page = 1  # The current page number
+            got_multiple_pages = False  # Flag indicating whether we scraped one page or multiple pages
+
+            while True:
+                parsed_html = BeautifulSoup(html, 'html.parser')
+                next_page_url = self._get_next_page(parsed_html)
+
+                if next_page_url is not None:
+                    # TODO: do not rely on outside function
+                    current_page += 1
+                    sys.stdout.write('\x1b[K')  # Clear the line
+                    print("Retrieving page {}".format(current_page))
+                    sys.stdout.write('\x1b[1A')  # Move cursor up 2 lines
+                    try:
+                        html = Decoding.scrapeSite(next_page_url)
+                    except requests.Timeout or requests.Timeout as e:
+                        self._log.error("Getting next Amiami pre-owned page Failed", exc_info=True)
+                        raise FigureDataCorrupt
+
+            while more_figures:
+                self._log.info("Parsing figures from page {0}.".format(current_page))
+                #  Pares the HTML into soup
+                try:
+                    # TODO: Get pages first so we can multi-thread retrieval of websites.
+                    next_page_url = self._get_next_page()
+                    products_soup = self._parsed_html.find_all(class_="product_box")
+                    # TODO: Find a better way of determining that there are no products on the page
+                    if products_soup is None:
+                        break
+
+                    for figure_soup in products_soup:
+                        tempFig = FigureData(self, Decoder.amiami_preowned, html)  # type: FigureData
+                        tempFig.condition = ""
+
+                        tmp = figure_soup.find(class_='product_name_list')
+                        tmp2 = tmp.find('a')
+                        tempFig.link = tmp2.get('href')
+                        tempFig.name = tmp2.text  # figure_soup.find(class_='product_name_list').text  # type: str
+
+                        if tempFig.name == "":  # Occasionally, amiami is missing product titles on the listing page
+                            self.get_extended_name(tempFig, override=True)
+
+                        tempPrice = figure_soup.find(class_="product_price").text.strip()
+
+                        try:
+                            tempPrice = re.search(r'\d{1,3}?,?\d{1,3}?,?\d{1,3} JPY', tempPrice)
+                            if tempPrice is not None:
+                                 tempFig.price = tempPrice.group(0)
+                            else:
+                                tempFig.price = " "
+                        except Exception as e:
+                            self._log.error('re search error: ', exc_info=True)
+
+                        tempFig.pic_link = figure_soup.find('img')['src']
+
+                        # The condition is not listed on the listing page, only the detail page.
+                        # To prevent hammering AmiAmi, we will get condition data only if the item is a match.
+
+                        tempFig._search_url = _url
+
+                        self._figures.append(tempFig)
+
+                # except requests.Timeout as e:
+
+                except Exception as e:
+                    self._log.error("Parsing Amiami pre-owned HTML Failed", exc_info=True)
+                    # return None
+                    raise FigureDataCorrupt
+
+                if next_page_url is not None:
+                    # TODO: do not rely on outside function
+                    current_page += 1
+                    sys.stdout.write('\x1b[K')  # Clear the line
+                    print("Retrieving page {}".format(current_page))
+                    sys.stdout.write('\x1b[1A')  # Move cursor up 2 lines
+                    try:
+                        html = Decoding.scrapeSite(next_page_url)
+                    except requests.Timeout or requests.Timeout as e:
+                        self._log.error("Getting next Amiami pre-owned page Failed", exc_info=True)
+
+                        raise FigureDataCorrupt
+                        # return None
+
+                    got_multiple_pages = True
+
+                    if html is None:  # if we can not get the web page (unknown reason), do not go to next page and invalidate results.
+                        more_figures = False
+                        self._log.error("Unable to retrieve the next page.")
+                        raise FigureDataCorrupt
+                        # return None
+                else:
+                    more_figures = False
+            if got_multiple_pages:
+                # sys.stdout.write('\x1b[K')  # Clear the line Retrieving page line
+                pass
+        return self._figures
+
+    def _parse_figure(self, figure_soup, _url, html):
+        tempFig = FigureData(self, Decoder.amiami_preowned, html)  # type: FigureData
+        tempFig.condition = ""
+
+        tmp = figure_soup.find(class_='product_name_list')
+        tmp2 = tmp.find('a')
+        tempFig.link = tmp2.get('href')
+        tempFig.name = tmp2.text  # figure_soup.find(class_='product_name_list').text  # type: str
+
+        tempPrice = figure_soup.find(class_="product_price").text.strip()
+
+        try:
+            tempPrice = re.search(r'\d{1,3}?,?\d{1,3}?,?\d{1,3} JPY', tempPrice)
+            if tempPrice is not None:
+                tempFig.price = tempPrice.group(0)
+            else:
+                tempFig.price = " "
+        except Exception as e:
+            self._log.error('re search error: ', exc_info=True)
+        tempFig.price_value, tempFig.currency = Decoding.parse_price(tempFig.price, self.currency)
+
+        tempFig.pic_link = figure_soup.find('img')['src']
+
+        # The condition is not listed on the listing page, only the detail page.
+        # To prevent hammering AmiAmi, we will get condition data only if the item is a match.
+
+        tempFig._search_url = _url
+        return tempFig
+
+    def parse_page(self, html, _url, prototype_url=None):
+        """
+        Parses a single listing page without fetching anything. Figures without a title on the listing get their
+        extended name fetched here, as get_figures does.
+        @param prototype_url: Only given for the first page, which links to all the others
+        @return: The figures on the page and the urls of the listing pages that follow it
+        @rtype: (list[FigureData], list[str])
+        """
+        return self._parse_listing(html, _url, prototype_url)
+
+    def _parse_listing(self, html, _url, prototype_url=None):
+        try:
+            parsed_html = BeautifulSoup(html, 'html.parser')
+        except:
+            self._log.error("parsing html failed.", exc_info=True)
+            raise FigureDataCorrupt
+        try:
+            urls = []
+            if prototype_url is not None and self.get_next_pages:
+                urls = self._get_pages(html_soup=parsed_html, prototype_url=prototype_url) or []
+            figures = [self._parse_figure(figure_soup, _url, None)
+                       for figure_soup in parsed_html.find_all(class_="product_box")]
+        except Exception:
+            self._log.error("Parsing Amiami pre-owned HTML Failed", exc_info=True)
+            raise FigureDataCorrupt
+        finally:
+            parsed_html.decompose()
+
+        untitled = [figure for figure in figures if figure.name == ""]  # AmiAmi sometimes leaves titles out
+        if untitled:
+            self.threaded_get_extended_names(untitled)
+        return figures, urls
+
+    def iter_figures(self, html=None, _url=None, prototype_url=None):
+        """
+        Yields the figures of the listing page by page. The other pages are fetched concurrently, but never more of
+        them than fit in max_buffered_bytes are held at once, and each parse tree is released as soon as its page has
+        been read, so memory stays flat however many pages the listing has. Pages are read in isolation, see
+        Decoder._read_page.
+
+        @param html: The first page. None if fetching it failed.
+        @type html: str | None
+        @param _url: Url of the first page
+        @type _url: str
+        @param prototype_url: Url of the listing with -~PAGENUMBER~- in place of the page number
+        @type prototype_url: str | None
+        @rtype: collections.Iterator[FigureData]
+        """
+        if _url is None or (html is None and self.snapshots is None):
+            return
+        page_size = len(html) if html is not None else 256 * 1024  # A typical listing page
+        self._log.info("Parsing figures from page 1.")
+        figures, urls = self._read_page(_url, html, 1, prototype_url)
+        html = None
+        yield from figures
+        if not urls:
+            return
+
+        print("Scraping {} more pages.".format(len(urls)))
+        window = max(1, min(len(urls), self.max_buffered_bytes // max(page_size, 1)))
+        pool = Pool(processes=min(8, window))
+        try:
+            for start in range(0, len(urls), window):
+                batch = urls[start:start + window]
+                for i, (url, page_html) in enumerate(zip(batch, pool.imap(Decoding.scrapeSite, batch))):
+                    self._log.info("Parsing figures from page {0}.".format(start + i + 2))
+                    figures, _ = self._read_page(url, page_html, start + i + 2)
+                    page_html = None
+                    yield from figures
+        finally:
+            pool.close()
+            pool.join()
+
+    def threaded_get_extended_names(self, _figures):
+        self._log.info("Getting extended names for {} figures.".format(len(_figures)))
+        pool = Pool(processes=30)
+        args = []
+        for figure in _figures:
+            args.append([figure, True])
+        pool.starmap(self.get_extended_name, args)
+        pool.close()
+        pool.join()
+
+        self._log.info("Got extended names")
+
+    def get_extended_name(self, _figure, override=False):
+        result = None  # re.search(re.escape(r"..."), _figure.name)  # AMIAMI does not use shortened names.
+        if result is not None or override is True:
+            # The entire name is not given on this page. We need the item page to get it.
+            self._log.debug("Need to get extended name for " + _figure.name)
+            # TODO: Do not rely on outside function
+
+            item_html = Decoding.scrapeSite(_figure.link)
+
+            if item_html is not None:
+                item_soup = BeautifulSoup(item_html, 'html.parser')
+                # TODO: Consider returning the extended name and setting it in the figure so extended_name is read only
+                try:
+                    tmp_extended_name = item_soup.find(class_="heading_10").contents[0]#.text
+                    # Remove (Released) from end of name
+                    _figure.extended_name = re.sub(r'\(Released\)', '', tmp_extended_name)  # This call is safe
+                    # TODO: I am setting the extended name here, but the condition in condition. Does this make sense?
+                    # Remove the condition data from the figure and store it in the figure.
+
+                    condition, extended_name = self._condition(_figure.extended_name)
+                    if condition is not None:
+                        _figure._condition, _figure.extended_name = condition, extended_name
+                    else:
+                        # Not a pre-owned heading, so the condition given by the listing stands.
+                        self._log.warning("No condition in the detail page of " + _figure.name)
+
+                    self._log.debug("New Name: " + _figure.extended_name)
+                except Exception as e:
+                    self._log.error("Unable to retrieve item detail page. Using truncated name.", exc_info=True)
+            else:
+                self._log.error("Unable to retrieve item detail page. Using truncated name.", exc_info=True)
+            # We need to extract the condition data from the name.
+
+    def identity(self, _figure):
+        # Every pre-owned item has a product code of its own, while the same figure in another condition has the same
+        # name on the listing. The rest of the link changes with the page the item is on.
+        code = re.search(r'gcode=([^&]+)', _figure.link or "")
+        return _figure._name + "#" + code.group(1) if code is not None else _figure._name
+
+    def condition_grade(self, condition):
+        # "Item : A- Box: B" is graded by the item
+        grade = re.match(r'Item\s*:\s*(\S+)', condition)
+        return grade.group(1) if grade is not None else condition
+
+    def get_condition(self, _figure):
+        #  Condition data is held in the extended name
+        if _figure.condition:
+            return  # Already read from the detail page, e.g. for an untitled figure
+        self.get_extended_name(_figure, override=True)
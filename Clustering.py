@@ -0,0 +1,271 @@
+import re
+import zlib
+import random
+import logging
+import threading
+
+
+def normalize_name(name):
+    """
+    Reduces a listing name to what identifies the figure: lower case, without bracketed notes such as
+    "(Pre-owned ITEM:A/BOX:B)" or "(Released)", and without punctuation.
+
+    @type name: str
+    @rtype: str
+    """
+    name = re.sub(r'\([^)]*\)|\[[^\]]*\]', ' ', name.lower())
+    name = re.sub(r'[^\w]+', ' ', name)
+    return " ".join(name.split())
+
+
+def shingles(name, size=3):
+    """
+    @param name: A normalized name
+    @type name: str
+    @param size: Characters per shingle
+    @type size: int
+    @return: The hashes of the overlapping character shingles of the name
+    @rtype: set[int]
+    """
+    if len(name) <= size:
+        return {zlib.crc32(name.encode('UTF-8'))}
+    return set(zlib.crc32(name[index:index + size].encode('UTF-8')) for index in range(len(name) - size + 1))
+
+
+variant_words = frozenset(['ver', 'version'])  # Words that mark a different version of the same figure
+
+
+def _same_figure(first, second):
+    """
+    @param first: The words of a normalized name
+    @type first: frozenset[str]
+    @param second: The words of another
+    @type second: frozenset[str]
+    @return: Whether the words of one name are all in the other, and the words it lacks do not make it a version of
+        its own, as in "Kirino Mizugi Ver." and "Kirino"
+    @rtype: bool
+    """
+    if first <= second:
+        return not (second - first) & variant_words
+    if second <= first:
+        return not (first - second) & variant_words
+    return False
+
+
+class MinHasher:
+
+    prime = (1 << 61) - 1  # Mersenne prime larger than any shingle hash
+
+    def __init__(self, num_perm=32, seed=1):
+        """
+        MinHash signatures: the share of positions two signatures agree on estimates the Jaccard similarity of the
+        shingle sets they were made from. The permutations are seeded, so signatures are the same in every process.
+
+        @param num_perm: Length of a signature
+        @type num_perm: int
+        @type seed: int
+        """
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self._permutations = [(rng.randrange(1, self.prime), rng.randrange(0, self.prime)) for _ in range(num_perm)]
+
+    def signature(self, hashes):
+        """
+        @param hashes: Shingle hashes, as returned by shingles()
+        @type hashes: set[int]
+        @rtype: tuple[int]
+        """
+        prime = self.prime
+        return tuple(min((a * value + b) % prime for value in hashes) for a, b in self._permutations)
+
+    @staticmethod
+    def similarity(first, second):
+        """
+        @return: The estimated Jaccard similarity of the names behind two signatures
+        @rtype: float
+        """
+        return sum(1 for a, b in zip(first, second) if a == b) / len(first)
+
+
+class ClusterIndex:
+
+    def __init__(self, num_perm=32, bands=16, threshold=0.5, shingle_size=3, seed=1):
+        """
+        Groups listings of the same figure across sub-sites. Each listing gets a MinHash signature of its normalized
+        name, which is split into bands. Listings sharing a band are candidates. A candidate joins the cluster if the
+        signatures are at least threshold similar and the words of one name are all found in the other: "Nendoroid
+        Izayoi" and "Nendoroid No.105 Izayoi" are one figure, but "... Shikishi Gino" and "... Shikishi Euphemia",
+        however similar, are not. Listings are added and removed one at a time, so the index follows the listings as
+        they change without ever being rebuilt.
+
+        Listings are keyed by (group, identity), where group is the sub-site key. A cluster is not split again when
+        the listing that connected two others is removed.
+
+        @param num_perm: Length of the signatures
+        @type num_perm: int
+        @param bands: Bands the signatures are split into. num_perm must be a multiple of it.
+        @type bands: int
+        @param threshold: Estimated Jaccard similarity two names need to be clustered
+        @type threshold: float
+        @param shingle_size: Characters per shingle
+        @type shingle_size: int
+        @type seed: int
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self._log = logging.getLogger(self.__class__.__name__)
+        self._lock = threading.RLock()
+        self._hasher = MinHasher(num_perm, seed)
+        self._bands = bands
+        self._rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self._buckets = [{} for _ in range(bands)]  # type: list[dict[tuple, set]]
+        self._signatures = {}  # type: dict[tuple, tuple]  # key to its signature
+        self._words = {}  # type: dict[tuple, frozenset]  # key to the words of its normalized name
+        self._offers = {}  # type: dict[tuple, object]  # key to whatever was passed along with it
+        self._cluster_of = {}  # type: dict[tuple, int]
+        self._members = {}  # type: dict[int, set]  # cluster to its keys
+        self._decisions = {}  # type: dict[int, dict]  # cluster to the decisions remembered for it
+        self._next_cluster = 0
+        self._groups = {}  # type: dict[str, set]  # group to the identities it has in the index
+
+    def _band_keys(self, signature):
+        rows = self._rows
+        return [tuple(signature[band * rows:(band + 1) * rows]) for band in range(self._bands)]
+
+    def add(self, key, name, offer=None):
+        """
+        Adds a listing, merging every cluster it is similar to.
+        @param key: (group, identity)
+        @type key: tuple
+        @param name: The name of the listing
+        @type name: str
+        @param offer: Kept with the listing and returned by offers()
+        @return: The cluster of the listing
+        @rtype: int
+        """
+        with self._lock:
+            if key in self._signatures:
+                self._offers[key] = offer
+                return self._cluster_of[key]
+            normalized = normalize_name(name)
+            words = frozenset(normalized.split())
+            signature = self._hasher.signature(shingles(normalized, self.shingle_size))
+            candidates = set()
+            for band, band_key in enumerate(self._band_keys(signature)):
+                bucket = self._buckets[band].setdefault(band_key, set())
+                candidates.update(bucket)
+                bucket.add(key)
+            clusters = set(self._cluster_of[candidate] for candidate in candidates
+                           if MinHasher.similarity(signature, self._signatures[candidate]) >= self.threshold and
+                           _same_figure(words, self._words[candidate]))
+
+            self._signatures[key] = signature
+            self._words[key] = words
+            self._offers[key] = offer
+            if clusters:
+                # The smaller clusters are merged into the biggest one.
+                cluster = max(clusters, key=lambda candidate: len(self._members[candidate]))
+                for other in clusters - {cluster}:
+                    for member in self._members.pop(other):
+                        self._cluster_of[member] = cluster
+                        self._members[cluster].add(member)
+                    for watchlist, decision in self._decisions.pop(other, {}).items():
+                        self._decisions.setdefault(cluster, {}).setdefault(watchlist, decision)
+            else:
+                cluster = self._next_cluster
+                self._next_cluster += 1
+                self._members[cluster] = set()
+            self._cluster_of[key] = cluster
+            self._members[cluster].add(key)
+            return cluster
+
+    def remove(self, key):
+        with self._lock:
+            signature = self._signatures.pop(key, None)
+            if signature is None:
+                return
+            for band, band_key in enumerate(self._band_keys(signature)):
+                bucket = self._buckets[band][band_key]
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band][band_key]
+            self._offers.pop(key, None)
+            self._words.pop(key, None)
+            cluster = self._cluster_of.pop(key)
+            self._members[cluster].discard(key)
+            if not self._members[cluster]:
+                del self._members[cluster]
+                self._decisions.pop(cluster, None)
+
+    def sync(self, group, listings):
+        """
+        Brings the listings of one group up to date: listings that are new are added, listings that are gone are
+        removed and the offers of the others are replaced.
+
+        @param group: The sub-site key
+        @type group: str
+        @param listings: Every current listing of the group, identity to its name and offer
+        @type listings: dict[str, (str, object)]
+        @return: Number of listings added and number removed
+        @rtype: (int, int)
+        """
+        with self._lock:
+            known = self._groups.setdefault(group, set())
+            gone = known - set(listings)
+            for identity in gone:
+                self.remove((group, identity))
+            added = 0
+            for identity, (name, offer) in listings.items():
+                if identity not in known:
+                    added += 1
+                self.add((group, identity), name, offer)
+            self._groups[group] = set(listings)
+            return added, len(gone)
+
+    def drop_group(self, group):
+        with self._lock:
+            for identity in self._groups.pop(group, set()):
+                self.remove((group, identity))
+
+    def cluster(self, key):
+        """
+        @return: The keys of every listing in the cluster of key, key included. Empty if key is not in the index.
+        @rtype: set[tuple]
+        """
+        with self._lock:
+            cluster = self._cluster_of.get(key)
+            return set(self._members[cluster]) if cluster is not None else set()
+
+    def offers(self, key):
+        """
+        @return: The offers of the other listings in the cluster of key, from other groups only
+        @rtype: list
+        """
+        with self._lock:
+            return [self._offers[member] for member in self.cluster(key)
+                    if member[0] != key[0] and self._offers.get(member) is not None]
+
+    def decision(self, key, watchlist):
+        """
+        @param watchlist: What the decision depends on besides the figure, e.g. the hash of a watchlist
+        @return: The decision remembered for the cluster of key, or None
+        """
+        with self._lock:
+            cluster = self._cluster_of.get(key)
+            if cluster is None:
+                return None
+            return self._decisions.get(cluster, {}).get(watchlist)
+
+    def remember(self, key, watchlist, decision):
+        """
+        Remembers a decision for the whole cluster of key, e.g. which watchlist entry it matched.
+        """
+        with self._lock:
+            cluster = self._cluster_of.get(key)
+            if cluster is not None:
+                self._decisions.setdefault(cluster, {})[watchlist] = decision
+
+    def __len__(self):
+        return len(self._members)
@@ -0,0 +1,509 @@
+# The figures, the decoders that read them from the shops and fetching pages. The decoders import this module rather
+# than StockChecker, so they get the same classes whether StockChecker was imported or run as a script.
+
+import re
+import logging
+import importlib
+import traceback
+import time as time_p
+from multiprocessing.dummy import Pool
+
+import Metrics
+
+# Metrics of fetching and reading pages. They are exported with those of StockChecker through Metrics.registry.
+fetch_seconds = Metrics.registry.histogram('stockchecker_fetch_seconds', 'Seconds spent fetching a single page.')
+pages_fetched = Metrics.registry.counter('stockchecker_pages_fetched_total', 'Pages fetched successfully.')
+bytes_fetched = Metrics.registry.counter('stockchecker_bytes_fetched_total', 'Characters of html fetched.')
+fetch_retries = Metrics.registry.counter('stockchecker_fetch_retries_total', 'Page fetches that were retried.')
+page_failures = Metrics.registry.counter('stockchecker_page_failures_total',
+                                         'Listing pages that could not be read, by what was used instead.',
+                                         ('fallback',))
+
+
+class FigureData:
+
+
+    def __init__(self, decoder, service, figure_html):
+        self._service = service.lower()  # type: str
+        self._decoder = decoder
+        self._html = figure_html
+        # self._parsed_html = BeautifulSoup(localHTML, 'html.parser')
+        self._name = None  # type: str
+        self.price = None  # type: str  # As listed
+        self.price_value = None  # type: int  # In the smallest unit of currency, see parse_price
+        self.currency = None  # type: str
+        self.link = None  # type: str
+        self.pic_link = None  # type: str
+        self._condition = None  # type: str
+        self._releaseStatus = None  # type: str
+        self._extended_name = None  # type: str
+        self._search_url = None  # type: str # TODO: This is currently unused
+        self.TTL = 3 # type: int  # number of times the figure must be missing to remove it from data
+        self.stale = False  # type: bool  # Taken from the last good parse of a page that could not be read
+        self.first_seen = time_p.time()  # type: float
+        self.last_seen = self.first_seen  # type: float
+        self._identity = None  # type: (str, str, str)  # name and link the identity was worked out from, and identity
+
+    @property
+    def release_status(self):
+        return self._releaseStatus
+
+    @release_status.setter
+    def release_status(self, value):
+        self._releaseStatus = value
+
+    @property
+    def name(self):
+        """
+        Returns the name of the figure
+
+        @return: Figure Name
+        @rtype: str
+        """
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        """
+        @param value: the name of the figure
+        @type value: str
+        """
+        self._name = value.strip()
+
+    @property
+    def extended_name(self):
+        if self._extended_name is not None:
+            return self._extended_name
+        else:
+            return self.name
+
+    @extended_name.setter
+    def extended_name(self, value):
+        self._extended_name = value.strip()
+
+    @property
+    def condition(self):
+        """
+        Returns the condition of the figure.
+
+        @return: a condition string defined in Decoder
+        @rtype: str
+        """
+        return self._condition
+
+    @condition.setter
+    def condition(self, value):
+        if self._condition is None:
+            self._condition = value
+        else:
+            raise ValueError("Can not change condition once condition has already been set.")
+
+    @property
+    def search_url(self):
+        return self._search_url
+
+    @search_url.setter
+    def search_url(self, value):
+        self._search_url = value
+
+    @property
+    def identity(self):
+        """
+        The key a figure is tracked by from one scrape to the next
+        @rtype: str
+        """
+        if self._decoder is None:
+            return self._name
+        if self._identity is None or self._identity[0] != self._name or self._identity[1] != self.link:
+            self._identity = (self._name, self.link, self._decoder.identity(self))
+        return self._identity[2]
+
+    def get_extended_name(self):
+        self._decoder.get_extended_name(self)
+
+    def get_condition(self):
+        self._decoder.get_condition(self)
+
+    @property
+    def needs_details(self):
+        return self._decoder.needs_details(self)
+
+    def to_record(self):
+        """
+        Converts the figure into a plain record for the state store. The page html is not kept.
+        @return: The figure data keyed by StateStore.figure_columns
+        @rtype: dict
+        """
+        return {'identity': self.identity,
+                'name': self._name,
+                'service': self._service,
+                'price': self.price,
+                'price_value': self.price_value,
+                'currency': self.currency,
+                'link': self.link,
+                'pic_link': self.pic_link,
+                'condition': self._condition,
+                'extended_name': self._extended_name,
+                'search_url': self._search_url,
+                'ttl': self.TTL,
+                'first_seen': self.first_seen,
+                'last_seen': self.last_seen}
+
+    @classmethod
+    def from_record(cls, decoder, record):
+        """
+        Rebuilds a figure from a state store record.
+        @param decoder: The decoder that will be used to fetch details for the figure
+        @type decoder: Decoder
+        @type record: dict
+        @rtype: FigureData
+        """
+        figure = cls(decoder, record['service'], None)
+        figure._name = record['name']
+        figure.price = record['price']
+        if 'price_value' in record:
+            figure.price_value, figure.currency = record['price_value'], record['currency']
+        else:  # The state store only keeps the price as listed
+            figure.price_value, figure.currency = parse_price(record['price'], decoder.currency)
+        figure.link = record['link']
+        figure.pic_link = record['pic_link']
+        figure._condition = record['condition']
+        figure._extended_name = record['extended_name']
+        figure._search_url = record['search_url']
+        figure.TTL = record['ttl']
+        figure.first_seen = record['first_seen']
+        figure.last_seen = record['last_seen']
+        return figure
+
+
+class Decoder:
+    jungle = 'jungle'
+    amiami = 'amiami'
+    amiami_preowned = 'amiami_preowned'
+    get_next_pages = True  # Follow the paging links of a listing. Disable to only read the first page.
+    max_buffered_bytes = 8 * 1024 * 1024  # Html of fetched pages waiting to be parsed is held below this
+    page_retries = 1  # Times a listing page that could not be fetched or parsed is fetched again
+    currency = None  # type: str  # Currency of prices listed without one
+    snapshots = None  # type: PageSnapshots  # Falls back to the last good parse of pages that can not be read
+
+    def __new__(cls, service, *arguments, **keyword):
+        subclass = decoders.get(service)
+        if subclass is None:
+            raise Exception('Website not supported not supported')
+        return super(cls, subclass).__new__(subclass)  # , *arguments)#, **keyword)
+
+    def _condition(self, value):
+        raise NotImplementedError
+
+    def _get_next_page(self):
+        """
+        Scrapes the webpage for the next page URL and returns it if found. If it can not be found, return None
+        @return: Next Page URL or None
+        @rtype: str | None
+        """
+        raise NotImplementedError
+
+    def get_figures(self, html=None, _url=None, prototype_url=None):
+        raise NotImplementedError
+
+    def iter_figures(self, html=None, _url=None, prototype_url=None):
+        """
+        Yields the figures of a listing, fetching and parsing one page after another.
+        @rtype: collections.Iterator[FigureData]
+        """
+        raise NotImplementedError
+
+    def _parse_listing(self, html, _url, prototype_url=None):
+        """
+        Parses one listing page and releases its parse tree.
+        @return: The figures on the page and the urls of the listing pages it leads to
+        @rtype: (list[FigureData], list[str])
+        @raise FigureDataCorrupt: If the page could not be parsed
+        """
+        raise NotImplementedError
+
+    def _read_page(self, url, html, page_number, prototype_url=None):
+        """
+        Parses one listing page in isolation. A page that could not be fetched or parsed is fetched again, up to
+        page_retries times. After that it is taken from its snapshot, if the decoder has snapshots.
+
+        @param url: The page
+        @type url: str
+        @param html: The page as it was fetched. None if fetching it failed.
+        @type html: str | None
+        @param page_number: For the log
+        @type page_number: int
+        @param prototype_url: Passed on to _parse_listing
+        @type prototype_url: str | None
+        @return: The figures on the page and the urls of the listing pages it leads to
+        @rtype: (list[FigureData], list[str])
+        @raise FigureDataCorrupt: If the page could not be read and there are no snapshots to fall back to
+        """
+        attempt = 0
+        while True:
+            if html is not None:
+                try:
+                    figures, next_urls = self._parse_listing(html, url, prototype_url)
+                except FigureDataCorrupt:
+                    self._log.error("Unable to parse page {}.".format(page_number))
+                else:
+                    if self.snapshots is not None:
+                        self.snapshots.store(url, figures, next_urls)
+                    return figures, next_urls
+            else:
+                self._log.error("Unable to retrieve page {}.".format(page_number))
+            html = None
+            if attempt >= self.page_retries:
+                break
+            attempt += 1
+            html = scrapeSite(url)
+
+        if self.snapshots is None:
+            page_failures.inc(fallback="none")
+            raise FigureDataCorrupt("Unable to read " + url)
+        snapshot = self.snapshots.fallback(self, url)
+        if snapshot is None:
+            page_failures.inc(fallback="unknown")
+            self._log.error("Page {} was never read. Its figures are unknown this cycle.".format(page_number))
+            return [], []
+        page_failures.inc(fallback="snapshot")
+        self._log.warning("Using the last good parse of page {}.".format(page_number))
+        return snapshot
+
+    def get_extended_name(self, _figure, override=False):
+        raise NotImplementedError
+
+    def get_condition(self, _figure):
+        """
+        Fills in the condition of a figure whose listing does not give it. Most listings do, so this does nothing.
+        @type _figure: FigureData
+        """
+        pass
+
+    def condition_grade(self, condition):
+        """
+        The grade a watchlist condition filter is compared against, e.g. "A" or "Sealed".
+        @type condition: str
+        @rtype: str
+        """
+        return condition
+
+    def needs_details(self, _figure):
+        """
+        Whether the listing name of a figure is too incomplete to match it against a watchlist, so that its detail page
+        has to be read first.
+        @type _figure: FigureData
+        @rtype: bool
+        """
+        return False
+
+    def identity(self, _figure):
+        """
+        The key a figure is tracked by from one scrape to the next. The name, unless the shop lists the same figure
+        more than once under one name, e.g. in different conditions.
+        @type _figure: FigureData
+        @rtype: str
+        """
+        return _figure._name
+
+
+class DecoderRegistry:
+
+    def __init__(self):
+        """
+        Maps service names to their decoder. The module of a decoder, and the parsing libraries it needs, are only
+        imported the first time a website of that service is decoded.
+        """
+        self._modules = {}  # type: dict[str, (str, str)]
+        self._classes = {}  # type: dict[str, type]
+
+    def register(self, service, module, class_name):
+        """
+        @param service: The service name, as the website name in sources.xml starts with
+        @type service: str
+        @param module: Name of the module holding the decoder
+        @type module: str
+        @param class_name: Name of the decoder class in that module
+        @type class_name: str
+        """
+        self._modules[service.lower()] = (module, class_name)
+        self._classes.pop(service.lower(), None)
+
+    def services(self):
+        """
+        @rtype: list[str]
+        """
+        return sorted(self._modules)
+
+    def _resolve(self, name):
+        service = name.lower()
+        if service in self._modules:
+            return service
+        # Website names only need to start with the service, e.g. "AmiAmi_preowned figures".
+        matches = [registered for registered in self._modules if service.startswith(registered)]
+        return max(matches, key=len) if matches else None
+
+    def get(self, name):
+        """
+        @param name: A website name
+        @type name: str
+        @return: The decoder class of the service, or None if no decoder is registered for it
+        @rtype: type | None
+        """
+        service = self._resolve(name)
+        if service is None:
+            return None
+        decoder = self._classes.get(service)
+        if decoder is None:
+            module, class_name = self._modules[service]
+            decoder = self._classes[service] = getattr(importlib.import_module(module), class_name)
+        return decoder
+
+
+decoders = DecoderRegistry()
+decoders.register(Decoder.jungle, 'JungleDecoder', 'JungleDecoder')
+decoders.register(Decoder.amiami_preowned, 'AmiAmiPreownedDecoder', 'AmiAmiPreownedDecoder')
+
+
+class FigureDataCorrupt(Exception):
+    pass
+
+
+def threaded_scrape(urls, max_retries=10, fake=False):
+    """
+    A threaded version of scrape site.
+    @param urls:
+    @type urls: list[str]
+    @param max_retries:
+    @type max_retries: int
+    @return: list[str | None | requests.Response]
+    """
+    if fake is not True:
+        print("Scraping {} more pages.".format(len(urls)))
+        pool = Pool(processes=8)
+        sites = pool.map(scrapeSite, urls)
+        for site in sites:
+            if site is None:
+                logging.error("Unable to retrieve the next page.")
+                pool.close()
+                pool.join()
+                raise FigureDataCorrupt
+        pool.close()
+        pool.join()
+        return sites
+
+    else:
+        sites = []
+        for url in urls:
+            site = scrapeSite(url, retry=max_retries)
+            if site is None:
+                logging.error("Unable to retrieve the next page.")
+                raise FigureDataCorrupt
+            sites.append(site)
+        return sites
+
+
+def scrapeSite(_url, use_progress_bar=False, retry=10):
+    """
+    Safely retrieves and returns a website using passed URL.
+    If error occurs during retrieval, None will be returned instead
+
+    @param _url: The URL of the website that will be scraped
+    @type _url: str
+    @param retry: Indicates How many retries are left. Starts at 10 by default.
+    @type retry: int
+    @return: website html if successful, otherwise None
+    @rtype: str | None | requests.Response
+    """
+
+    import requests  # pip3 install requests
+
+    logging.debug("Scraping " + _url)
+    try:
+        with fetch_seconds.time():
+            website = requests.get(_url)
+    except requests.Timeout as e:
+        website = None
+        if retry > 0:
+            fetch_retries.inc()
+            logging.warning("Retry #{}".format(11 - retry))
+            time_p.sleep(0.25 * (11 - retry))
+            retry_scrape = scrapeSite(_url, retry=(retry - 1))
+            try:
+                data = retry_scrape.text
+            except:
+                data = retry_scrape
+            return data
+        else:
+            logging.error(traceback.format_exc())
+            raise requests.Timeout
+    except Exception as error:
+        website = None
+        # printTKMSG("Uncaught Exception in scrapePlex", traceback.format_exc())
+
+        if retry > 0:
+            fetch_retries.inc()
+            logging.warning("Retry #{}".format(11 - retry))
+            time_p.sleep(0.33 * (11 - retry))
+            retry_scrape = scrapeSite(_url, retry=(retry - 1))
+            try:
+                data = retry_scrape.text
+            except:
+                data = retry_scrape
+            return data
+        else:
+            logging.error(traceback.format_exc())
+            raise requests.RequestException
+
+    if website is not None:
+        website_data = website.text
+        pages_fetched.inc()
+        bytes_fetched.inc(len(website_data))
+    else:
+        website_data = None
+
+    return website_data
+
+
+# Currency codes of the symbols prices are written with. Jungle writes yen as "Y".
+currency_symbols = {'¥': 'JPY', '円': 'JPY', 'Y': 'JPY', '$': 'USD', '€': 'EUR', '£': 'GBP'}
+currency_decimals = {'JPY': 0, 'KRW': 0}  # Digits after the decimal point. Every other currency has 2.
+price_pattern = re.compile(r'(?P<before>[A-Z]{3}|[^\d\s.,-]{1,2})?\s*(?P<amount>\d[\d,]*(?:\.\d+)?)\s*(?P<after>[A-Z]{3}|円)?')
+
+
+def parse_price(text, default_currency=None):
+    """
+    Reads a price written as e.g. "12,800 JPY", "Y1,080" or "$12.99".
+
+    @param text: The price as listed
+    @type text: str | None
+    @param default_currency: Currency of a price written without one
+    @type default_currency: str | None
+    @return: The price in the smallest unit of its currency (yen, cents) and the currency code, or (None, None) if
+             there is no price in the text
+    @rtype: (int | None, str | None)
+    """
+    if not text:
+        return None, None
+    match = price_pattern.search(text)
+    if match is None:
+        return None, None
+    currency = default_currency
+    for symbol in (match.group('after'), match.group('before')):
+        if symbol is not None:
+            currency = currency_symbols.get(symbol, symbol if len(symbol) == 3 and symbol.isupper() else currency)
+    decimals = currency_decimals.get(currency, 2)
+    whole, _, fraction = match.group('amount').replace(',', '').partition('.')
+    return int(whole) * 10 ** decimals + int((fraction + '0' * decimals)[:decimals] or 0), currency
+
+
+def format_price(value, currency):
+    """
+    @param value: Price in the smallest unit of its currency, as returned by parse_price
+    @type value: int
+    @type currency: str | None
+    @rtype: str
+    """
+    decimals = currency_decimals.get(currency, 2)
+    amount = "{:,}".format(value) if decimals == 0 else "{:,.{}f}".format(value / 10 ** decimals, decimals)
+    return (amount + " " + currency) if currency else amount
@@ -0,0 +1,371 @@
+import json
+import uuid
+import hashlib
+import logging
+import sqlite3
+import threading
+import time as time_p
+
+
+class Job:
+    listing = 'listing'  # Fetch and parse one listing page
+    detail = 'detail'  # Fetch the detail pages of a batch of figures
+    match = 'match'  # Match a batch of figure names against a watchlist
+
+    queued = 'queued'
+    leased = 'leased'
+    done = 'done'
+    failed = 'failed'
+
+    def __init__(self, kind, sub_site, crawl, payload, max_attempts=5):
+        """
+        A unit of crawl work. Its id is derived from what it does, so putting the same job twice, e.g. when two
+        workers find the same next page, only queues it once.
+
+        @param kind: Job.listing, Job.detail or Job.match
+        @type kind: str
+        @param sub_site: Key of the sub-site the job belongs to
+        @type sub_site: str
+        @param crawl: Identifies the crawl of the sub-site the job is part of
+        @type crawl: str
+        @param payload: What the job works on. Must be JSON serializable.
+        @type payload: dict
+        @param max_attempts: Leases the job gets before it is given up on
+        @type max_attempts: int
+        """
+        self.kind = kind
+        self.sub_site = sub_site
+        self.crawl = crawl
+        self.payload = payload
+        self.max_attempts = max_attempts
+        self.id = self.make_id(kind, sub_site, crawl, payload)  # type: str
+        self.state = Job.queued  # type: str
+        self.attempts = 0  # type: int
+        self.lease = None  # type: str  # Token of the current lease
+        self.result = None  # type: dict
+        self.error = None  # type: str
+
+    @staticmethod
+    def make_id(kind, sub_site, crawl, payload):
+        return hashlib.sha1(json.dumps([kind, sub_site, crawl, payload], sort_keys=True).encode('UTF-8')).hexdigest()
+
+    @classmethod
+    def from_row(cls, kind, sub_site, crawl, payload, max_attempts, state, attempts, lease, result, error):
+        job = cls(kind, sub_site, crawl, json.loads(payload), int(max_attempts))
+        job.state = state
+        job.attempts = int(attempts)
+        job.lease = lease
+        job.result = json.loads(result) if result else None
+        job.error = error
+        return job
+
+
+class JobQueue:
+    """
+    Hands crawl jobs out to workers under a lease. A job whose lease runs out before it is completed is handed out
+    again, and a failed job is retried after a delay until it runs out of attempts. Completing a job is idempotent:
+    only the first result is kept, so a slow worker finishing a job that was already re-leased changes nothing.
+    """
+
+    def put(self, job):
+        """
+        @type job: Job
+        @return: False if the job was already queued
+        @rtype: bool
+        """
+        raise NotImplementedError
+
+    def lease(self, worker, lease_seconds=60.0):
+        """
+        @param worker: Name of the worker taking the job, for logging
+        @type worker: str
+        @param lease_seconds: Seconds the worker has to complete the job before it is handed to another
+        @type lease_seconds: float
+        @return: The next available job, or None if there is none
+        @rtype: Job | None
+        """
+        raise NotImplementedError
+
+    def complete(self, job, result):
+        """
+        @param job: A leased job
+        @type job: Job
+        @param result: The result. Must be JSON serializable.
+        @type result: dict
+        @return: False if the job already had a result
+        @rtype: bool
+        """
+        raise NotImplementedError
+
+    def fail(self, job, error):
+        """
+        @param job: A leased job
+        @type job: Job
+        @param error: Why the job failed
+        @type error: str
+        @return: False if the lease was no longer held
+        @rtype: bool
+        """
+        raise NotImplementedError
+
+    def jobs(self, sub_site, crawl):
+        """
+        @return: Every job of a crawl, with its state and result
+        @rtype: list[Job]
+        """
+        raise NotImplementedError
+
+    def purge(self, sub_site, crawl):
+        """
+        Forgets the jobs of a finished crawl.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteJobQueue(JobQueue):
+
+    def __init__(self, uri="jobs.db", retry_delay=5.0, timeout=30.0):
+        """
+        A job queue in a SQLite database, for workers on one machine or a shared filesystem, and for tests.
+
+        @param uri: Path of the database file. ":memory:" can be used for throwaway queues.
+        @type uri: str
+        @param retry_delay: Seconds before a failed job is retried. Doubles with every further attempt.
+        @type retry_delay: float
+        @param timeout: Seconds to wait for another process to finish writing
+        @type timeout: float
+        """
+        self._log = logging.getLogger(self.__class__.__name__)
+        self._retry_delay = retry_delay
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(uri, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                  id TEXT PRIMARY KEY,
+                                  kind TEXT NOT NULL,
+                                  sub_site TEXT NOT NULL,
+                                  crawl TEXT NOT NULL,
+                                  payload TEXT NOT NULL,
+                                  max_attempts INTEGER NOT NULL,
+                                  state TEXT NOT NULL,
+                                  attempts INTEGER NOT NULL DEFAULT 0,
+                                  lease TEXT,
+                                  lease_expires REAL,
+                                  available REAL NOT NULL,
+                                  result TEXT,
+                                  error TEXT
+                              )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_available ON jobs (state, available)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_crawl ON jobs (sub_site, crawl)")
+
+    _columns = "kind, sub_site, crawl, payload, max_attempts, state, attempts, lease, result, error"
+
+    def put(self, job):
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO jobs (id, kind, sub_site, crawl, payload, max_attempts, state, available) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.id, job.kind, job.sub_site, job.crawl, json.dumps(job.payload, sort_keys=True), job.max_attempts,
+                 Job.queued, time_p.time()))
+            return cursor.rowcount == 1
+
+    def lease(self, worker, lease_seconds=60.0):
+        now = time_p.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                while True:
+                    row = self._conn.execute(
+                        "SELECT id, {} FROM jobs WHERE (state = ? AND available <= ?) OR (state = ? AND lease_expires "
+                        "<= ?) ORDER BY available LIMIT 1".format(self._columns),
+                        (Job.queued, now, Job.leased, now)).fetchone()
+                    if row is None:
+                        self._conn.execute("COMMIT")
+                        return None
+                    job = Job.from_row(*row[1:])
+                    if job.attempts >= job.max_attempts:
+                        self._log.error("Giving up on {} job of {} after {} attempts".format(job.kind, job.sub_site,
+                                                                                           job.attempts))
+                        self._conn.execute("UPDATE jobs SET state = ?, lease = NULL WHERE id = ?",
+                                           (Job.failed, job.id))
+                        continue
+                    job.attempts += 1
+                    job.state = Job.leased
+                    job.lease = "{}/{}".format(worker, uuid.uuid4().hex)
+                    self._conn.execute("UPDATE jobs SET state = ?, attempts = ?, lease = ?, lease_expires = ? "
+                                       "WHERE id = ?", (job.state, job.attempts, job.lease, now + lease_seconds, job.id))
+                    self._conn.execute("COMMIT")
+                    return job
+            except sqlite3.Error:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def complete(self, job, result):
+        with self._lock:
+            cursor = self._conn.execute("UPDATE jobs SET state = ?, result = ?, lease = NULL WHERE id = ? AND "
+                                        "state NOT IN (?, ?)",
+                                        (Job.done, json.dumps(result), job.id, Job.done, Job.failed))
+            return cursor.rowcount == 1
+
+    def fail(self, job, error):
+        with self._lock:
+            row = self._conn.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ? AND lease = ?",
+                                     (job.id, job.lease)).fetchone()
+            if row is None:
+                return False
+            attempts, max_attempts = row
+            if attempts >= max_attempts:
+                state, available = Job.failed, time_p.time()
+            else:
+                state, available = Job.queued, time_p.time() + self._retry_delay * 2 ** (attempts - 1)
+            cursor = self._conn.execute("UPDATE jobs SET state = ?, available = ?, error = ?, lease = NULL "
+                                        "WHERE id = ? AND lease = ?", (state, available, error, job.id, job.lease))
+            return cursor.rowcount == 1
+
+    def jobs(self, sub_site, crawl):
+        with self._lock:
+            return [Job.from_row(*row) for row in self._conn.execute(
+                "SELECT {} FROM jobs WHERE sub_site = ? AND crawl = ?".format(self._columns), (sub_site, crawl))]
+
+    def purge(self, sub_site, crawl):
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE sub_site = ? AND crawl = ?", (sub_site, crawl))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class BrokerJobQueue(JobQueue):
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="stockchecker", retry_delay=5.0):
+        """
+        A job queue on a Redis broker, for workers spread across machines. The redis client is only imported when a
+        broker queue is created.
+
+        @param url: Address of the broker
+        @type url: str
+        @param prefix: Prefix of every key the queue uses, so several checkers can share a broker
+        @type prefix: str
+        @param retry_delay: Seconds before a failed job is retried. Doubles with every further attempt.
+        @type retry_delay: float
+        """
+        import redis  # pip3 install redis
+
+        self._log = logging.getLogger(self.__class__.__name__)
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+        self._retry_delay = retry_delay
+        self._available = prefix + ":available"  # sorted set of queued job ids by the time they may be leased
+        self._leases = prefix + ":leases"  # sorted set of leased job ids by the time their lease runs out
+
+    def _job_key(self, job_id):
+        return "{}:job:{}".format(self._prefix, job_id)
+
+    def _crawl_key(self, sub_site, crawl):
+        return "{}:crawl:{}:{}".format(self._prefix, sub_site, crawl)
+
+    def _load(self, job_id):
+        fields = self._redis.hgetall(self._job_key(job_id))
+        if not fields:
+            return None
+        return Job.from_row(fields['kind'], fields['sub_site'], fields['crawl'], fields['payload'],
+                            fields['max_attempts'], fields['state'], fields.get('attempts', 0), fields.get('lease'),
+                            fields.get('result'), fields.get('error'))
+
+    def put(self, job):
+        key = self._job_key(job.id)
+        # The first field written decides which of several writers queues the job.
+        if not self._redis.hsetnx(key, 'kind', job.kind):
+            return False
+        self._redis.hset(key, mapping={'sub_site': job.sub_site, 'crawl': job.crawl,
+                                       'payload': json.dumps(job.payload, sort_keys=True),
+                                       'max_attempts': job.max_attempts, 'state': Job.queued, 'attempts': 0})
+        self._redis.sadd(self._crawl_key(job.sub_site, job.crawl), job.id)
+        self._redis.zadd(self._available, {job.id: time_p.time()})
+        return True
+
+    def lease(self, worker, lease_seconds=60.0):
+        now = time_p.time()
+        for job_id in self._redis.zrangebyscore(self._leases, 0, now):
+            # Whoever removes an expired lease puts the job back.
+            if self._redis.zrem(self._leases, job_id):
+                self._redis.zadd(self._available, {job_id: now})
+
+        while True:
+            candidates = self._redis.zrangebyscore(self._available, 0, now, start=0, num=1)
+            if not candidates:
+                return None
+            job_id = candidates[0]
+            if not self._redis.zrem(self._available, job_id):
+                continue  # Another worker took it first
+            job = self._load(job_id)
+            if job is None or job.state in (Job.done, Job.failed):
+                continue
+            if job.attempts >= job.max_attempts:
+                self._log.error("Giving up on {} job of {} after {} attempts".format(job.kind, job.sub_site,
+                                                                                   job.attempts))
+                self._redis.hset(self._job_key(job_id), 'state', Job.failed)
+                continue
+            job.attempts = self._redis.hincrby(self._job_key(job_id), 'attempts', 1)
+            job.state = Job.leased
+            job.lease = "{}/{}".format(worker, uuid.uuid4().hex)
+            self._redis.hset(self._job_key(job_id), mapping={'state': job.state, 'lease': job.lease})
+            self._redis.zadd(self._leases, {job_id: now + lease_seconds})
+            return job
+
+    def complete(self, job, result):
+        key = self._job_key(job.id)
+        if self._redis.hget(key, 'state') == Job.failed:
+            return False
+        # The first result written wins.
+        if not self._redis.hsetnx(key, 'result', json.dumps(result)):
+            return False
+        self._redis.hset(key, 'state', Job.done)
+        self._redis.hdel(key, 'lease')
+        self._redis.zrem(self._leases, job.id)
+        self._redis.zrem(self._available, job.id)
+        return True
+
+    def fail(self, job, error):
+        key = self._job_key(job.id)
+        if self._redis.hget(key, 'lease') != job.lease:
+            return False
+        self._redis.zrem(self._leases, job.id)
+        self._redis.hdel(key, 'lease')
+        attempts = int(self._redis.hget(key, 'attempts') or 0)
+        if attempts >= job.max_attempts:
+            self._redis.hset(key, mapping={'state': Job.failed, 'error': error})
+        else:
+            self._redis.hset(key, mapping={'state': Job.queued, 'error': error})
+            self._redis.zadd(self._available, {job.id: time_p.time() + self._retry_delay * 2 ** (attempts - 1)})
+        return True
+
+    def jobs(self, sub_site, crawl):
+        jobs = [self._load(job_id) for job_id in self._redis.smembers(self._crawl_key(sub_site, crawl))]
+        return [job for job in jobs if job is not None]
+
+    def purge(self, sub_site, crawl):
+        crawl_key = self._crawl_key(sub_site, crawl)
+        for job_id in self._redis.smembers(crawl_key):
+            self._redis.delete(self._job_key(job_id))
+            self._redis.zrem(self._available, job_id)
+            self._redis.zrem(self._leases, job_id)
+        self._redis.delete(crawl_key)
+
+    def close(self):
+        self._redis.close()
+
+
+def open_job_queue(uri):
+    """
+    @param uri: redis://host:port/db for a broker, otherwise the path of a SQLite database
+    @type uri: str
+    @rtype: JobQueue
+    """
+    if uri.startswith(('redis://', 'rediss://', 'unix://')):
+        return BrokerJobQueue(uri)
+    return SQLiteJobQueue(uri)
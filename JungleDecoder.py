@@ -0,0 +1,163 @@
+import re
+import sys
+import logging
+from urllib.parse import urljoin
+
+from bs4 import BeautifulSoup  # pip3 install beautifulsoup4
+
+import Decoding
+from Decoding import Decoder, FigureData, FigureDataCorrupt
+
+
+class JungleDecoder(Decoder):
+    service = Decoder.jungle
+    conditionBase = "http://jungle-scs.co.jp/sale_en/wp-content/themes/jungle_2013en/images/"
+    conditionS = "conditionicon_s_en.gif"
+    conditionA = "conditionicon_a_en.gif"
+    conditionB = "conditionicon_b_en.gif"
+    conditionDecode = {conditionS: 'Sealed', conditionA: 'A', conditionB: 'B'}
+    currency = 'JPY'
+
+    def __new__(cls, service):
+        pass
+
+    def __init__(self, service, get_next_pages=True, max_buffered_bytes=Decoder.max_buffered_bytes, snapshots=None):
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.get_next_pages = get_next_pages  # type: bool
+        self.max_buffered_bytes = max_buffered_bytes  # type: int  # Pages are fetched one at a time, so always met
+        self.snapshots = snapshots  # type: StockChecker.PageSnapshots
+        self._product_phtml = None
+        self._parsed_html = None  # type: BeautifulSoup
+        self._figures = []  # type: list[FigureData]
+
+    def _condition(self, value):
+        tmp = value[value.rindex('/') + 1:]
+        return self.conditionDecode[tmp]
+
+    def _get_next_page(self):
+        """
+        Scrapes the webpage for the next page URL and returns it if found. If it can not be found, return None
+        @return: Next Page URL or None
+        @rtype: str | None
+        """
+        if self.get_next_pages is False:
+            return None
+        paging_tags = self._parsed_html.find(id='paging')  #.find_all('span')  # type: list[tag]
+
+        if paging_tags is not None:
+            next_page_element = paging_tags.find('span', string='Next Page»') #_class='sp04_pl20')  #.find('a').get('href')
+            if next_page_element is not None:
+                next_page_url = next_page_element.find('a').get('href')
+                return next_page_url
+
+        return None
+
+    def _parse_figure(self, figure_soup, _url, html):
+        tempFig = FigureData(self, Decoder.jungle, html)  # type: FigureData
+
+        tempFig.name = figure_soup.find(class_='wrapword').text  # type: str
+
+        tempFig.price = figure_soup.find(class_="price").text
+        tempFig.price_value, tempFig.currency = Decoding.parse_price(tempFig.price, self.currency)
+
+        tempFig.pic_link = figure_soup.find('img')['src']
+
+        tempFig.condition = self._condition(figure_soup.find('p').find_all('img')[1]['src'])
+
+        relURL = figure_soup.find('a').get('href')
+        tempFig.link = urljoin(_url, relURL)
+
+        tempFig._search_url = _url
+        return tempFig
+
+    def parse_page(self, html, _url, prototype_url=None):
+        """
+        Parses a single listing page without fetching anything.
+        @return: The figures on the page and the urls of the listing pages that follow it
+        @rtype: (list[FigureData], list[str])
+        """
+        return self._parse_listing(html, _url, prototype_url)
+
+    def _parse_listing(self, html, _url, prototype_url=None):
+        self._parsed_html = BeautifulSoup(html, 'html.parser')
+        try:
+            next_page_url = self._get_next_page()
+            products_soup = self._parsed_html.find(id='products')
+            # TODO: Find a better way of determining that there are no products on the page
+            if products_soup is None:
+                return [], []
+            figures = [self._parse_figure(figure_soup, _url, None) for figure_soup in products_soup.find_all("li")]
+        except Exception as e:
+            self._log.error("Unable to parse listing %s", _url, exc_info=True)
+            raise FigureDataCorrupt from e
+        finally:
+            self._parsed_html.decompose()
+            self._parsed_html = None
+        return figures, [next_page_url] if next_page_url is not None else []
+
+    def iter_figures(self, html=None, _url=None, prototype_url=None):
+        """
+        Yields the figures of the listing page by page. The next page is only fetched once the figures of the current
+        one have been taken, and the parse tree of each page is released before that, so memory stays flat however
+        many pages the listing has. Pages are read in isolation, see Decoder._read_page.
+
+        @param html: The first page. None if fetching it failed.
+        @type html: str | None
+        @param _url: Url of the first page
+        @type _url: str
+        @rtype: collections.Iterator[FigureData]
+        """
+        if _url is None or (html is None and self.snapshots is None):
+            return
+
+        current_page = 1
+        page_url = _url
+        while page_url is not None:
+            figures, next_urls = self._read_page(page_url, html, current_page)
+            html = None
+            yield from figures
+
+            page_url = next_urls[0] if next_urls else None
+            if page_url is not None:
+                # TODO: do not rely on outside function
+                current_page += 1
+                html = Decoding.scrapeSite(page_url)
+                sys.stdout.write('\x1b[K')  # Clear the line
+                print("Retrieving page {}".format(current_page))
+                sys.stdout.write('\x1b[1A')  # Move cursor up 2 lines
+
+    def get_figures(self, html=None, _url=None, prototype_url=None):
+
+        if (html is not None or self.snapshots is not None) and len(self._figures) < 1 and _url is not None:
+            # Only parse if html is given and the figures array is empty
+            self._figures.extend(self.iter_figures(html, _url, prototype_url))
+
+        return self._figures
+
+    def needs_details(self, _figure):
+        # Long names are cut short with "..." on the listing.
+        return _figure._extended_name is None and "..." in _figure.name
+
+    def identity(self, _figure):
+        # Copies of a figure in different conditions are listed under the same name, each with an id of its own.
+        listing_id = re.search(r'[?&]id=(\d+)', _figure.link or "")
+        return _figure._name + "#" + listing_id.group(1) if listing_id is not None else _figure._name
+
+    def get_extended_name(self, _figure, override=False):
+        result = re.search(re.escape(r"..."), _figure.name)
+        if result is not None:
+            # The entire name is not given on this page. We need  the item page to get it.
+            self._log.debug("need to get extended name for " + _figure.name)
+            # TODO: Do not rely on outside function
+            item_html = Decoding.scrapeSite(_figure.link)
+            if item_html is not None:
+                try:
+                    item_soup = BeautifulSoup(item_html, 'html.parser')
+                    # TODO: Consider returning the extended name and setting it in the figure so extended_name is read only
+                    _figure.extended_name = item_soup.find(class_="contentstitle").text
+                    self._log.debug("new Name: " + _figure.extended_name)
+                except:
+                    self._log.error("Unable to retrieve item detail page. Using truncated name.", exc_info=True)
+
+            else:
+                self._log.error("Unable to retrieve item detail page. Using truncated name.", exc_info=True)
@@ -0,0 +1,264 @@
+import os
+import logging
+import threading
+import time as time_p
+from contextlib import contextmanager
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        @param name: The metric name as exported
+        @type name: str
+        @param documentation: The HELP text
+        @type documentation: str
+        @param labels: Names of the labels every sample must carry
+        @type labels: tuple[str]
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError("{} expects labels {}, got {}".format(self.name, self.label_names, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + "}"
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.kind)]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return ["{}{} {}".format(self.name, self._format_labels(key), _number(value))
+                    for key, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def remove(self, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values.pop(key, None)
+
+    def samples(self):
+        with self._lock:
+            return ["{}{} {}".format(self.name, self._format_labels(key), _number(value))
+                    for key, value in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+    default_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, name, documentation, labels=(), buckets=default_buckets):
+        """
+        @param buckets: Upper bounds of the buckets, in increasing order. +Inf is added automatically.
+        @type buckets: tuple[float]
+        """
+        _Metric.__init__(self, name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, observations = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value, observations + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the seconds spent inside the with block.
+        """
+        start = time_p.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time_p.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), (None, 0.0, 0))[2]
+
+    def sum(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), (None, 0.0, 0))[1]
+
+    def samples(self):
+        lines = []
+        with self._lock:
+            for key, (counts, total, observations) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append("{}_bucket{} {}".format(self.name, self._format_labels(key, [('le', _number(bound))]),
+                                                         count))
+                lines.append("{}_bucket{} {}".format(self.name, self._format_labels(key, [('le', '+Inf')]),
+                                                     observations))
+                lines.append("{}_sum{} {}".format(self.name, self._format_labels(key), _number(total)))
+                lines.append("{}_count{} {}".format(self.name, self._format_labels(key), observations))
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        """
+        Holds every metric of the process and renders them in the Prometheus text format.
+        """
+        self._log = logging.getLogger(self.__class__.__name__)
+        self._metrics = {}  # type: dict[str, _Metric]
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.label_names != metric.label_names:
+                    raise ValueError("{} is already registered differently".format(metric.name))
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labels=()):
+        """
+        @rtype: Counter
+        """
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        """
+        @rtype: Gauge
+        """
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=Histogram.default_buckets):
+        """
+        @rtype: Histogram
+        """
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def get(self, name):
+        """
+        @rtype: _Metric | None
+        """
+        with self._lock:
+            return self._metrics.get(name)
+
+    def render(self):
+        """
+        @return: Every metric in the Prometheus text exposition format
+        @rtype: str
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+    def write(self, uri):
+        """
+        Writes the metrics to a file, e.g. for the node exporter's textfile collector. The file is replaced
+        atomically so readers never see a partial write.
+        @param uri: Path of the file
+        @type uri: str
+        """
+        tmp_uri = uri + ".tmp"
+        with open(tmp_uri, 'w', encoding='UTF-8') as handle:
+            handle.write(self.render())
+        os.replace(tmp_uri, uri)
+
+
+class MetricsServer:
+
+    def __init__(self, registry, port=9108, host='127.0.0.1'):
+        """
+        Serves the metrics of a registry at http://host:port/metrics from a background thread.
+        @type registry: Registry
+        @type port: int
+        @type host: str
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # Only needed when serving
+
+        self._log = logging.getLogger(self.__class__.__name__)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('UTF-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="MetricsServer", daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        self._log.info("Serving metrics on port {}".format(self.port))
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, float) and value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+registry = Registry()  # The registry used by the checker
@@ -0,0 +1,345 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time as time_p
+
+import Metrics
+
+notifications = Metrics.registry.counter('stockchecker_notifications_total',
+                                         'Notifications handled by the dispatcher.', ('destination', 'result'))
+notification_send_seconds = Metrics.registry.histogram('stockchecker_notification_send_seconds',
+                                                       'Seconds spent in a transport sending one notification.',
+                                                       ('destination',))
+notification_queue = Metrics.registry.gauge('stockchecker_notification_queue',
+                                            'Notifications accepted but not yet sent or dropped.')
+
+
+class Notification:
+
+    def __init__(self, title, message, destination="default", html=True, url=None, url_title=None, priority=0,
+                 group=None, group_title=None, alerts=None):
+        """
+        A message waiting to be sent.
+
+        @param title: Title of the message
+        @type title: str
+        @param message: Body of the message
+        @type message: str
+        @param destination: Name of the transport the message is sent through
+        @type destination: str
+        @param group: Messages with the same destination and group that arrive close together are coalesced into one.
+        None sends the message on its own.
+        @type group: str | None
+        @param group_title: Title used for a coalesced message. Defaults to title.
+        @type group_title: str | None
+        @param alerts: Keys of the alerts the message carries, handed to the dispatcher's on_sent once it was sent
+        @type alerts: list[str] | None
+        """
+        self.title = title
+        self.message = message
+        self.destination = destination
+        self.html = html
+        self.url = url
+        self.url_title = url_title
+        self.priority = priority
+        self.group = group
+        self.group_title = group_title if group_title is not None else title
+        self.alerts = list(alerts or [])  # type: list[str]
+        self.attempts = 0  # type: int
+
+
+class Transport:
+    """
+    Delivers notifications. send() raises if the notification could not be delivered, so that it is retried.
+    """
+
+    def send(self, notification):
+        raise NotImplementedError
+
+
+class PushoverTransport(Transport):
+
+    def __init__(self, user):
+        """
+        @param user: The pushover user to send to
+        @type user: chump.User
+        """
+        self._user = user
+
+    def send(self, notification):
+        """
+        @type notification: Notification
+        """
+        message = self._user.send_message(title=notification.title,
+                                          message=notification.message,
+                                          html=notification.html,
+                                          url=notification.url,
+                                          url_title=notification.url_title,
+                                          priority=notification.priority)
+        if hasattr(message, 'is_sent') and not message.is_sent:
+            raise IOError("Pushover did not accept the message")
+        return message
+
+
+class StubTransport(Transport):
+
+    def __init__(self, failures=0, delay=0.0):
+        """
+        A local transport that keeps every notification it is given, for tests and dry runs.
+        @param failures: Number of sends that fail before messages are accepted
+        @type failures: int
+        @param delay: Seconds each send takes
+        @type delay: float
+        """
+        self.sent = []  # type: list[Notification]
+        self.failures = failures
+        self.delay = delay
+
+    def send(self, notification):
+        if self.delay:
+            time_p.sleep(self.delay)
+        if self.failures > 0:
+            self.failures -= 1
+            raise IOError("Stub failure")
+        self.sent.append(notification)
+
+
+class RateLimit:
+
+    def __init__(self, rate=0.5, burst=5):
+        """
+        A token bucket.
+        @param rate: Messages per second allowed on average
+        @type rate: float
+        @param burst: Messages that may be sent back to back
+        @type burst: int
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time_p.monotonic()
+
+    def acquire(self, now):
+        """
+        Takes a token if one is available.
+        @param now: time.monotonic() value
+        @type now: float
+        @return: 0 if a token was taken, otherwise the seconds until one is available
+        @rtype: float
+        """
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+
+class NotificationDispatcher:
+
+    max_message_length = 1024  # Pushover rejects longer messages
+
+    def __init__(self, transports, rate_limits=None, coalesce_window=5.0, max_retries=5, backoff=2.0, on_sent=None):
+        """
+        Sends notifications from a background thread, so a slow push API never holds up a scrape cycle.
+
+        @param transports: Destination name to the transport that delivers to it
+        @type transports: dict[str, Transport]
+        @param rate_limits: Destination name to its RateLimit. Destinations without one get the default RateLimit.
+        @type rate_limits: dict[str, RateLimit]
+        @param coalesce_window: Seconds grouped notifications are held to be combined with ones that follow
+        @type coalesce_window: float
+        @param max_retries: Attempts after the first before a notification is dropped
+        @type max_retries: int
+        @param backoff: Seconds before the first retry. Doubles with each further retry.
+        @type backoff: float
+        @param on_sent: Called from the dispatcher thread with every notification that was delivered, e.g.
+                        AlertDedup.sent. Not called for notifications that were dropped.
+        @type on_sent: (Notification) -> None
+        """
+        self._log = logging.getLogger(self.__class__.__name__)
+        self._transports = transports
+        self._rate_limits = dict(rate_limits or {})
+        self._coalesce_window = coalesce_window
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self.on_sent = on_sent
+
+        self._queue = queue.Queue()
+        self._ready = []  # heap of (monotonic time it may be sent, sequence, Notification)
+        self._groups = {}  # (destination, group) to (monotonic time of the first arrival, [Notification])
+        self._counter = itertools.count()
+        self._idle = threading.Condition()
+        self._busy = 0  # Notifications accepted but not yet sent or dropped
+        self._thread = None  # type: threading.Thread
+        self._stopping = False
+        self.sent = 0  # type: int
+        self.dropped = 0  # type: int
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="NotificationDispatcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def enqueue(self, notification):
+        """
+        Queues a notification without waiting for it to be sent.
+        @type notification: Notification
+        """
+        if notification.destination not in self._transports:
+            self._log.error("No transport for destination {}. Dropping {}".format(notification.destination,
+                                                                                   notification.title))
+            return
+        with self._idle:
+            self._busy += 1
+            notification_queue.set(self._busy)
+        self._queue.put(notification)
+
+    def flush(self, timeout=None):
+        """
+        Blocks until every queued notification has been sent or dropped, ignoring the coalescing delay.
+        @param timeout: Seconds to wait at most
+        @type timeout: float | None
+        @return: True if everything was sent or dropped
+        @rtype: bool
+        """
+        self._queue.put(_FLUSH)
+        with self._idle:
+            return self._idle.wait_for(lambda: self._busy == 0, timeout=timeout)
+
+    def close(self, timeout=None):
+        """
+        Sends what is still queued and stops the background thread.
+        """
+        self.flush(timeout)
+        self._stopping = True
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _rate_limit(self, destination):
+        rate_limit = self._rate_limits.get(destination)
+        if rate_limit is None:
+            rate_limit = self._rate_limits[destination] = RateLimit()
+        return rate_limit
+
+    def _next_wakeup(self, now):
+        wakeups = [first + self._coalesce_window for first, notifications in self._groups.values()]
+        if self._ready:
+            wakeups.append(self._ready[0][0])
+        if not wakeups:
+            return None
+        return max(0, min(wakeups) - now)
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                item = self._queue.get(timeout=self._next_wakeup(time_p.monotonic()))
+            except queue.Empty:
+                item = None
+            now = time_p.monotonic()
+            if item is _FLUSH:
+                self._release_groups(now, force=True)
+            elif item is not None:
+                self._accept(item, now)
+            self._release_groups(now)
+            self._send_ready(time_p.monotonic())
+
+    def _accept(self, notification, now):
+        if notification.group is None:
+            heapq.heappush(self._ready, (now, next(self._counter), notification))
+            return
+        key = (notification.destination, notification.group)
+        if key not in self._groups:
+            self._groups[key] = (now, [])
+        self._groups[key][1].append(notification)
+
+    def _release_groups(self, now, force=False):
+        for key in list(self._groups):
+            first, notifications = self._groups[key]
+            if force or now - first >= self._coalesce_window:
+                del self._groups[key]
+                for notification in self._coalesce(notifications):
+                    heapq.heappush(self._ready, (now, next(self._counter), notification))
+
+    def _coalesce(self, notifications):
+        """
+        Combines grouped notifications into as few messages as fit the length limit.
+        @type notifications: list[Notification]
+        @rtype: list[Notification]
+        """
+        if len(notifications) == 1:
+            return notifications
+        first = notifications[0]
+        combined = []
+        body = ""
+        alerts = []
+        for notification in notifications:
+            line = notification.message + "\n"
+            if body and len(body) + len(line) > self.max_message_length:
+                combined.append((body, alerts))
+                body = ""
+                alerts = []
+            body += line
+            alerts.extend(notification.alerts)
+        if body:
+            combined.append((body, alerts))
+
+        messages = []
+        for body, alerts in combined:
+            messages.append(Notification(first.group_title, body, destination=first.destination, html=first.html,
+                                         url=first.url, url_title=first.url_title,
+                                         priority=max(notification.priority for notification in notifications),
+                                         alerts=alerts))
+        # The originals are replaced by the combined messages.
+        self._done(len(notifications) - len(messages))
+        return messages
+
+    def _send_ready(self, now):
+        deferred = []
+        while self._ready and self._ready[0][0] <= now:
+            ready_at, sequence, notification = heapq.heappop(self._ready)
+            wait = self._rate_limit(notification.destination).acquire(now)
+            if wait > 0:
+                deferred.append((now + wait, sequence, notification))
+                continue
+            try:
+                with notification_send_seconds.time(destination=notification.destination):
+                    self._transports[notification.destination].send(notification)
+            except Exception:
+                notification.attempts += 1
+                if notification.attempts > self._max_retries:
+                    notifications.inc(destination=notification.destination, result="dropped")
+                    self._log.error("Giving up on {} after {} attempts".format(notification.title,
+                                                                              notification.attempts), exc_info=True)
+                    self.dropped += 1
+                    self._done(1)
+                else:
+                    notifications.inc(destination=notification.destination, result="retried")
+                    delay = self._backoff * 2 ** (notification.attempts - 1)
+                    self._log.warning("Sending {} failed. Retrying in {} seconds".format(notification.title, delay))
+                    deferred.append((now + delay, sequence, notification))
+                continue
+            self.sent += 1
+            notifications.inc(destination=notification.destination, result="sent")
+            if self.on_sent is not None:
+                try:
+                    self.on_sent(notification)
+                except Exception:
+                    self._log.error("on_sent failed for {}".format(notification.title), exc_info=True)
+            self._done(1)
+        for item in deferred:
+            heapq.heappush(self._ready, item)
+
+    def _done(self, count):
+        with self._idle:
+            self._busy -= count
+            notification_queue.set(self._busy)
+            if self._busy == 0:
+                self._idle.notify_all()
+
+
+_FLUSH = object()  # Queue marker that releases every held group
@@ -0,0 +1,268 @@
+import os
+import re
+import json
+import logging
+import threading
+import time as time_p
+
+
+class ObservationLog:
+    """
+    An append-only log of what every scrape of every sub-site saw.
+
+    Observations are written as JSON lines into numbered segment files. Once a segment is full it is closed and a
+    background thread folds it, together with the previous snapshot, into a snapshot holding the latest observation of
+    every sub-site. Any past state can then be rebuilt by loading the newest snapshot before that point and replaying
+    at most one segment, without reading the whole history into memory.
+    """
+
+    segment_pattern = re.compile(r'^segment-(\d{8})\.jsonl$')
+    snapshot_pattern = re.compile(r'^snapshot-(\d{8})\.json$')
+
+    def __init__(self, directory="observations", max_segment_bytes=4 * 1024 * 1024, keep_segments=50,
+                 background=True):
+        """
+        @param directory: Where segments and snapshots are stored. Created if missing.
+        @type directory: str
+        @param max_segment_bytes: Size after which the current segment is closed and a new one started
+        @type max_segment_bytes: int
+        @param keep_segments: Number of compacted segments kept for replay. Older segments and their snapshots are
+        deleted, the newest snapshot is always kept.
+        @type keep_segments: int
+        @param background: Compact closed segments in a background thread instead of on the calling thread.
+        @type background: bool
+        """
+        self._log = logging.getLogger(self.__class__.__name__)
+        self._directory = directory
+        self._max_segment_bytes = max_segment_bytes
+        self._keep_segments = keep_segments
+        self._background = background
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._compactor = None  # type: threading.Thread
+
+        os.makedirs(self._directory, exist_ok=True)
+        segments = self.segments()
+        self._segment = segments[-1] if segments else 1
+        self._handle = open(self._segment_path(self._segment), 'a', encoding='UTF-8')
+        self._cycle = 0
+
+    def _segment_path(self, number):
+        return os.path.join(self._directory, "segment-{:08d}.jsonl".format(number))
+
+    def _snapshot_path(self, number):
+        return os.path.join(self._directory, "snapshot-{:08d}.json".format(number))
+
+    def _numbers(self, pattern):
+        numbers = []
+        for file_name in os.listdir(self._directory):
+            match = pattern.match(file_name)
+            if match is not None:
+                numbers.append(int(match.group(1)))
+        return sorted(numbers)
+
+    def segments(self):
+        """
+        @return: The numbers of all segments on disk, oldest first
+        @rtype: list[int]
+        """
+        return self._numbers(self.segment_pattern)
+
+    def snapshots(self):
+        """
+        @return: The numbers of all snapshots on disk, oldest first. Snapshot n holds the state at the end of segment n.
+        @rtype: list[int]
+        """
+        return self._numbers(self.snapshot_pattern)
+
+    def next_cycle(self):
+        """
+        Marks the start of a new scrape cycle. Observations appended afterwards carry the new cycle number.
+        @return: The cycle number
+        @rtype: int
+        """
+        with self._lock:
+            self._cycle += 1
+            return self._cycle
+
+    def append(self, sub_site, items, timings=None, error=None, ts=None):
+        """
+        Appends the observation of one sub-site scrape.
+
+        @param sub_site: The key of the sub-site
+        @type sub_site: str
+        @param items: One [figure key, price, condition] entry per figure seen
+        @type items: list[list]
+        @param timings: Stage name to seconds spent, e.g. fetch and parse
+        @type timings: dict[str, float]
+        @param error: Description of why the scrape failed, if it did
+        @type error: str | None
+        @param ts: Unix time of the observation. Defaults to now.
+        @type ts: float | None
+        """
+        record = {'ts': ts if ts is not None else time_p.time(),
+                  'cycle': self._cycle,
+                  'sub_site': sub_site,
+                  'items': items,
+                  'timings': timings or {}}
+        if error is not None:
+            record['error'] = error
+        line = json.dumps(record, separators=(',', ':'), ensure_ascii=False) + "\n"
+
+        with self._lock:
+            self._handle.write(line)
+            self._handle.flush()
+            rotate = self._handle.tell() >= self._max_segment_bytes
+            if rotate:
+                self._handle.close()
+                self._segment += 1
+                self._handle = open(self._segment_path(self._segment), 'a', encoding='UTF-8')
+                self._log.info("Started observation segment {}".format(self._segment))
+        if rotate:
+            self._start_compaction()
+
+    def _start_compaction(self):
+        if self._background:
+            if self._compactor is None or not self._compactor.is_alive():
+                self._compactor = threading.Thread(target=self.compact, name="ObservationLogCompactor", daemon=True)
+                self._compactor.start()
+        else:
+            self.compact()
+
+    def compact(self):
+        """
+        Folds every closed segment that has no snapshot yet into one, then applies the retention limit.
+        """
+        with self._compact_lock:
+            with self._lock:
+                current = self._segment
+            snapshots = set(self.snapshots())
+            for number in self.segments():
+                if number >= current or number in snapshots:
+                    continue
+                state = self._load_snapshot(number - 1) if (number - 1) in snapshots else self._rebuild(number - 1)
+                for record in self._read_segment(number):
+                    self._fold(state, record)
+                self._write_snapshot(number, state)
+                snapshots.add(number)
+                self._log.info("Compacted observation segment {}".format(number))
+            self._apply_retention(current)
+
+    def _apply_retention(self, current):
+        closed = [number for number in self.segments() if number < current]
+        for number in closed[:max(0, len(closed) - self._keep_segments)]:
+            os.remove(self._segment_path(number))
+        snapshots = self.snapshots()
+        oldest_segment = min(self.segments() or [current])
+        for number in snapshots[:-1]:
+            # A snapshot is only needed as the starting point of a segment that is still kept.
+            if number < oldest_segment - 1:
+                os.remove(self._snapshot_path(number))
+
+    @staticmethod
+    def _fold(state, record):
+        if 'error' in record:
+            # A failed scrape says nothing about what is listed.
+            return
+        state['ts'] = record['ts']
+        state['sub_sites'][record['sub_site']] = record
+
+    def _write_snapshot(self, number, state):
+        path = self._snapshot_path(number)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='UTF-8') as handle:
+            json.dump(state, handle, separators=(',', ':'), ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _load_snapshot(self, number):
+        with open(self._snapshot_path(number), 'r', encoding='UTF-8') as handle:
+            return json.load(handle)
+
+    def _rebuild(self, number):
+        """
+        Builds the state at the end of segment number from the newest snapshot before it.
+        """
+        state = {'ts': None, 'sub_sites': {}}
+        if number < 1:
+            return state
+        earlier = [snapshot for snapshot in self.snapshots() if snapshot <= number]
+        start = 1
+        if earlier:
+            state = self._load_snapshot(earlier[-1])
+            start = earlier[-1] + 1
+        for segment in self.segments():
+            if start <= segment <= number:
+                for record in self._read_segment(segment):
+                    self._fold(state, record)
+        return state
+
+    def _read_segment(self, number):
+        try:
+            handle = open(self._segment_path(number), 'r', encoding='UTF-8')
+        except FileNotFoundError:
+            return
+        with handle:
+            for line in handle:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # The tail of a segment can be cut short by a crash.
+                    self._log.warning("Skipping a damaged observation in segment {}".format(number))
+
+    def replay(self, since=None, until=None, sub_site=None):
+        """
+        Streams observations in the order they were written.
+
+        @param since: Only observations at or after this Unix time
+        @type since: float | None
+        @param until: Only observations at or before this Unix time
+        @type until: float | None
+        @param sub_site: Only observations of this sub-site key
+        @type sub_site: str | None
+        @rtype: collections.Iterable[dict]
+        """
+        with self._lock:
+            self._handle.flush()
+        for number in self.segments():
+            for record in self._read_segment(number):
+                if since is not None and record['ts'] < since:
+                    continue
+                if until is not None and record['ts'] > until:
+                    return
+                if sub_site is not None and record['sub_site'] != sub_site:
+                    continue
+                yield record
+
+    def snapshot_at(self, ts=None):
+        """
+        Rebuilds the latest successful observation of every sub-site as of a point in time.
+
+        @param ts: Unix time to rebuild the state at. Defaults to now.
+        @type ts: float | None
+        @return: Sub-site key to observation record
+        @rtype: dict[str, dict]
+        """
+        with self._lock:
+            self._handle.flush()
+        state = {'ts': None, 'sub_sites': {}}
+        start = 1
+        for number in reversed(self.snapshots()):
+            snapshot = self._load_snapshot(number)
+            if ts is None or (snapshot['ts'] is not None and snapshot['ts'] <= ts):
+                state = snapshot
+                start = number + 1
+                break
+        for number in self.segments():
+            if number < start:
+                continue
+            for record in self._read_segment(number):
+                if ts is not None and record['ts'] > ts:
+                    return state['sub_sites']
+                self._fold(state, record)
+        return state['sub_sites']
+
+    def close(self):
+        with self._lock:
+            self._handle.close()
+        if self._compactor is not None:
+            self._compactor.join()
@@ -0,0 +1,152 @@
+import sys
+import logging
+import threading
+import cProfile
+import tracemalloc
+from collections import Counter
+
+
+class SamplingProfiler:
+
+    def __init__(self, interval=0.005):
+        """
+        Samples the stacks of every thread at a fixed interval. Overhead stays low as nothing is traced between
+        samples, and the crawl threads of the cycle executor are covered as well as the main thread.
+
+        @param interval: Seconds between samples
+        @type interval: float
+        """
+        self._interval = interval
+        self._stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None  # type: threading.Thread
+
+    def start(self):
+        self._stacks.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="SamplingProfiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self._interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{}:{}".format(code.co_filename.rsplit('/', 1)[-1], code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self._stacks[";".join(reversed(stack))] += 1
+
+    def write_folded(self, uri):
+        """
+        Writes the samples in the folded stack format read by flamegraph.pl, speedscope and inferno.
+        @param uri: Path of the output file
+        @type uri: str
+        """
+        with open(uri, 'w', encoding='UTF-8') as handle:
+            for stack, count in self._stacks.most_common():
+                handle.write("{} {}\n".format(stack, count))
+
+
+class CycleProfiler:
+
+    def __init__(self, cycles, base_uri="StockChecker", mode="sample", interval=0.005, top=25):
+        """
+        Profiles the first few scrape cycles and writes the results next to the log.
+        Every profiled cycle produces <base_uri>.profile-<cycle>.folded (or .pstats when mode is "cprofile") and
+        <base_uri>.profile-<cycle>.tracemalloc.txt with the top allocation sites.
+
+        @param cycles: Number of cycles to profile
+        @type cycles: int
+        @param base_uri: Path prefix of the output files
+        @type base_uri: str
+        @param mode: "sample" for the sampling profiler, "cprofile" for cProfile of the calling thread
+        @type mode: str
+        @param interval: Seconds between samples in sample mode
+        @type interval: float
+        @param top: Number of allocation sites to report
+        @type top: int
+        """
+        if mode not in ("sample", "cprofile"):
+            raise ValueError("Unknown profile mode " + mode)
+        self._log = logging.getLogger(self.__class__.__name__)
+        self._remaining = cycles
+        self._base_uri = base_uri
+        self._mode = mode
+        self._interval = interval
+        self._top = top
+        self._profiler = None
+        self._cycle = None
+
+    @property
+    def active(self):
+        """
+        @return: True while there are cycles left to profile
+        @rtype: bool
+        """
+        return self._remaining > 0
+
+    def start_cycle(self, cycle):
+        """
+        @param cycle: Number of the cycle that is about to run
+        @type cycle: int
+        """
+        if not self.active:
+            return
+        self._cycle = cycle
+        tracemalloc.start(10)
+        if self._mode == "sample":
+            self._profiler = SamplingProfiler(self._interval)
+            self._profiler.start()
+        else:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def end_cycle(self):
+        """
+        Stops profiling the current cycle and writes its results.
+        @return: The paths that were written
+        @rtype: list[str]
+        """
+        if self._profiler is None:
+            return []
+        base = "{}.profile-{}".format(self._base_uri, self._cycle)
+        written = []
+        if self._mode == "sample":
+            self._profiler.stop()
+            self._profiler.write_folded(base + ".folded")
+            written.append(base + ".folded")
+        else:
+            self._profiler.disable()
+            self._profiler.dump_stats(base + ".pstats")
+            written.append(base + ".pstats")
+
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                           tracemalloc.Filter(False, "<frozen importlib._bootstrap>")))
+        with open(base + ".tracemalloc.txt", 'w', encoding='UTF-8') as handle:
+            handle.write("Cycle {}: {:.1f} KiB traced at the end, {:.1f} KiB peak\n\n".format(
+                self._cycle, current / 1024, peak / 1024))
+            for statistic in snapshot.statistics('traceback')[:self._top]:
+                handle.write("{:.1f} KiB in {} blocks\n".format(statistic.size / 1024, statistic.count))
+                for line in statistic.traceback.format(limit=5):
+                    handle.write(line + "\n")
+                handle.write("\n")
+        written.append(base + ".tracemalloc.txt")
+
+        self._log.info("Profile of cycle {} written to {}".format(self._cycle, ", ".join(written)))
+        self._profiler = None
+        self._remaining -= 1
+        return written
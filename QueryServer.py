@@ -0,0 +1,280 @@
+import os
+import re
+import json
+import bisect
+import logging
+import threading
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+
+
+def words_of(text):
+    """
+    @return: The lower case words of a text, as they are indexed and searched
+    @rtype: list[str]
+    """
+    return re.findall(r'\w+', text.lower()) if text else []
+
+
+class _SubSiteListings:
+
+    def __init__(self, rows):
+        """
+        The listings of one sub-site with an inverted index over the words of their names. Never changed once built:
+        a new scrape builds a new one, so readers never see a listing half way through an update.
+
+        @param rows: One dict per listing. 'name' is the text that is indexed.
+        @type rows: list[dict]
+        """
+        self.rows = rows
+        self.updated = datetime.now().timestamp()
+        self.postings = {}  # type: dict[str, set[int]]  # word to the rows whose name has it
+        for position, row in enumerate(rows):
+            for word in words_of(row.get('name')):
+                self.postings.setdefault(word, set()).add(position)
+        self.vocabulary = sorted(self.postings)  # type: list[str]  # For prefix searches
+
+    def matching(self, term):
+        """
+        @param term: A word, or the start of one followed by *
+        @type term: str
+        @return: The rows whose name has the word
+        @rtype: set[int]
+        """
+        if not term.endswith('*'):
+            return self.postings.get(term, set())
+        prefix = term[:-1]
+        found = set()
+        for index in range(bisect.bisect_left(self.vocabulary, prefix), len(self.vocabulary)):
+            if not self.vocabulary[index].startswith(prefix):
+                break
+            found |= self.postings[self.vocabulary[index]]
+        return found
+
+
+class StockIndex:
+
+    def __init__(self):
+        """
+        The latest listings of every sub-site, searchable by the words of their names. Sub-sites are replaced whole
+        after each scrape and queries read whatever snapshot is current, so queries never wait for a scrape.
+        """
+        self._lock = threading.Lock()
+        self._sub_sites = {}  # type: dict[str, _SubSiteListings]
+
+    def update(self, sub_site_key, rows):
+        """
+        Replaces the listings of a sub-site.
+        @type sub_site_key: str
+        @param rows: One dict per listing, holding at least 'name', 'site', 'condition', 'price_value', 'currency'
+                     and 'first_seen'
+        @type rows: list[dict]
+        """
+        listings = _SubSiteListings(rows)
+        with self._lock:
+            self._sub_sites[sub_site_key] = listings
+
+    def remove(self, sub_site_key):
+        with self._lock:
+            self._sub_sites.pop(sub_site_key, None)
+
+    def sub_sites(self):
+        """
+        @return: Per sub-site, its key, how many listings it has and when they were last updated
+        @rtype: list[dict]
+        """
+        with self._lock:
+            snapshot = dict(self._sub_sites)
+        return [{'sub_site': key, 'listings': len(listings.rows), 'updated': listings.updated}
+                for key, listings in sorted(snapshot.items())]
+
+    def search(self, text=None, site=None, sub_site=None, conditions=None, min_price=None, max_price=None,
+               since=None, limit=100):
+        """
+        Finds listings. Every given filter has to match.
+
+        @param text: Words that must all be in the name. A word ending in * matches every word starting with it.
+        @type text: str | None
+        @param site: Website name, e.g. Jungle. Case is ignored.
+        @type site: str | None
+        @param sub_site: Sub-site key
+        @type sub_site: str | None
+        @param conditions: Conditions accepted, e.g. ['Sealed', 'A']. Case is ignored.
+        @type conditions: list[str] | None
+        @param min_price: Lowest price, as (smallest unit of the currency, currency)
+        @type min_price: (int, str) | None
+        @param max_price: Highest price, as (smallest unit of the currency, currency)
+        @type max_price: (int, str) | None
+        @param since: Only listings first seen at or after this unix time
+        @type since: float | None
+        @param limit: Most listings returned. None returns all of them.
+        @type limit: int | None
+        @return: The number of listings found and the first limit of them, newest first
+        @rtype: (int, list[dict])
+        """
+        terms = re.findall(r'\w+\*?', text.lower()) if text else []
+        conditions = set(condition.lower() for condition in conditions) if conditions else None
+        with self._lock:
+            snapshot = dict(self._sub_sites)
+
+        found = []
+        for key, listings in snapshot.items():
+            if sub_site is not None and key != sub_site:
+                continue
+            if terms:
+                positions = None
+                for term in terms:
+                    matching = listings.matching(term)
+                    positions = matching if positions is None else positions & matching
+                    if not positions:
+                        break
+                rows = [listings.rows[position] for position in sorted(positions)]
+            else:
+                rows = listings.rows
+            for row in rows:
+                if site is not None and (row.get('site') or '').lower() != site.lower():
+                    continue
+                if conditions is not None and (row.get('condition') or '').lower() not in conditions:
+                    continue
+                if since is not None and (row.get('first_seen') or 0) < since:
+                    continue
+                if not _in_range(row, min_price, max_price):
+                    continue
+                found.append(row)
+        found.sort(key=lambda row: row.get('first_seen') or 0, reverse=True)
+        return len(found), found if limit is None else found[:limit]
+
+
+def _in_range(row, min_price, max_price):
+    for bound, fits in ((min_price, lambda value, limit: value >= limit),
+                        (max_price, lambda value, limit: value <= limit)):
+        if bound is None:
+            continue
+        value, currency = bound
+        if row.get('price_value') is None or (currency is not None and row.get('currency') != currency):
+            return False  # Prices in another currency, or without one, can not be compared
+        if not fits(row['price_value'], value):
+            return False
+    return True
+
+
+def parse_since(text):
+    """
+    @param text: A unix time, or a date and time in ISO 8601 such as 2016-05-01T18:00
+    @type text: str
+    @rtype: float
+    """
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+
+class QueryServer:
+
+    def __init__(self, index, port=None, host='127.0.0.1', socket_path=None, parse_price=None):
+        """
+        Answers read-only queries about the current stock from background threads, over http://host:port and/or a
+        Unix socket. Queries are served from the index only, so they never cause a shop to be scraped.
+
+            GET /listings?q=nendoroid+izayoi&site=Jungle&condition=sealed&max_price=4000&since=2016-05-01
+            GET /sub_sites
+
+        @param index: The snapshot that is queried
+        @type index: StockIndex
+        @param port: TCP port to listen on. None listens on no port.
+        @type port: int | None
+        @type host: str
+        @param socket_path: Unix socket to listen on. None listens on no socket.
+        @type socket_path: str | None
+        @param parse_price: Reads the min_price and max_price parameters into (smallest unit, currency). None takes
+                            them as plain numbers in the smallest unit of any currency.
+        @type parse_price: (str) -> (int | None, str | None)
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # Only needed when serving
+        import socketserver
+
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.socket_path = socket_path
+        def price_parameter(parameters, name):
+            if name not in parameters:
+                return None
+            if parse_price is None:
+                return int(parameters[name][-1]), None
+            value, currency = parse_price(parameters[name][-1])
+            if value is None:
+                raise ValueError("{} is not a price".format(name))
+            return value, currency
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                request = urlparse(self.path)
+                parameters = parse_qs(request.query)
+                try:
+                    if request.path == '/listings':
+                        limit = int(parameters.get('limit', ['100'])[-1])
+                        count, rows = index.search(
+                            text=parameters.get('q', [None])[-1],
+                            site=parameters.get('site', [None])[-1],
+                            sub_site=parameters.get('sub_site', [None])[-1],
+                            conditions=parameters.get('condition'),
+                            min_price=price_parameter(parameters, 'min_price'),
+                            max_price=price_parameter(parameters, 'max_price'),
+                            since=parse_since(parameters['since'][-1]) if 'since' in parameters else None,
+                            limit=limit if limit > 0 else None)
+                        self._send(200, {'count': count, 'listings': rows})
+                    elif request.path == '/sub_sites':
+                        self._send(200, {'sub_sites': index.sub_sites()})
+                    else:
+                        self._send(404, {'error': "Unknown path " + request.path})
+                except ValueError as error:
+                    self._send(400, {'error': str(error)})
+
+            def _send(self, status, content):
+                body = json.dumps(content, default=str).encode('UTF-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def address_string(self):
+                # Clients of the Unix socket have no address.
+                return self.client_address[0] if self.client_address else self.server.server_address
+
+            def log_message(self, format, *args):
+                pass
+
+        class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        self._servers = []
+        if port is not None:
+            self._servers.append(ThreadingHTTPServer((host, port), Handler))
+            self._servers[-1].daemon_threads = True
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)  # Left behind by a run that did not stop cleanly
+            self._servers.append(ThreadingUnixServer(socket_path, Handler))
+        self._threads = [threading.Thread(target=server.serve_forever, name="QueryServer", daemon=True)
+                         for server in self._servers]
+
+    @property
+    def port(self):
+        for server in self._servers:
+            if isinstance(server.server_address, tuple):
+                return server.server_address[1]
+        return None
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        self._log.info("Serving queries on port {} and socket {}".format(self.port, self.socket_path))
+        return self
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
@@ -0,0 +1,271 @@
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time as time_p
+from datetime import datetime
+
+
+class HashRing:
+
+    def __init__(self, nodes, replicas=64):
+        """
+        Consistent hashing over sub-site keys. Every node owns many small arcs of the ring, so keys spread evenly and
+        adding or removing a node only moves the keys of that node.
+
+        @param nodes: Names of the nodes, e.g. the shard numbers
+        @type nodes: list
+        @param replicas: Points each node has on the ring
+        @type replicas: int
+        """
+        self.replicas = replicas
+        self._points = []  # type: list[int]
+        self._nodes = {}  # point on the ring to the node that owns it
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(str(value).encode('UTF-8')).digest()[:8], 'big')
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = self._hash("{}#{}".format(node, replica))
+            if point not in self._nodes:
+                bisect.insort(self._points, point)
+            self._nodes[point] = node
+
+    def remove(self, node):
+        for replica in range(self.replicas):
+            point = self._hash("{}#{}".format(node, replica))
+            if self._nodes.get(point) == node:
+                del self._nodes[point]
+                self._points.remove(point)
+
+    def node_for(self, key):
+        """
+        @param key: A sub-site key
+        @type key: str
+        @return: The node that owns the key
+        """
+        if not self._points:
+            raise LookupError("The ring has no nodes")
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._nodes[self._points[index]]
+
+
+class ForwardingDispatcher:
+
+    def __init__(self, outbox, on_sent=None):
+        """
+        Stands in for the NotificationDispatcher inside a worker, handing every notification to the coordinator.
+
+        @param outbox: Pipe end read by the coordinator
+        @type outbox: multiprocessing.connection.Connection
+        @param on_sent: Called with every notification handed to the coordinator. Each worker alone alerts on the
+                        sub-sites it owns, so its AlertDedup records them here, as the coordinator has no way to tell
+                        it what was delivered.
+        @type on_sent: (Notification) -> None
+        """
+        self._outbox = outbox
+        self.on_sent = on_sent
+
+    def enqueue(self, notification):
+        self._outbox.send(notification)
+        if self.on_sent is not None:
+            self.on_sent(notification)
+
+    def flush(self, timeout=None):
+        return True
+
+    def close(self, timeout=None):
+        pass
+
+
+def shard_uri(uri, shard):
+    """
+    @return: The path a shard uses for a file that can not be shared, e.g. StockChecker.prom -> StockChecker.shard-1.prom
+    @rtype: str
+    """
+    base, extension = os.path.splitext(uri)
+    return "{}.shard-{}{}".format(base, shard, extension)
+
+
+def run_worker(shard, shards, config_uri, keys, outbox, stopping):
+    """
+    Entry point of a worker process. Scrapes the sub-sites of one shard until stopping is set.
+
+    @param shard: Number of this worker's shard
+    @type shard: int
+    @param shards: Number of shards
+    @type shards: int
+    @param config_uri: Path of sources.xml
+    @type config_uri: str
+    @param keys: The loaded keys.yaml
+    @type keys: dict
+    @param outbox: Pipe end the alerts are sent to the coordinator through
+    @type outbox: multiprocessing.connection.Connection
+    @param stopping: Set by the coordinator to stop the worker
+    @type stopping: multiprocessing.Event
+    """
+    from StockChecker import StockChecker, load_user_watchlists
+    from StateStore import StateStore, AlertDedup
+    from ObservationLog import ObservationLog
+
+    log = logging.getLogger("Worker-{}".format(shard))
+    ring = HashRing(range(shards))
+    state_store = StateStore(keys.get("StateStore", "StockChecker.db"))
+    metrics_file = keys.get("MetricsFile", "StockChecker.prom")
+    checker = StockChecker(config_uri,
+                           dispatcher=ForwardingDispatcher(outbox),
+                           state_store=state_store,
+                           observation_log=ObservationLog(os.path.join(keys.get("ObservationLog", "observations"),
+                                                                       "shard-{}".format(shard))),
+                           alert_dedup=AlertDedup(state_store,
+                                                  window=keys.get("AlertSuppressionHours", 24) * 60 * 60),
+                           per_host=keys.get("ConnectionsPerHost", 1),
+                           metrics_file=shard_uri(metrics_file, shard) if metrics_file else None,
+                           owns=lambda key: ring.node_for(key) == shard,
+                           user_watchlists=load_user_watchlists(keys))
+    checker.start()
+    log.info("Worker {} of {} owns {}".format(shard, shards, ", ".join(
+        sub_site.key for site in checker.websites for sub_site in site.sub_sites or [])))
+    try:
+        while not stopping.is_set():
+            checker.run_once()
+            next_deadline = checker.scheduler.next_deadline()
+            wait = 10 if next_deadline is None else (next_deadline - datetime.now()).total_seconds()
+            stopping.wait(min(max(wait, 0), 10))
+    finally:
+        checker.close()
+        outbox.close()
+
+
+class ShardCoordinator:
+
+    def __init__(self, shards, keys, dispatcher, config_uri='sources.xml', restart_delay=30.0):
+        """
+        Runs the checker as several worker processes. Sub-sites are assigned to workers by consistent hashing over
+        their keys, and every worker keeps its scrape state in the shared state store. The coordinator owns the
+        notifier: alerts of all workers are merged into one dispatcher, so groups are coalesced across shards and the
+        push rate limit holds for the whole checker. A worker that dies is restarted and resumes its shard from the
+        store, while the other shards carry on.
+
+        @param shards: Number of worker processes
+        @type shards: int
+        @param keys: The loaded keys.yaml
+        @type keys: dict
+        @param dispatcher: Sends the alerts of every worker
+        @type dispatcher: NotificationDispatcher
+        @param config_uri: Path of sources.xml
+        @type config_uri: str
+        @param restart_delay: Seconds to wait before restarting a worker that died
+        @type restart_delay: float
+        """
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.shards = shards
+        self._keys = dict(keys)
+        self._keys.pop("MetricsPort", None)  # Workers can not share the port
+        self._dispatcher = dispatcher
+        self._config_uri = config_uri
+        self._restart_delay = restart_delay
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._workers = {}  # shard to its (multiprocessing.Process, multiprocessing.Event to stop it)
+        self._readers = {}  # pipe end receiving the alerts of a worker to its shard
+        self._died = {}  # shard to the monotonic time its worker was found dead
+        self._merger = None  # type: threading.Thread
+        self.restarts = 0  # type: int
+
+    def _spawn(self, shard):
+        # Every worker gets its own pipe and stop event, so a worker that is killed half way through using them can
+        # not block the others.
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        stopping = multiprocessing.Event()
+        worker = multiprocessing.Process(target=run_worker, name="StockChecker-shard-{}".format(shard),
+                                         args=(shard, self.shards, self._config_uri, self._keys, writer, stopping),
+                                         daemon=True)
+        worker.start()
+        writer.close()  # Only the worker writes. The reader sees EOF once the worker is gone.
+        with self._lock:
+            self._workers[shard] = (worker, stopping)
+            self._readers[reader] = shard
+        self._log.info("Started worker {} as pid {}".format(shard, worker.pid))
+
+    def _merge(self):
+        while True:
+            with self._lock:
+                readers = list(self._readers)
+            if not readers:
+                if self._stopping.is_set():
+                    return
+                time_p.sleep(1)
+                continue
+            for reader in multiprocessing.connection.wait(readers, timeout=1):
+                try:
+                    notification = reader.recv()
+                except (EOFError, OSError):
+                    with self._lock:
+                        del self._readers[reader]
+                    reader.close()
+                    continue
+                self._log.debug("Alert from worker {}: {}".format(self._readers.get(reader), notification.title))
+                self._dispatcher.enqueue(notification)
+
+    def start(self):
+        for shard in range(self.shards):
+            self._spawn(shard)
+        self._merger = threading.Thread(target=self._merge, name="ShardMerger", daemon=True)
+        self._merger.start()
+        return self
+
+    def check_workers(self):
+        """
+        Restarts workers that died, once they have been dead for restart_delay seconds.
+        @return: Shards whose worker is currently not running
+        @rtype: list[int]
+        """
+        now = time_p.monotonic()
+        down = []
+        for shard, (worker, stopping) in list(self._workers.items()):
+            if worker.is_alive():
+                continue
+            if shard not in self._died:
+                self._died[shard] = now
+                self._log.error("Worker {} exited with code {}. Restarting it in {} seconds."
+                                .format(shard, worker.exitcode, self._restart_delay))
+            if now - self._died[shard] >= self._restart_delay:
+                del self._died[shard]
+                self.restarts += 1
+                self._spawn(shard)
+            else:
+                down.append(shard)
+        return down
+
+    def run_forever(self, interval=5.0):
+        """
+        Supervises the workers until stop() is called.
+        """
+        if self._merger is None:
+            self.start()
+        while not self._stopping.wait(interval):
+            self.check_workers()
+
+    def stop(self, timeout=60):
+        """
+        Stops every worker and sends the alerts they left behind.
+        """
+        self._stopping.set()
+        for worker, stopping in self._workers.values():
+            if worker.is_alive():
+                stopping.set()
+        for worker, stopping in self._workers.values():
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+        if self._merger is not None:
+            self._merger.join(timeout)
+        self._dispatcher.flush(timeout)
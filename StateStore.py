@@ -0,0 +1,334 @@
+import sqlite3
+import logging
+import hashlib
+import threading
+import time as time_p
+
+
+class StateStore:
+    """
+    SQLite backed storage for the scrape state of every sub-site.
+
+    The database runs in WAL mode, so a crash in the middle of a cycle leaves the last committed snapshot intact, and
+    every save is a single transaction holding only the rows that changed since the previous save. Figures that were
+    only seen again have just their last_seen updated. Several processes may share one database as long as each writes
+    its own sub-sites.
+    """
+
+    # identity first, as rows are keyed by it, and last_seen last, as it is saved apart from the rest
+    figure_columns = ('identity', 'name', 'service', 'price', 'link', 'pic_link', 'condition', 'extended_name',
+                      'search_url', 'ttl', 'first_seen', 'last_seen')
+
+    def __init__(self, uri="StockChecker.db", timeout=30.0):
+        """
+        @param uri: Path of the database file. ":memory:" can be used for throwaway stores.
+        @type uri: str
+        @param timeout: Seconds to wait for another process to finish writing
+        @type timeout: float
+        """
+        self._log = logging.getLogger(self.__class__.__name__)
+        self._uri = uri
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(uri, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS figures (
+                                  sub_site TEXT NOT NULL,
+                                  identity TEXT NOT NULL,
+                                  name TEXT NOT NULL,
+                                  service TEXT,
+                                  price TEXT,
+                                  link TEXT,
+                                  pic_link TEXT,
+                                  condition TEXT,
+                                  extended_name TEXT,
+                                  search_url TEXT,
+                                  ttl INTEGER,
+                                  first_seen REAL,
+                                  last_seen REAL,
+                                  PRIMARY KEY (sub_site, identity)
+                              ) WITHOUT ROWID""")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS sub_sites (
+                                  sub_site TEXT PRIMARY KEY,
+                                  identity TEXT NOT NULL,
+                                  next_run REAL,
+                                  updated REAL
+                              )""")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS alerts (
+                                  alert TEXT PRIMARY KEY,
+                                  sent REAL NOT NULL
+                              ) WITHOUT ROWID""")
+        # The rows last written for each sub-site, so a save only touches what actually changed.
+        self._saved = {}  # type: dict[str, dict[str, tuple]]
+
+    @property
+    def uri(self):
+        return self._uri
+
+    def _row(self, record):
+        return tuple(record.get(column) for column in self.figure_columns)
+
+    def _saved_rows(self, sub_site):
+        """
+        @return: The rows currently stored for a sub-site keyed by figure identity, read from the database on first use.
+        @rtype: dict[str, tuple]
+        """
+        saved = self._saved.get(sub_site)
+        if saved is None:
+            cursor = self._conn.execute("SELECT {} FROM figures WHERE sub_site = ?".format(
+                ", ".join(self.figure_columns)), (sub_site,))
+            saved = {row[0]: tuple(row) for row in cursor}
+            self._saved[sub_site] = saved
+        return saved
+
+    def save_figures(self, sub_site, records):
+        """
+        Replaces the stored snapshot of a sub-site with the passed figure records.
+        Unchanged rows are skipped, rows where only last_seen moved get just that column updated, and the upserts,
+        updates and deletes are written in one transaction.
+
+        @param sub_site: The key of the sub-site the figures belong to
+        @type sub_site: str
+        @param records: Figure records as returned by FigureData.to_record()
+        @type records: list[dict]
+        @return: Number of rows written and number of rows deleted. Rows where only last_seen was updated are not
+                 counted.
+        @rtype: (int, int)
+        """
+        with self._lock:
+            saved = self._saved_rows(sub_site)
+            current = {}
+            for record in records:
+                row = self._row(record)
+                current[row[0]] = row
+
+            upserts = []
+            seen = []
+            for identity, row in current.items():
+                saved_row = saved.get(identity)
+                if saved_row is None or saved_row[:-1] != row[:-1]:
+                    upserts.append((sub_site,) + row)
+                elif saved_row[-1] != row[-1]:
+                    seen.append((row[-1], sub_site, identity))
+            deletes = [(sub_site, identity) for identity in saved if identity not in current]
+
+            if upserts or seen or deletes:
+                placeholders = ", ".join("?" * (len(self.figure_columns) + 1))
+                try:
+                    self._conn.execute("BEGIN IMMEDIATE")
+                    self._conn.executemany("INSERT OR REPLACE INTO figures (sub_site, {}) VALUES ({})".format(
+                        ", ".join(self.figure_columns), placeholders), upserts)
+                    self._conn.executemany("UPDATE figures SET last_seen = ? WHERE sub_site = ? AND identity = ?", seen)
+                    self._conn.executemany("DELETE FROM figures WHERE sub_site = ? AND identity = ?", deletes)
+                    self._conn.execute("COMMIT")
+                except sqlite3.Error:
+                    self._conn.execute("ROLLBACK")
+                    self._saved.pop(sub_site, None)
+                    self._log.error("Unable to save figures for {}".format(sub_site), exc_info=True)
+                    raise
+
+            self._saved[sub_site] = current
+            self._log.debug("Saved {}: {} rows written, {} seen again, {} rows deleted".format(
+                sub_site, len(upserts), len(seen), len(deletes)))
+            return len(upserts), len(deletes)
+
+    def load_figures(self, sub_site):
+        """
+        @param sub_site: The key of the sub-site to load
+        @type sub_site: str
+        @return: The stored figure records of the sub-site
+        @rtype: list[dict]
+        """
+        with self._lock:
+            return [dict(zip(self.figure_columns, row)) for row in self._saved_rows(sub_site).values()]
+
+    def save_sub_site(self, sub_site, identity, next_run=None, updated=None):
+        """
+        Records that a sub-site has a valid baseline, along with when it should be scraped next.
+
+        @param sub_site: The key of the sub-site
+        @type sub_site: str
+        @param identity: A hash of the configuration the stored figures were scraped with
+        @type identity: str
+        @param next_run: Unix time of the next scheduled scrape
+        @type next_run: float | None
+        @param updated: Unix time the state was written
+        @type updated: float | None
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO sub_sites (sub_site, identity, next_run, updated) "
+                               "VALUES (?, ?, ?, ?)", (sub_site, identity, next_run, updated))
+
+    def load_sub_site(self, sub_site):
+        """
+        @param sub_site: The key of the sub-site
+        @type sub_site: str
+        @return: The stored identity, next_run and updated values of the sub-site, or None if it has no baseline
+        @rtype: dict | None
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT identity, next_run, updated FROM sub_sites WHERE sub_site = ?",
+                                     (sub_site,)).fetchone()
+        if row is None:
+            return None
+        return {'identity': row[0], 'next_run': row[1], 'updated': row[2]}
+
+    def delete_sub_site(self, sub_site):
+        """
+        Drops all stored state of a sub-site.
+        @param sub_site: The key of the sub-site
+        @type sub_site: str
+        """
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._conn.execute("DELETE FROM figures WHERE sub_site = ?", (sub_site,))
+                self._conn.execute("DELETE FROM sub_sites WHERE sub_site = ?", (sub_site,))
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                self._conn.execute("ROLLBACK")
+                raise
+            finally:
+                self._saved.pop(sub_site, None)
+
+    def sub_sites(self):
+        """
+        @return: The keys of all sub-sites with stored state
+        @rtype: list[str]
+        """
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT sub_site FROM sub_sites UNION SELECT DISTINCT sub_site FROM figures")]
+
+    def load_alerts(self):
+        """
+        @return: Alert key to the Unix time it was last sent
+        @rtype: dict[str, float]
+        """
+        with self._lock:
+            return {row[0]: row[1] for row in self._conn.execute("SELECT alert, sent FROM alerts")}
+
+    def record_alert(self, alert, sent):
+        """
+        @param alert: The alert key
+        @type alert: str
+        @param sent: Unix time the alert was sent
+        @type sent: float
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO alerts (alert, sent) VALUES (?, ?)", (alert, sent))
+
+    def prune_alerts(self, before):
+        """
+        Forgets alerts sent before a point in time.
+        @param before: Unix time
+        @type before: float
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM alerts WHERE sent < ?", (before,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class AlertDedup:
+
+    def __init__(self, store, window=24 * 60 * 60, retention=30 * 24 * 60 * 60):
+        """
+        Remembers which alerts were sent, so a figure that drops out and comes back, or flaps between pages, does not
+        alert again within the suppression window. check() only looks: an alert is recorded by record(), or sent() as
+        the dispatcher's on_sent, once it was actually delivered, so an alert that failed to send is not suppressed.
+        Every alert sent within the retention is held in memory, so checks never touch the store. The store is only
+        written through, to carry the alerts over a restart.
+
+        @param store: Where sent alerts are persisted
+        @type store: StateStore
+        @param window: Default suppression window in seconds
+        @type window: float
+        @param retention: Seconds after which sent alerts are forgotten entirely
+        @type retention: float
+        """
+        self._log = logging.getLogger(self.__class__.__name__)
+        self._store = store
+        self.window = window
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._pruned = time_p.time()
+        store.prune_alerts(self._pruned - retention)
+        self._sent = store.load_alerts()  # type: dict[str, float]
+        self.suppressed = 0  # type: int
+
+    @staticmethod
+    def key(product, entry, price, condition):
+        """
+        @param product: Identity of the product, e.g. its link
+        @param entry: The watchlist entry the alert is for
+        @param price: The listed price
+        @param condition: The listed condition
+        @return: The key the alert is stored under
+        @rtype: str
+        """
+        digest = hashlib.sha1()
+        for part in (product, entry, price, condition):
+            digest.update(str(part).encode('UTF-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def check(self, product, entry, price, condition, window=None, now=None):
+        """
+        Decides whether an alert should be sent. Does not record it, see record().
+
+        @param window: Suppression window in seconds. Defaults to the window given at construction.
+        @type window: float | None
+        @param now: Unix time of the alert. Defaults to now.
+        @type now: float | None
+        @return: False if the same alert was already sent within the window
+        @rtype: bool
+        """
+        alert = self.key(product, entry, price, condition)
+        if window is None:
+            window = self.window
+        if now is None:
+            now = time_p.time()
+        with self._lock:
+            sent = self._sent.get(alert)
+            if sent is None or now - sent >= window:
+                return True
+            self.suppressed += 1
+        self._log.info("Suppressed repeat alert for {} ({})".format(product, entry))
+        return False
+
+    def record(self, alert, now=None):
+        """
+        Records an alert as sent.
+        @param alert: The alert key, see key()
+        @type alert: str
+        @param now: Unix time it was sent. Defaults to now.
+        @type now: float | None
+        """
+        if now is None:
+            now = time_p.time()
+        with self._lock:
+            self._sent[alert] = now
+            prune = now - self._pruned > 60 * 60
+            if prune:
+                # Alerts past the retention are forgotten, in memory as in the store.
+                self._pruned = now
+                for key in [key for key, sent in self._sent.items() if now - sent > self.retention]:
+                    del self._sent[key]
+        try:
+            self._store.record_alert(alert, now)
+            if prune:
+                self._store.prune_alerts(now - self.retention)
+        except sqlite3.Error:
+            self._log.error("Unable to persist alert {}".format(alert), exc_info=True)
+
+    def sent(self, notification):
+        """
+        Records the alerts of a notification that was delivered. Meant as NotificationDispatcher's on_sent.
+        @type notification: Notifier.Notification
+        """
+        for alert in notification.alerts:
+            self.record(alert)
+
@@ -1,30 +1,55 @@
 import xml.etree.ElementTree as ET
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
 import time as time_p
 import logging
+import os
 import sys
-import traceback
-from distutils.util import strtobool
+import argparse
+import socket
+import threading
 from datetime import time, timedelta, datetime, date
 from multiprocessing.dummy import Pool
-import pickle
+from collections import OrderedDict, deque
+import heapq
+import itertools
+import hashlib
+import uuid
 
-import requests  # pip3 install requests
-from bs4 import BeautifulSoup  # pip3 install beautifulsoup4
-
-# Pushover
-from chump import Application  # pip3 install chump
-
-# For console manipulation.
-from colorama import Fore, Back, Style, init
-import click
-
-# String Searching
-#  http://chairnerd.seatgeek.com/fuzzywuzzy-fuzzy-string-matching-in-python/
-from fuzzywuzzy import fuzz  # pip3 install fuzzywuzzy
-from fuzzywuzzy import process
+# The third party dependencies are heavy to import, so they are only imported where they are used:
+#  requests in Decoding.scrapeSite, beautifulsoup4 by the decoders, chump for Pushover, colorama and click for the
+#  console and fuzzywuzzy (http://chairnerd.seatgeek.com/fuzzywuzzy-fuzzy-string-matching-in-python/) for matching.
 
 import re
+import sqlite3
+
+from StateStore import StateStore, AlertDedup
+from ObservationLog import ObservationLog
+from Notifier import Notification, NotificationDispatcher, PushoverTransport, StubTransport
+import Metrics
+from Profiler import CycleProfiler
+from JobQueue import Job, open_job_queue
+from Clustering import ClusterIndex
+from QueryServer import StockIndex, QueryServer
+import Decoding
+from Decoding import FigureData, Decoder, FigureDataCorrupt, parse_price
+
+# Metrics of the checker. They are exported in the Prometheus text format through Metrics.registry.
+stage_seconds = Metrics.registry.histogram('stockchecker_stage_seconds',
+                                           'Seconds spent in each stage of a sub-site scrape.', ('stage', 'sub_site'))
+match_cache_lookups = Metrics.registry.counter('stockchecker_match_cache_lookups_total',
+                                               'Lookups of the match cache.', ('result',))
+figure_clusters = Metrics.registry.gauge('stockchecker_figure_clusters',
+                                         'Clusters the listings of every sub-site are grouped into.')
+sub_site_figures = Metrics.registry.gauge('stockchecker_sub_site_figures',
+                                          'Figures listed by a sub-site in its last scrape.', ('sub_site',))
+sub_site_discovered = Metrics.registry.gauge('stockchecker_sub_site_discovered_figures',
+                                             'New figures found by the last scrape of a sub-site.', ('sub_site',))
+sub_site_last_scrape = Metrics.registry.gauge('stockchecker_sub_site_last_scrape_timestamp_seconds',
+                                              'Unix time a sub-site was last scraped successfully.', ('sub_site',))
+sub_site_next_run = Metrics.registry.gauge('stockchecker_sub_site_next_run_timestamp_seconds',
+                                           'Unix time a sub-site is next due.', ('sub_site',))
+sub_site_failures = Metrics.registry.counter('stockchecker_sub_site_failures_total',
+                                             'Scrapes of a sub-site that returned corrupt figure data.', ('sub_site',))
 
 
 class WebsiteData:
@@ -39,14 +64,16 @@ class WebsiteData:
         """
         self._website_xml = _website_xml
         self._website_name = "Unknown"
+        self._id = None
         self._log = logging.getLogger(self.__class__.__name__)
         try:
             self._website_name = _website_xml.attrib['name']
+            self._id = _website_xml.attrib.get('id', self._website_name)
             self._base_url = _website_xml.find("base_url").text
 
             self._sub_sites = []
             for sub_site_xml in self._website_xml.findall('sub_site'):
-                self._sub_sites.append(SubSiteData(sub_site_xml))
+                self._sub_sites.append(SubSiteData(sub_site_xml, self._website_name))
 
             # for subSite in self._sub_sites:
                 # print(self._base_url + subSite.url)
@@ -65,6 +92,14 @@ class WebsiteData:
         """
         return self._website_name
 
+    @property
+    def id(self):
+        """
+        @return: The id attribute of the website in sources.xml
+        @rtype: str
+        """
+        return self._id
+
     @property
     def sub_sites(self):
         """
@@ -85,16 +120,20 @@ class WebsiteData:
 
 
 class SubSiteData:
+    default_frequency = timedelta(minutes=0.13)  # Used when the sub-site has no schedule block
 
-    def __init__(self, sub_site_xml):
+    def __init__(self, sub_site_xml, website_name="Unknown"):
         """
         This is a data type for holding and processing all info relating to a sub-site specified for a base webpage
         @param sub_site_xml: An ElementTree holding xml information regarding a sub website
         @type sub_site_xml: ElementTree
+        @param website_name: The name of the website this sub-site belongs to
+        @type website_name: str
         @return: None
         @rtype: None
         """
         self._xml = sub_site_xml
+        self._website_name = website_name
         self._url = self._xml.find('url').text
         try:
             self._local_uri = self._xml.find('local').text
@@ -120,20 +159,35 @@ class SubSiteData:
             self.match_confidence = 60
 
         self._sub_site_description = self._xml.attrib['name']
+        self._id = self._xml.attrib.get('id', self._sub_site_description)
 
         self.website_html = None
+        self.primed = False  # True once old_figures holds a baseline to compare new scrapes against
+        self.next_run = None  # type: datetime
         self.old_figures = []
         self._figures = None
         self.figure_search_data = []
         self._discovered_figures = []
-        self._deleted_figures = []
+        self.tombstones = Tombstones()
+        self.price_changes = []  # type: list[(FigureData, FigureData)]  # (figure, as it was) of the last diff
+        self.price_indexes = {}  # type: dict[int, PriceIndex]  # Watchlist entry index to its price index
+        self.prices_indexed = False  # True once the baseline has been matched into price_indexes
 
         # initialize the search parameters.
         for fig in self._xml.findall('figure'):
             self.figure_search_data.append(SearchParams(fig))
+        self.watchlist_hash = self._hash_watchlist()
 
         self.frequency, self.time = self.parse_schedule()
+        self.adaptive = None  # type: AdaptiveSchedule
+        schedule_xml = self._xml.find('schedule')
+        if schedule_xml is not None and schedule_xml.attrib.get('mode') == 'adaptive':
+            self.adaptive = AdaptiveSchedule(schedule_xml, self.frequency or self.default_frequency)
+        self.listing_hash = None  # type: str
+        self.page_snapshots = PageSnapshots()
         self.matched_reporting, self.unmatched_reporting = self.parse_reporting()
+        report_xml = self._xml.find('report')
+        self.suppression_window = parse_timedelta(report_xml.find('suppress')) if report_xml is not None else None
 
 
 
@@ -174,15 +228,11 @@ class SubSiteData:
     @property
     def deleted_figures(self):
         """
-        Storage for figures that we scrape from the website that we have deemed to be deleted.
+        The figures most recently deemed deleted, oldest first. Only the last Tombstones.history are kept.
         @return: List of Deleted Figures
         @rtype: list[FigureData]
         """
-        return self._deleted_figures
-
-    @deleted_figures.setter
-    def deleted_figures(self, value):
-        self._deleted_figures = value
+        return list(self.tombstones.deleted)
 
     @property
     def url(self):
@@ -210,24 +260,71 @@ class SubSiteData:
         """
         return self._sub_site_description
 
+    @property
+    def id(self):
+        """
+        @return: The id attribute of the sub-site in sources.xml
+        @rtype: str
+        """
+        return self._id
+
+    @property
+    def xml(self):
+        """
+        @return: The configuration the sub-site was built from
+        @rtype: ElementTree
+        """
+        return self._xml
+
+    def adopt_state(self, other):
+        """
+        Takes over the scrape state of the sub-site this one replaces after the configuration was reloaded.
+        The figures, baseline and adaptive interval carry over. Search parameters and schedule stay as configured.
+
+        @param other: The sub-site built from the previous configuration
+        @type other: SubSiteData
+        """
+        self.website_html = other.website_html
+        self.old_figures = other.old_figures
+        self._figures = other.figures
+        self.primed = other.primed
+        self.listing_hash = other.listing_hash
+        self.page_snapshots = other.page_snapshots
+        self.tombstones = other.tombstones
+        if self.adaptive is not None and other.adaptive is not None:
+            self.adaptive.interval = min(max(other.adaptive.interval, self.adaptive.min_interval),
+                                         self.adaptive.max_interval)
+            self.adaptive.change_rate = other.adaptive.change_rate
+
+    @property
+    def key(self):
+        """
+        A stable identifier of the sub-site used to store its state.
+        @return: website name and sub-site id
+        @rtype: str
+        """
+        return "{}/{}".format(self._website_name, self._id)
+
+    @property
+    def identity(self):
+        """
+        A hash of the parts of the configuration that determine which figures are scraped. Stored state is only
+        restored into a sub-site with the same identity.
+        @rtype: str
+        """
+        digest = hashlib.sha1()
+        for part in (self._website_name, self._id, self._url, self._proto_url, self._local_uri):
+            digest.update(str(part).encode('UTF-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
     def parse_schedule(self):
         frequency = None
         _time_date = None
         try:
             sch_xml = self._xml.find('schedule')
 
-            try:
-                freq_xml = sch_xml.find('frequency')
-                _days = int(freq_xml.find('days').text)
-                _hours = int(freq_xml.find('hours').text)
-                _minutes = int(freq_xml.find('minutes').text)
-                _seconds = int(freq_xml.find('seconds').text)
-
-                frequency = timedelta(days=_days, hours=_hours, minutes=_minutes, seconds=_seconds)
-            except AttributeError:
-                pass
-            except KeyError:
-                pass
+            frequency = parse_timedelta(sch_xml.find('frequency'))
 
             try:
                 str_time = sch_xml.find('time').text
@@ -245,6 +342,9 @@ class SubSiteData:
                 pass
             except KeyError:
                 pass
+            except ValueError:
+                logging.warning("Ignoring invalid schedule time {!r} of {}. Using the frequency instead.".format(
+                    str_time, self.description))
 
         except AttributeError:
             pass
@@ -253,6 +353,134 @@ class SubSiteData:
 
         return frequency, _time_date
 
+    def next_due(self, after=None):
+        """
+        Works out when this sub-site should be scraped next according to its own schedule block.
+        An adaptive schedule decides for itself. Otherwise a time of day takes precedence over a frequency, and
+        without either, default_frequency is used.
+        @param after: The time of the last scrape. Defaults to now.
+        @type after: datetime | None
+        @return: The time the sub-site is next due
+        @rtype: datetime
+        """
+        if after is None:
+            after = datetime.now()
+        if self.adaptive is not None:
+            return self.adaptive.next_due(after)
+        if self.time is not None:
+            next_time = datetime.combine(after.date(), self.time.time())
+            if next_time <= after:
+                next_time += timedelta(days=1)
+            return next_time
+        if self.frequency is not None:
+            return after + self.frequency
+        return after + self.default_frequency
+
+    def _hash_watchlist(self):
+        """
+        Hashes the figure entries of this sub-site (and the confidence they are matched with) so that cached match
+        results are invalidated as soon as the watchlist in sources.xml changes.
+        @return: Hex digest identifying this version of the watchlist
+        @rtype: str
+        """
+        digest = hashlib.sha1(str(self.match_confidence).encode('UTF-8'))
+        for fig in self._xml.findall('figure'):
+            digest.update(ET.tostring(fig, encoding='UTF-8'))
+        return digest.hexdigest()
+
+    def match(self, _figure, cache=None):
+        """
+        Matches a figure against the watchlist, as match_name does, and applies the price and condition filters of the
+        entry it matched. A figure rejected by a filter is returned as not matching, with the filter as the method.
+        @type _figure: FigureData
+        @rtype: (SearchParams | None, int, str)
+        """
+        search_data, reported_confidence, match_type = self.match_name(_figure, cache)
+        if search_data is not None:
+            accepted, rejected_by = search_data.accepts(_figure)
+            if not accepted:
+                return None, reported_confidence, rejected_by
+        return search_data, reported_confidence, match_type
+
+    def index_price(self, _figure, cache=None):
+        """
+        Files a figure in the price index of the watchlist entry its name matches, if any.
+        @type _figure: FigureData
+        @return: The index of the watchlist entry, or None if the figure is not watched or has no price
+        @rtype: int | None
+        """
+        if _figure.price_value is None or not self.figure_search_data:
+            return None
+        search_data = self.match_name(_figure, cache)[0]
+        if search_data is None:
+            return None
+        index = self.figure_search_data.index(search_data)
+        self.price_indexes.setdefault(index, PriceIndex()).update(_figure.identity, _figure.price_value)
+        return index
+
+    def watched_entry(self, identity):
+        """
+        @return: The index of the watchlist entry whose price index holds the figure, or None
+        @rtype: int | None
+        """
+        for index, price_index in self.price_indexes.items():
+            if identity in price_index:
+                return index
+        return None
+
+    def unindex_price(self, identity):
+        for price_index in self.price_indexes.values():
+            price_index.remove(identity)
+
+    def match_name(self, _figure, cache=None):
+        """
+        Matches a figure against every entry of this sub-site's watchlist, consulting the match cache first and then
+        the entry another listing of the same figure matched in the same watchlist, see clusters.
+        @param _figure: The figure to match
+        @type _figure: FigureData
+        @param cache: The memo to use. Defaults to the module wide match_cache.
+        @type cache: MatchCache
+        @return: The matching search entry (or None), the reported confidence and the matching method
+        @rtype: (SearchParams | None, int, str)
+        """
+        if cache is None:
+            cache = match_cache
+        cached = cache.get(_figure.extended_name, self.watchlist_hash)
+        match_cache_lookups.inc(result="hit" if cached is not None else "miss")
+        if cached is None:
+            # Listings of one cluster can differ by a word, e.g. "Figma Kirino Kousaka" and "Kirino Kousaka". So a match
+            # is only taken over if this name has the mandatory parameters of the entry as well, and a miss is worked
+            # out anew. Either way it is not put in the match cache, which only holds what was worked out for a name.
+            borrowed = clusters.decision((self.key, _figure.identity), self.watchlist_hash)
+            if borrowed is not None and borrowed[0] is not None and \
+                    self.figure_search_data[borrowed[0]].has_mandatory(_figure.extended_name):
+                match_cache_lookups.inc(result="cluster")
+                cached = borrowed
+        if cached is not None:
+            index, reported_confidence, match_type = cached
+            search_data = self.figure_search_data[index] if index is not None else None
+            return search_data, reported_confidence, match_type
+
+        best = (None, 0, None)
+        with stage_seconds.time(stage="match", sub_site=self.key):
+            for index, search_data in enumerate(self.figure_search_data):
+                fig_found, reported_confidence, match_type = search_data.search(_figure, self.match_confidence)
+
+                if not fig_found and reported_confidence > (self.match_confidence - 20):
+                    logging.info("Confidence: {} using {} for {}".
+                                 format(reported_confidence, match_type, _figure.extended_name))
+                if fig_found:
+                    best = (index, reported_confidence, match_type)
+                    break  # No need to keep trying to match the figure
+                if reported_confidence > best[1]:
+                    best = (None, reported_confidence, match_type)
+
+        cache.put(_figure.extended_name, self.watchlist_hash, best)
+        clusters.remember((self.key, _figure.identity), self.watchlist_hash, best)
+        index, reported_confidence, match_type = best
+        search_data = self.figure_search_data[index] if index is not None else None
+        return search_data, reported_confidence, match_type
+
     def parse_reporting(self):
         """
 
@@ -271,6 +499,111 @@ class SubSiteData:
         return matched, unmatched
 
 
+class AdaptiveSchedule:
+
+    def __init__(self, schedule_xml, frequency):
+        """
+        The polling interval of a sub-site with <schedule mode="adaptive">. The interval tightens while the listing keeps
+        changing and relaxes while it stays quiet, bounded by <min> and <max>. Known restock windows, given as
+        <frequencyAtTimePeriod enabled="True" start="06:50:00" frequency="30">15</frequencyAtTimePeriod>, are polled
+        every `frequency` seconds for the given number of minutes. start defaults to the schedule's <time>.
+
+        @param schedule_xml: The schedule block of the sub-site
+        @type schedule_xml: ElementTree
+        @param frequency: The interval to start from
+        @type frequency: timedelta
+        """
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.min_interval = parse_timedelta(schedule_xml.find('min')) or timedelta(minutes=1)
+        self.max_interval = parse_timedelta(schedule_xml.find('max')) or timedelta(hours=1)
+        self.interval = min(max(frequency, self.min_interval), self.max_interval)
+        self.tighten = float(schedule_xml.attrib.get('tighten', 0.5))
+        self.relax = float(schedule_xml.attrib.get('relax', 1.5))
+        self.change_rate = 0.0  # Exponentially weighted fraction of scrapes that saw a change
+        self.windows = []  # type: list[(time, timedelta, timedelta)]
+
+        default_start = None
+        try:
+            default_start = datetime.strptime(schedule_xml.find('time').text, "%H:%M:%S").time()
+        except AttributeError:
+            pass
+        except ValueError as e:
+            self._log.warning("Ignoring invalid schedule time, polling at the adaptive interval: " + str(e))
+
+        for window_xml in schedule_xml.findall('frequencyAtTimePeriod'):
+            try:
+                if not strtobool(window_xml.attrib.get('enabled', 'True').strip()):
+                    continue
+                if 'start' in window_xml.attrib:
+                    start = datetime.strptime(window_xml.attrib['start'], "%H:%M:%S").time()
+                else:
+                    start = default_start
+                if start is None:
+                    raise ValueError("no start time")
+                duration = timedelta(minutes=float(window_xml.text))
+                window_frequency = timedelta(seconds=float(window_xml.attrib['frequency'])) \
+                    if 'frequency' in window_xml.attrib else self.min_interval
+                self.windows.append((start, duration, window_frequency))
+            except (ValueError, TypeError) as e:
+                self._log.error("Ignoring invalid frequencyAtTimePeriod: " + str(e))
+
+    def observe(self, added, removed, listing_changed):
+        """
+        Adjusts the interval after a scrape.
+
+        @param added: Number of figures that appeared
+        @type added: int
+        @param removed: Number of figures that disappeared from the listing, see diff_figures
+        @type removed: int
+        @param listing_changed: Whether the listing hash differs from the previous scrape
+        @type listing_changed: bool
+        """
+        changed = added > 0 or removed > 0 or listing_changed
+        self.change_rate = 0.7 * self.change_rate + (0.3 if changed else 0.0)
+        if changed:
+            self.interval = max(self.min_interval, self.interval * self.tighten)
+        elif self.change_rate < 0.1:
+            self.interval = min(self.max_interval, self.interval * self.relax)
+        self._log.debug("Interval {} (change rate {:.2f})".format(self.interval, self.change_rate))
+
+    def _window(self, moment):
+        """
+        @return: The restock window the moment falls into as (start, end, frequency), or None
+        @rtype: (datetime, datetime, timedelta) | None
+        """
+        for start, duration, window_frequency in self.windows:
+            for day in (moment.date() - timedelta(days=1), moment.date()):
+                window_start = datetime.combine(day, start)
+                if window_start <= moment < window_start + duration:
+                    return window_start, window_start + duration, window_frequency
+        return None
+
+    def _next_window_start(self, moment):
+        starts = []
+        for start, duration, window_frequency in self.windows:
+            window_start = datetime.combine(moment.date(), start)
+            if window_start <= moment:
+                window_start += timedelta(days=1)
+            starts.append(window_start)
+        return min(starts) if starts else None
+
+    def next_due(self, after):
+        """
+        @param after: The time of the last scrape
+        @type after: datetime
+        @return: When the sub-site should be scraped next
+        @rtype: datetime
+        """
+        window = self._window(after)
+        if window is not None:
+            return after + window[2]
+        due = after + self.interval
+        window_start = self._next_window_start(after)
+        if window_start is not None and window_start < due:
+            return window_start
+        return due
+
+
 class FigureSearchData:
 
     def __init__(self, search_param_xml):
@@ -301,9 +634,22 @@ class SearchParams:
         for search_xml in self._xml.findall('search'):
             self._search_parameters.append(FigureSearchData(search_xml))
 
+        # Optional filters: <max_price>8,000 JPY</max_price> and any number of <condition>A</condition>
+        self.max_price, self.max_price_currency = parse_price(self._xml.findtext('max_price'))  # type: int, str
+        self.conditions = [condition.text.strip().lower() for condition in self._xml.findall('condition')
+                           if condition.text]  # type: list[str]
+
         self.fuzzy_search = ""
         self.regex_search = None
 
+    @property
+    def name(self):
+        """
+        @return: The name of the watchlist entry
+        @rtype: str
+        """
+        return self._figure_name
+
     @property
     def parameters(self):
         return self._search_parameters
@@ -312,13 +658,11 @@ class SearchParams:
     def parameters(self, value):
         self._search_parameters = value
 
-    def search(self, _figure, confidence):
-        # we are using a two step matching system.
-        # First we be above a confidence threshold using a fuzzy search
-        # Then we must find all of the mandatory parameters using regex
+    def _prepare(self):
         if self.fuzzy_search == '':
+            fuzzy_search = ""
             for param in self._search_parameters:
-                self.fuzzy_search += param.search_parameter + " "
+                fuzzy_search += param.search_parameter + " "
 
                 if param.dependence == "mandatory":
                     # TODO: I do not think I am supposed to use escape like this. (what did I mean by that?)
@@ -331,7 +675,26 @@ class SearchParams:
             #     self.regex_search = param.regEx_string
             # else:
             #     self.regex_search += "|" + param.regEx_string
+            self.fuzzy_search = fuzzy_search
+
+    def has_mandatory(self, name):
+        """
+        The regex half of search() on its own. A name without every mandatory parameter never matches, whatever its
+        fuzzy score, so the far slower fuzzy search can be skipped for it.
+        @type name: str
+        @rtype: bool
+        """
+        self._prepare()
+        return all(re.search(param.regEx_string, name) is not None for param in self._search_parameters)
+
+    def search(self, _figure, confidence):
+        # we are using a two step matching system.
+        # First we be above a confidence threshold using a fuzzy search
+        # Then we must find all of the mandatory parameters using regex
+        self._prepare()
         # result = fuzz.token_set_ratio(self.fuzzy_search, _figure.extended_name)
+        from fuzzywuzzy import fuzz  # pip3 install fuzzywuzzy
+
         length_ratio = len(_figure.extended_name.split())/len(self.fuzzy_search.split())
         if length_ratio > 1.5 or length_ratio < 0.5:
             # The name is too long or too short to match using standard ratio, use Token Set instead.
@@ -346,12 +709,224 @@ class SearchParams:
             for param in self._search_parameters:
                 if re.search(param.regEx_string, _figure.extended_name) is None:
                     # if any of the mandatory strings are not found, return false
-                    return False, result
+                    return False, result, method
         else:
             return False, result, method
 
         return True, result, method
 
+    def accepts(self, _figure):
+        """
+        Applies the price and condition filters of this entry to a figure whose name matched it. A price or
+        condition that is not known passes, so a missing detail never swallows an alert.
+
+        @type _figure: FigureData
+        @return: Whether the figure passes, and the filter that rejected it if it does not
+        @rtype: (bool, str | None)
+        """
+        if self.max_price is not None and _figure.price_value is not None:
+            same_currency = self.max_price_currency is None or _figure.currency is None or \
+                self.max_price_currency == _figure.currency
+            if same_currency and _figure.price_value > self.max_price:
+                return False, "max_price"
+        if self.conditions and _figure.condition:
+            grade = _figure._decoder.condition_grade(_figure.condition) if _figure._decoder is not None \
+                else _figure.condition
+            if grade.strip().lower() not in self.conditions:
+                return False, "condition"
+        return True, None
+
+
+class PriceIndex:
+
+    def __init__(self):
+        """
+        The prices of the listed figures that match one watchlist entry, so whether a figure is watched, and what it
+        was last listed for, is a dict lookup instead of a match against the whole watchlist.
+        """
+        self._prices = {}  # type: dict[str, int]
+
+    def update(self, identity, price):
+        """
+        @type identity: str
+        @param price: Price in the smallest unit of currency
+        @type price: int
+        @return: The price the figure was indexed with before, or None
+        @rtype: int | None
+        """
+        previous = self._prices.get(identity)
+        self._prices[identity] = price
+        return previous
+
+    def remove(self, identity):
+        """
+        @return: The price the figure was indexed with, or None if it was not
+        @rtype: int | None
+        """
+        return self._prices.pop(identity, None)
+
+    def price(self, identity):
+        return self._prices.get(identity)
+
+    def __contains__(self, identity):
+        return identity in self._prices
+
+    def __len__(self):
+        return len(self._prices)
+
+
+class MatchCache:
+
+    def __init__(self, max_size=4096):
+        """
+        A bounded LRU memo of match decisions keyed by (name, watchlist hash).
+        Figures that come back after their TTL ran out, or that show up on another sub-site with the same watchlist,
+        are then never scored by fuzzywuzzy twice. Names are kept exactly as they are matched: fuzzy scores differ
+        between names that only differ in whitespace.
+        @param max_size: Number of decisions to keep before the least recently used one is evicted.
+        @type max_size: int
+        """
+        self._max_size = max_size
+        self._cache = OrderedDict()
+        self.hits = 0  # type: int
+        self.misses = 0  # type: int
+
+    def get(self, name, watchlist_hash):
+        """
+        @return: The cached (search entry index | None, confidence, method), or None if the name was never matched
+        against this version of the watchlist.
+        @rtype: (int | None, int, str) | None
+        """
+        key = (name, watchlist_hash)
+        try:
+            result = self._cache[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, name, watchlist_hash, result):
+        key = (name, watchlist_hash)
+        self._cache[key] = result
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
+
+    def clear(self):
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+match_cache = MatchCache()
+
+
+class UserWatchlists:
+
+    def __init__(self, users=None):
+        """
+        The watchlists of every user, compiled into one index that applies to every sub-site. Entries of different
+        users that search for the same thing are scored as one, so a listing is scored once against each distinct
+        search however many users watch it, and the matches fan out to every user subscribed to the search. The price
+        and condition filters stay with each user's own entry.
+
+        @param users: User name to their watchlist, a <watchlist> of <figure> entries written as in sources.xml
+        @type users: dict[str, ElementTree]
+        """
+        self._log = logging.getLogger(self.__class__.__name__)
+        self._searches = []  # type: list[SearchParams]  # One per distinct search
+        self._subscriptions = []  # type: list[list[(str, SearchParams)]]  # Per search, the users and their entries
+        self._scores = MatchCache()  # Name to the (search, score, method) of the searches it has the mandatory parts of
+        positions = {}
+        digest = hashlib.sha1()
+        for user in sorted(users or {}):
+            for figure_xml in users[user].findall('figure'):
+                entry = SearchParams(figure_xml)
+                search = tuple((param.search_parameter, param.dependence, param.exactly) for param in entry.parameters)
+                if search not in positions:
+                    positions[search] = len(self._searches)
+                    self._searches.append(entry)
+                    self._subscriptions.append([])
+                    digest.update(repr(search).encode('UTF-8'))
+                self._subscriptions[positions[search]].append((user, entry))
+        self.hash = digest.hexdigest()  # type: str
+        self.users = sorted(users or {})  # type: list[str]
+        self._log.info("{} users watch {} distinct searches".format(len(self.users), len(self._searches)))
+
+    def __len__(self):
+        return len(self._searches)
+
+    def matches(self, _figure, confidence):
+        """
+        @param _figure: The figure to match
+        @type _figure: FigureData
+        @param confidence: The match confidence of the sub-site the figure was found on
+        @type confidence: int
+        @return: The user and their entry, the confidence and the method of every entry the figure matches
+        @rtype: list[(str, SearchParams, int, str)]
+        """
+        scores = self._scores.get(_figure.extended_name, self.hash)
+        if scores is None:
+            scores = []
+            with stage_seconds.time(stage="match", sub_site="users"):
+                for index, search_data in enumerate(self._searches):
+                    if not search_data.has_mandatory(_figure.extended_name):
+                        continue
+                    # No threshold yet: it is the sub-site's, and the score is kept for every sub-site.
+                    fig_found, reported_confidence, match_type = search_data.search(_figure, -1)
+                    if fig_found:
+                        scores.append((index, reported_confidence, match_type))
+            self._scores.put(_figure.extended_name, self.hash, scores)
+        return [(user, entry, reported_confidence, match_type)
+                for index, reported_confidence, match_type in scores if reported_confidence > confidence
+                for user, entry in self._subscriptions[index]]
+
+
+def load_user_watchlists(keys):
+    """
+    Reads the users of keys.yaml, each with their own Pushover user key and watchlist file:
+
+        Users:
+          alice:
+            UserKey: ...
+            Watchlist: alice.xml
+
+    @param keys: The loaded keys.yaml
+    @type keys: dict
+    @return: The watchlists of the users, or None if there are no users
+    @rtype: UserWatchlists | None
+    """
+    users = keys.get("Users") or {}
+    if not users:
+        return None
+    return UserWatchlists(dict((str(user), ET.parse(settings["Watchlist"]).getroot())
+                               for user, settings in users.items()))
+
+
+def pushover_transports(keys):
+    """
+    @param keys: The loaded keys.yaml
+    @type keys: dict
+    @return: A transport for the user of keys.yaml as "default", and one for each of the Users, by name
+    @rtype: dict[str, PushoverTransport]
+    """
+    from chump import Application  # pip3 install chump
+
+    push_app = Application(keys["AppKey"])
+    transports = {"default": PushoverTransport(push_app.get_user(keys["UserKey"]))}
+    for user, settings in (keys.get("Users") or {}).items():
+        transports[str(user)] = PushoverTransport(push_app.get_user(settings["UserKey"]))
+    return transports
+
+
+# Listings of every sub-site, grouped by the figure they are for. Keyed by (sub-site key, figure identity).
+clusters = ClusterIndex()
+# The latest listings of every sub-site, for the query server.
+stock_index = StockIndex()
+
 
 class Figures:
     # TODO: Figure out a better way of doing this.
@@ -373,991 +948,1720 @@ class Figures:
         self.figures = self._decoder.get_figures(self._html, self._url)  # type: list[FigureData]
 
 
-class FigureData:
-
-
-    def __init__(self, decoder, service, figure_html):
-        self._service = service.lower()  # type: str
-        self._decoder = decoder
-        self._html = figure_html
-        # self._parsed_html = BeautifulSoup(localHTML, 'html.parser')
-        self._name = None  # type: str
-        self.price = None  # type: str
-        self.link = None  # type: str
-        self.pic_link = None  # type: str
-        self._condition = None  # type: str
-        self._releaseStatus = None  # type: str
-        self._extended_name = None  # type: str
-        self._search_url = None  # type: str # TODO: This is currently unused
-        self.TTL = 3 # type: int  # number of times the figure must be missing to remove it from data
+class PageSnapshots:
 
-    @property
-    def release_status(self):
-        return self._releaseStatus
+    def __init__(self):
+        """
+        The last good parse of every page of a listing. A page that can not be fetched or parsed is taken from here,
+        marked stale, so one bad page does not throw away the rest of the crawl.
+        """
+        self._pages = {}  # type: dict[str, (list[dict], list[str])]
+        self._read = set()  # type: set[str]  # Pages of the current crawl that were read, fresh or stale
+        self.stale = set()  # type: set[str]  # Pages of the current crawl taken from their snapshot
+        self.missing = set()  # type: set[str]  # Pages of the current crawl that failed without a snapshot
 
-    @release_status.setter
-    def release_status(self, value):
-        self._releaseStatus = value
+    def begin(self):
+        self._read = set()
+        self.stale = set()
+        self.missing = set()
 
-    @property
-    def name(self):
+    def store(self, url, figures, next_urls=()):
+        """
+        @param url: The page
+        @type url: str
+        @param figures: The figures parsed from it
+        @type figures: list[FigureData]
+        @param next_urls: The listing pages it led to
+        @type next_urls: list[str]
         """
-        Returns the name of the figure
+        self._read.add(url)
+        self._pages[url] = ([figure.to_record() for figure in figures], list(next_urls))
 
-        @return: Figure Name
-        @rtype: str
+    def fallback(self, decoder, url):
+        """
+        @param decoder: Decoder the figures are rebuilt with
+        @type decoder: Decoder
+        @param url: The page that could not be read
+        @type url: str
+        @return: The figures of the last good parse of the page, marked stale, and the pages it led to. None if the
+                 page was never read.
+        @rtype: (list[FigureData], list[str]) | None
         """
-        return self._name
+        if url not in self._pages:
+            self.missing.add(url)
+            return None
+        self._read.add(url)
+        self.stale.add(url)
+        records, next_urls = self._pages[url]
+        figures = [FigureData.from_record(decoder, record) for record in records]
+        for figure in figures:
+            figure.stale = True
+        return figures, list(next_urls)
+
+    def finish(self):
+        """
+        Drops the snapshots of pages the listing no longer has. Kept while pages are missing, as those may lead to them.
+        """
+        if not self.missing:
+            for url in set(self._pages) - self._read:
+                del self._pages[url]
 
-    @name.setter
-    def name(self, value):
+    def is_unknown(self, figure):
         """
-        @param value: the name of the figure
-        @type value: str
+        Whether a figure that is absent from the current crawl might only be absent because its page was not read.
+        @type figure: FigureData
+        @rtype: bool
         """
-        self._name = value.strip()
+        return bool(self.missing) and figure.search_url not in self._read
 
-    @property
-    def extended_name(self):
-        if self._extended_name is not None:
-            return self._extended_name
-        else:
-            return self.name
 
-    @extended_name.setter
-    def extended_name(self, value):
-        self._extended_name = value.strip()
+class Tombstones:
 
-    @property
-    def condition(self):
+    def __init__(self, ttl=3, history=500):
+        """
+        Figures that disappeared from a listing. Each one is kept for ttl scrapes in case it comes back, in which case
+        it is not new, and is deemed deleted after that. Expiries are kept in a min-heap, so a scrape only looks at the
+        tombstones that are due, and only the last history deleted figures are remembered.
+
+        @param ttl: Scrapes a figure must be missing before it is deemed deleted
+        @type ttl: int
+        @param history: Deleted figures to remember
+        @type history: int
         """
-        Returns the condition of the figure.
+        self.ttl = ttl
+        self.scrape = 0  # type: int  # Scrapes of the sub-site so far, the clock the expiries are measured in
+        self._tombstones = {}  # type: dict[str, (FigureData, int)]  # identity to the figure and its expiry
+        self._heap = []  # type: list[(int, int, str)]
+        self._counter = itertools.count()  # Keeps tombstones expiring in the same scrape in the order they were made
+        self._live = {}  # identity of each tombstone to the sequence number of its live heap entry
+        self.deleted = deque(maxlen=history)  # type: deque[FigureData]
+
+    def tick(self):
+        """
+        Advances the clock by one scrape. Called once per scrape, before the tombstones are touched.
+        """
+        self.scrape += 1
 
-        @return: a condition string defined in Decoder
-        @rtype: str
+    def bury(self, figure, misses=None):
+        """
+        Adds a tombstone for a figure that is missing from the current scrape.
+        @type figure: FigureData
+        @param misses: Scrapes, this one included, the figure may be missing before it is deleted. Defaults to ttl.
+        @type misses: int | None
+        """
+        if misses is None:
+            misses = self.ttl
+        expiry = self.scrape + misses
+        sequence = next(self._counter)
+        # An earlier tombstone of the same figure is superseded and skipped when it reaches the top of the heap.
+        self._live[figure.identity] = sequence
+        self._tombstones[figure.identity] = (figure, expiry)
+        heapq.heappush(self._heap, (expiry, sequence, figure.identity))
+        figure.TTL = misses - 1
+
+    def resurrect(self, identity):
+        """
+        Removes the tombstone of a figure that is listed again.
+        @type identity: str
+        @return: The figure as it was last listed, or None if it has no tombstone
+        @rtype: FigureData | None
         """
-        return self._condition
+        self._live.pop(identity, None)
+        tombstone = self._tombstones.pop(identity, None)
+        return tombstone[0] if tombstone is not None else None
 
-    @condition.setter
-    def condition(self, value):
-        if self._condition is None:
-            self._condition = value
-        else:
-            raise ValueError("Can not change condition once condition has already been set.")
+    def _discard_stale(self):
+        while self._heap and self._live.get(self._heap[0][2]) != self._heap[0][1]:
+            heapq.heappop(self._heap)
 
-    @property
-    def search_url(self):
-        return self._search_url
+    def expire(self, keep=None):
+        """
+        Removes every tombstone that is due, moving its figure to the deleted history.
+        @param keep: Decides which due figures get another scrape instead, e.g. when their page could not be read.
+        @type keep: (FigureData) -> bool
+        @return: The figures that were deleted
+        @rtype: list[FigureData]
+        """
+        expired = []
+        kept = []
+        self._discard_stale()
+        while self._heap and self._heap[0][0] <= self.scrape:
+            _expiry, _sequence, identity = heapq.heappop(self._heap)
+            del self._live[identity]
+            figure, _expiry = self._tombstones.pop(identity)
+            if keep is not None and keep(figure):
+                kept.append(figure)
+            else:
+                figure.TTL = 0
+                self.deleted.append(figure)
+                expired.append(figure)
+            self._discard_stale()
+        for figure in kept:
+            self.bury(figure, 1)
+        return expired
 
-    @search_url.setter
-    def search_url(self, value):
-        self._search_url = value
+    def figures(self):
+        """
+        The figures that have a tombstone, with TTL set to the scrapes they may still be missing before being deleted.
+        @rtype: list[FigureData]
+        """
+        figures = []
+        for figure, expiry in self._tombstones.values():
+            figure.TTL = expiry - self.scrape - 1
+            figures.append(figure)
+        return figures
 
-    def get_extended_name(self):
-        self._decoder.get_extended_name(self)
+    def __contains__(self, identity):
+        return identity in self._tombstones
 
+    def __len__(self):
+        return len(self._tombstones)
 
-class Decoder:
-    jungle = 'jungle'
-    amiami = 'amiami'
-    amiami_preowned = 'amiami_preowned'
 
-    def __new__(cls, service, *arguments, **keyword):
-        for subclass in Decoder.__subclasses__():
-            if service.lower().startswith(subclass.service):
-                return super(cls, subclass).__new__(subclass)  # , *arguments)#, **keyword)
-        raise Exception('Website not supported not supported')
+def strtobool(value):
+    """
+    Reads a boolean as distutils.util.strtobool did, without importing distutils, which pulls in setuptools.
 
-    def _condition(self, value):
-        raise NotImplementedError
+    @param value: y, yes, t, true, on or 1 for True. n, no, f, false, off or 0 for False. Case is ignored.
+    @type value: str
+    @rtype: int
+    """
+    value = value.lower()
+    if value in ('y', 'yes', 't', 'true', 'on', '1'):
+        return 1
+    if value in ('n', 'no', 'f', 'false', 'off', '0'):
+        return 0
+    raise ValueError("invalid truth value {!r}".format(value))
 
-    def _get_next_page(self):
-        """
-        Scrapes the webpage for the next page URL and returns it if found. If it can not be found, return None
-        @return: Next Page URL or None
-        @rtype: str | None
-        """
-        raise NotImplementedError
 
-    def get_figures(self, html=None, _url=None, prototype_url=None):
-        raise NotImplementedError
+def parse_timedelta(duration_xml):
+    """
+    Reads a block of <days>, <hours>, <minutes> and <seconds> elements, as used by <frequency>.
 
-    def get_extended_name(self, _figure, override=False):
-        raise NotImplementedError
+    @param duration_xml: The element holding the duration
+    @type duration_xml: ElementTree | None
+    @return: The duration, or None if the block is missing or incomplete
+    @rtype: timedelta | None
+    """
+    try:
+        _days = int(duration_xml.find('days').text)
+        _hours = int(duration_xml.find('hours').text)
+        _minutes = int(duration_xml.find('minutes').text)
+        _seconds = int(duration_xml.find('seconds').text)
+    except AttributeError:
+        return None
+    except KeyError:
+        return None
 
+    return timedelta(days=_days, hours=_hours, minutes=_minutes, seconds=_seconds)
 
-class JungleDecoder(Decoder):
-    service = Decoder.jungle
-    conditionBase = "http://jungle-scs.co.jp/sale_en/wp-content/themes/jungle_2013en/images/"
-    conditionS = "conditionicon_s_en.gif"
-    conditionA = "conditionicon_a_en.gif"
-    conditionB = "conditionicon_b_en.gif"
-    conditionDecode = {conditionS: 'Sealed', conditionA: 'A', conditionB: 'B'}
 
-    def __new__(cls, service):
-        pass
+def load_config(uri="keys.yaml"):
+    import yaml
+    with open(uri, 'r') as stream:
+        try:
+            _config = yaml.load(stream)
+            return _config
+        except yaml.YAMLError:
+            logging.exception("Error loading yaml config")
 
-    def __init__(self, service):
-        self._log = logging.getLogger(self.__class__.__name__)
-        self._product_phtml = None
-        self._parsed_html = None  # type: BeautifulSoup
-        self._figures = []  # type: list[FigureData]
 
-    def _condition(self, value):
-        tmp = value[value.rindex('/') + 1:]
-        return self.conditionDecode[tmp]
+def save_figures(store, sub_site):
+    """
+    Writes the current figures of a sub-site to the state store.
+
+    @param store: The store to write to
+    @type store: StateStore
+    @param sub_site: The sub-site whose old_figures and tombstones are saved
+    @type sub_site: SubSiteData
+    @return: Number of rows written and number of rows deleted
+    @rtype: (int, int)
+    """
+    # Tombstones are told apart from listed figures by their TTL, which only they have counted down.
+    return store.save_figures(sub_site.key, [figure.to_record()
+                                             for figure in sub_site.old_figures + sub_site.tombstones.figures()])
 
-    def _get_next_page(self):
-        """
-        Scrapes the webpage for the next page URL and returns it if found. If it can not be found, return None
-        @return: Next Page URL or None
-        @rtype: str | None
-        """
-        if get_next_pages is False:
-            return None
-        paging_tags = self._parsed_html.find(id='paging')  #.find_all('span')  # type: list[tag]
 
-        if paging_tags is not None:
-            next_page_element = paging_tags.find('span', string='Next Page»') #_class='sp04_pl20')  #.find('a').get('href')
-            if next_page_element is not None:
-                next_page_url = next_page_element.find('a').get('href')
-                return next_page_url
+def load_figures(store, sub_site, service):
+    """
+    Reads the figures of a sub-site back from the state store.
+
+    @param store: The store to read from
+    @type store: StateStore
+    @param sub_site: The sub-site to load figures for
+    @type sub_site: SubSiteData
+    @param service: The website name, used to find the decoder for the figures
+    @type service: str
+    @rtype: list[FigureData]
+    """
+    decoder = Decoder(service)
+    return [FigureData.from_record(decoder, record) for record in store.load_figures(sub_site.key)]
 
-        return None
 
-    def get_figures(self, html=None, _url=None, prototype_url=None):
+def save_state(store, sub_site):
+    """
+    Writes the figures and schedule of a primed sub-site to the state store, so a restart can resume from it.
 
-        if html is not None and len(self._figures) < 1 and _url is not None:
+    @type store: StateStore
+    @type sub_site: SubSiteData
+    """
+    save_figures(store, sub_site)
+    next_run = sub_site.next_run.timestamp() if sub_site.next_run is not None else None
+    store.save_sub_site(sub_site.key, sub_site.identity, next_run=next_run, updated=time_p.time())
 
-            # Only parse if html is given and the figures array is empty
-            more_figures = True
-            next_page_url = None
-            current_page = 1
-            while more_figures:
-                self._parsed_html = BeautifulSoup(html, 'html.parser')
-                try:
-                    next_page_url = self._get_next_page()
-                    products_soup = self._parsed_html.find(id='products')
-                    # TODO: Find a better way of determining that there are no products on the page
-                    if products_soup is not None:
-                        products_soup = products_soup.find_all("li")
-                    else:
-                        break
-                    for figure_soup in products_soup:
-                        tempFig = FigureData(self, Decoder.jungle, html)  # type: FigureData
 
-                        tempFig.name = figure_soup.find(class_='wrapword').text  # type: str
+def restore_state(store, websites, prune=True):
+    """
+    Restores old_figures, TTLs and the next scheduled scrape of every configured sub-site from the state store.
+    Sub-sites whose stored identity does not match the configuration, and stored sub-sites that are no longer
+    configured, are discarded and will take a baseline scrape instead.
+
+    @type store: StateStore
+    @type websites: list[WebsiteData]
+    @param prune: Discard stored sub-sites that are not in websites. Disabled when the store is shared by shards.
+    @type prune: bool
+    @return: Number of sub-sites restored
+    @rtype: int
+    """
+    configured = set()
+    restored = 0
+    for site in websites:
+        if site.sub_sites is None:
+            continue
+        for sub_site in site.sub_sites:
+            configured.add(sub_site.key)
+            state = store.load_sub_site(sub_site.key)
+            if state is None:
+                continue
+            if state['identity'] != sub_site.identity:
+                logging.warning("Stored state of {} does not match sources.xml. Discarding it.".format(sub_site.key))
+                store.delete_sub_site(sub_site.key)
+                continue
+            try:
+                figures = load_figures(store, sub_site, site.website_name)
+            except Exception:
+                logging.error("Unable to restore the figures of {}".format(sub_site.key), exc_info=True)
+                store.delete_sub_site(sub_site.key)
+                continue
+            sub_site.old_figures = []
+            sub_site.tombstones = Tombstones()
+            for figure in figures:
+                if figure.TTL < sub_site.tombstones.ttl:
+                    sub_site.tombstones.bury(figure, figure.TTL + 1)
+                else:
+                    sub_site.old_figures.append(figure)
+            if state['next_run'] is not None:
+                sub_site.next_run = datetime.fromtimestamp(state['next_run'])
+            sub_site.primed = True
+            restored += 1
+            logging.info("Restored {} figures for {}".format(len(sub_site.old_figures), sub_site.key))
+
+    for key in store.sub_sites() if prune else []:
+        if key not in configured:
+            logging.info("Discarding stored state of {} as it is no longer configured.".format(key))
+            store.delete_sub_site(key)
+    return restored
+
 
-                        tempFig.price = figure_soup.find(class_="price").text
+class Scheduler:
 
-                        tempFig.pic_link = figure_soup.find('img')['src']
+    def __init__(self):
+        """
+        A priority queue of sub-sites ordered by the time they are next due to be scraped.
+        @return: None
+        @rtype: None
+        """
+        self._heap = []  # type: list[(datetime, int, WebsiteData, SubSiteData)]
+        self._counter = itertools.count()  # Keeps entries due at the same time in insertion order
+        self._queued = {}  # id of each queued sub-site to the sequence number of its live heap entry
+        self._changed = threading.Condition(threading.RLock())  # Notified whenever the schedule changes
 
-                        tempFig.condition = self._condition(figure_soup.find('p').find_all('img')[1]['src'])
+    def schedule(self, site, sub_site, due=None):
+        """
+        Queues a sub-site to be scraped at its due time.
+        @param site: The website the sub-site belongs to
+        @type site: WebsiteData
+        @type sub_site: SubSiteData
+        @param due: When the sub-site is due. Defaults to sub_site.next_run, or now if it has never been scheduled.
+        @type due: datetime | None
+        """
+        if due is None:
+            due = sub_site.next_run if sub_site.next_run is not None else datetime.now()
+        with self._changed:
+            sub_site.next_run = due
+            sequence = next(self._counter)
+            # An earlier entry of the same sub-site is superseded and skipped when it reaches the top of the heap.
+            self._queued[id(sub_site)] = sequence
+            heapq.heappush(self._heap, (due, sequence, site, sub_site))
+            self._changed.notify_all()
+
+    def remove(self, sub_site):
+        """
+        Stops scraping a sub-site.
+        @type sub_site: SubSiteData
+        """
+        with self._changed:
+            self._queued.pop(id(sub_site), None)
+            self._changed.notify_all()
 
-                        relURL = figure_soup.find('a').get('href')
-                        tempFig.link = urljoin(_url, relURL)
+    def wake(self):
+        """
+        Ends a wait() early, e.g. because the configuration changed or the checker is stopping.
+        """
+        with self._changed:
+            self._changed.notify_all()
 
-                        tempFig._search_url = _url
+    def wait(self, timeout=None):
+        """
+        Sleeps until the next sub-site is due, or until the schedule changes or wake() is called.
+        @param timeout: Seconds to sleep at most. None sleeps as long as it takes.
+        @type timeout: float | None
+        """
+        with self._changed:
+            next_deadline = self.next_deadline()
+            remaining = None if next_deadline is None else (next_deadline - datetime.now()).total_seconds()
+            if timeout is not None:
+                remaining = timeout if remaining is None else min(remaining, timeout)
+            if remaining is None or remaining > 0:
+                self._changed.wait(remaining)
+
+    def _discard_stale(self):
+        while self._heap and self._queued.get(id(self._heap[0][3])) != self._heap[0][1]:
+            heapq.heappop(self._heap)
+
+    def pop_due(self, now=None):
+        """
+        Removes and returns every sub-site that is due.
+        @param now: The time to compare against. Defaults to datetime.now()
+        @type now: datetime | None
+        @return: The due (website, sub-site) pairs, earliest first
+        @rtype: list[(WebsiteData, SubSiteData)]
+        """
+        if now is None:
+            now = datetime.now()
+        due = []
+        with self._changed:
+            self._discard_stale()
+            while self._heap and self._heap[0][0] <= now:
+                _due, _count, site, sub_site = heapq.heappop(self._heap)
+                del self._queued[id(sub_site)]
+                due.append((site, sub_site))
+                self._discard_stale()
+        return due
+
+    def next_deadline(self):
+        """
+        @return: When the next sub-site is due, or None if nothing is scheduled
+        @rtype: datetime | None
+        """
+        with self._changed:
+            self._discard_stale()
+            if self._heap:
+                return self._heap[0][0]
+            return None
 
-                        self._figures.append(tempFig)
+    def __len__(self):
+        return len(self._queued)
 
-                except Exception as e:
-                    print("Try Failed")
-                    print(e)
-                    print(traceback.format_exc())
 
-                if next_page_url is not None:
-                    # TODO: do not rely on outside function
-                    current_page += 1
-                    html = scrapeSite(next_page_url)
-                    sys.stdout.write('\x1b[K')  # Clear the line
-                    print("Retrieving page {}".format(current_page))
-                    sys.stdout.write('\x1b[1A')  # Move cursor up 2 lines
+class CycleExecutor:
 
-                    if html is None:  # if we can not get the web page (probably error), do not go to next page.
-                        more_figures = False
-                        self._log.error("Unable to retrieve the next page.")
-                else:
-                    more_figures = False
+    def __init__(self, per_host=1, max_workers=8):
+        """
+        Runs the sub-site crawls of a cycle concurrently across hosts, while keeping the requests to any one host
+        limited, so the cycle takes about as long as the slowest site instead of the sum of all of them.
+        @param per_host: How many sub-sites of the same host may be crawled at the same time
+        @type per_host: int
+        @param max_workers: Upper bound on the number of crawls running at once
+        @type max_workers: int
+        """
+        self._log = logging.getLogger(self.__class__.__name__)
+        self._per_host = max(1, per_host)
+        self._max_workers = max(1, max_workers)
 
-        return self._figures
+    @staticmethod
+    def host(site):
+        """
+        @type site: WebsiteData
+        @return: The host a website is served from
+        @rtype: str
+        """
+        host = urlparse(site.url).netloc.lower()
+        return host if host else site.website_name
 
-    def get_extended_name(self, _figure, override=False):
-        result = re.search(re.escape(r"..."), _figure.name)
-        if result is not None:
-            # The entire name is not given on this page. We need  the item page to get it.
-            self._log.debug("need to get extended name for " + _figure.name)
-            # TODO: Do not rely on outside function
-            item_html = scrapeSite(_figure.link)
-            if item_html is not None:
+    def run(self, due, function):
+        """
+        Calls function(site, sub_site) for every due sub-site. Sub-sites of the same host are split into at most
+        per_host lanes that are worked through in order.
+
+        @param due: The (website, sub-site) pairs to crawl
+        @type due: list[(WebsiteData, SubSiteData)]
+        @param function: The crawl to run for each pair
+        @type function: (WebsiteData, SubSiteData) -> object
+        @return: The result of each call in the order of due. A call that raised returns None.
+        @rtype: list
+        """
+        lanes = OrderedDict()
+        hosts = OrderedDict()
+        for index, (site, sub_site) in enumerate(due):
+            host = self.host(site)
+            lane = hosts.get(host, 0)
+            hosts[host] = (lane + 1) % self._per_host
+            lanes.setdefault((host, lane), []).append(index)
+
+        results = [None] * len(due)
+
+        def run_lane(indexes):
+            for index in indexes:
+                site, sub_site = due[index]
                 try:
-                    item_soup = BeautifulSoup(item_html, 'html.parser')
-                    # TODO: Consider returning the extended name and setting it in the figure so extended_name is read only
-                    _figure.extended_name = item_soup.find(class_="contentstitle").text
-                    self._log.debug("new Name: " + _figure.extended_name)
-                except:
-                    self._log.error("Unable to retrieve item detail page. Using truncated name.", exc_info=True)
-
-            else:
-                self._log.error("Unable to retrieve item detail page. Using truncated name.", exc_info=True)
+                    results[index] = function(site, sub_site)
+                except Exception:
+                    self._log.error("Crawling {} failed".format(sub_site.description), exc_info=True)
 
+        if len(lanes) <= 1:
+            for indexes in lanes.values():
+                run_lane(indexes)
+        else:
+            pool = Pool(processes=min(self._max_workers, len(lanes)))
+            pool.map(run_lane, list(lanes.values()))
+            pool.close()
+            pool.join()
+        return results
 
-class AmiAmiPreownedDecoder(Decoder):
-    service = Decoder.amiami_preowned
-    conditionBase = "http://amiami.co.jp"
-    conditionS = "conditionicon_s_en.gif"
-    conditionA = "conditionicon_a_en.gif"
-    conditionB = "conditionicon_b_en.gif"
-    conditionDecode = {conditionS: 'Sealed', conditionA: 'A', conditionB: 'B'}
 
-    def __new__(cls, service):
-        pass
+class ConfigWatcher:
 
-    def __init__(self, service):
-        self._log = logging.getLogger(self.__class__.__name__)
-        self._product_phtml = None
-        self._parsed_html = None
-        self._figures = []  # type: list[FigureData]
-        self._extended_name_figures = []  # type: list[FigureData]
-
-    def _condition(self, value):
-        # TODO: Standardise all _condition() functions
-        """
-        Deciphers the condition from the string passed to it. If the conditon is part of other pertinent data (such as
-        the Figure name) we will return it.
-        @param value: The string we need to get the condition from. (inside extended Name of figure)
-        @type value: str
-        @return: This version will return the name of the figure with the condition striped out.
-        @rtype: str
+    def __init__(self, uri='sources.xml'):
+        """
+        Notices when the configuration file changes on disk.
+        @param uri: Path of the configuration file
+        @type uri: str
         """
+        self._uri = uri
+        self._mtime = self._stat()
+        self._watching = None  # type: threading.Event  # Set to stop the thread started by watch()
 
-        #  (Pre-owned ITEM:A-/BOX:B)EX Cute Otogi no Kuni / Sleeping Beauty Lien Complete Doll(Released)
-        # r'\(Pre-owned ITEM:(\S+)\/BOx:(\S+)\)\b'
-        # extract the item condition and box condition
-        condition = None
-        extended_name = None
+    def _stat(self):
         try:
-            item_condition, box_condition = re.search(r'\(Pre-owned ITEM:(.*)\/.*?BOx:(.*)\)(?=.)', value, re.I).groups()
-            condition = ("Item : " + item_condition + " Box: " + box_condition)
-            extended_name = re.sub(r'\(Pre-owned ITEM:(.*)\/.*?BOx:(.*)\)(?=.)', '', value, flags=re.I)
-            return condition, extended_name
-        except:
-            self._log.error(traceback.format_exc())
-            return condition, extended_name
+            stat = os.stat(self._uri)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
 
-    def _get_next_page(self, html_soup=None):
+    def changed(self):
         """
-        Scrapes the webpage for the next page URL and returns it if found. If it can not be found, return None
-        @return: Next Page URL or None
-        @rtype: str | None
+        @return: True if the file changed since the last call
+        @rtype: bool
         """
-        if get_next_pages is False:
-            return None
-        product_tags = self._parsed_html.find(id='products')  # .find_all('span')  # type: list[tag]
-        if product_tags is not None:
-            next_page_element = product_tags.find('a', string='Next>>')  # _class='sp04_pl20')  #.find('a').get('href')
-            if next_page_element is not None:
-                next_page_url = next_page_element.get('href')
-                return next_page_url
-                # return None
-        return None
+        mtime = self._stat()
+        if mtime is None or mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        return True
 
-    def _get_pages(self, html_soup=None, prototype_url=None, results=False):
-        """
-        Scrapes the webpage for the all page urls and returns them if found. If they can not be found, return None
-        @return: Next Page URLs or None
-        @rtype: list[str] | None
-        """
-
-        if html_soup is not None:
-            product_tags = html_soup.find(id='products')  # .find_all('span')  # type: list[tag]
-            if product_tags is not None:
-                max_page_num = float("-inf")
-                for link in product_tags.find_all('a'):
-                    # TODO: Add Try/Except
-                    page_num = re.search(r'\[(\d{1,2})\]$', link.text)
-                    if page_num is not None:
-                        page_num = page_num.groups()[0]
-                        try:
-                            page_num = int(page_num)
-                            if page_num > max_page_num:
-                                max_page_num = page_num
-
-                        except ValueError:
-                            self._log.error("Unable to get URLs in parallel. Switching to sequence mode.")
-                            return None
-
-                urls = []
-                # Assume we already have page one.
-                for current_page in range(2, (max_page_num + 1)):
-                    page_url = re.sub(r'-~PAGENUMBER~-', str(current_page), prototype_url)
-                    urls.append(page_url)
-
-                return urls
-        return None
+    def watch(self, callback, interval=5.0):
+        """
+        Calls callback from a background thread whenever the file changes, so a checker sleeping until its next
+        deadline can pick the change up right away. Does not affect changed().
+        @param callback: Called without arguments
+        @type callback: () -> None
+        @param interval: Seconds between looks at the file
+        @type interval: float
+        """
+        self.unwatch()
+        stopping = self._watching = threading.Event()
 
-    def get_figures(self, html=None, _url=None, prototype_url=None):
-
-        if html is not None and len(self._figures) < 1 and _url is not None:
-            if prototype_url is not None:
-                return self.threaded_get_figures(html, _base_url=_url, prototype_url=prototype_url)
-
-            # TODO: I think the code below is broken.....
-            self._log.warning("Executing broken code!")
-            # Only parse if html is given and the figures array is empty
-            more_figures = True  # Flag indicating we still have more figs to parse
-            next_page_url = None  # Stores the URL for the next page. Needs to be initialized to None.
-            current_page = 1  # The current page number
-            got_multiple_pages = False  # Flag indicating whether we scraped one page or multiple pages
-
-            while True:
-                parsed_html = BeautifulSoup(html, 'html.parser')
-                next_page_url = self._get_next_page(parsed_html)
-
-                if next_page_url is not None:
-                    # TODO: do not rely on outside function
-                    current_page += 1
-                    sys.stdout.write('\x1b[K')  # Clear the line
-                    print("Retrieving page {}".format(current_page))
-                    sys.stdout.write('\x1b[1A')  # Move cursor up 2 lines
-                    try:
-                        html = scrapeSite(next_page_url)
-                    except requests.Timeout or requests.Timeout as e:
-                        self._log.error("Getting next Amiami pre-owned page Failed", exc_info=True)
-                        raise FigureDataCorrupt
-
-            while more_figures:
-                self._log.info("Parsing figures from page {0}.".format(current_page))
-                #  Pares the HTML into soup
-                try:
-                    # TODO: Get pages first so we can multi-thread retrieval of websites.
-                    next_page_url = self._get_next_page()
-                    products_soup = self._parsed_html.find_all(class_="product_box")
-                    # TODO: Find a better way of determining that there are no products on the page
-                    if products_soup is None:
-                        break
-
-                    for figure_soup in products_soup:
-                        tempFig = FigureData(self, Decoder.amiami_preowned, html)  # type: FigureData
-                        tempFig.condition = ""
-
-                        tmp = figure_soup.find(class_='product_name_list')
-                        tmp2 = tmp.find('a')
-                        tempFig.link = tmp2.get('href')
-                        tempFig.name = tmp2.text  # figure_soup.find(class_='product_name_list').text  # type: str
-
-                        if tempFig.name == "":  # Occasionally, amiami is missing product titles on the listing page
-                            self.get_extended_name(tempFig, override=True)
-
-                        tempPrice = figure_soup.find(class_="product_price").text.strip()
-
-                        try:
-                            tempPrice = re.search(r'\d{1,3}?,?\d{1,3}?,?\d{1,3} JPY', tempPrice)
-                            if tempPrice is not None:
-                                 tempFig.price = tempPrice.group(0)
-                            else:
-                                tempFig.price = " "
-                        except Exception as e:
-                            self._log.error('re search error: ', exc_info=True)
-
-                        tempFig.pic_link = figure_soup.find('img')['src']
-
-                        # The condition is not listed on the listing page, only the detail page.
-                        # To prevent hammering AmiAmi, we will get condition data only if the item is a match.
-
-                        tempFig._search_url = _url
-
-                        self._figures.append(tempFig)
-
-                # except requests.Timeout as e:
-
-                except Exception as e:
-                    self._log.error("Parsing Amiami pre-owned HTML Failed", exc_info=True)
-                    # return None
-                    raise FigureDataCorrupt
-
-                if next_page_url is not None:
-                    # TODO: do not rely on outside function
-                    current_page += 1
-                    sys.stdout.write('\x1b[K')  # Clear the line
-                    print("Retrieving page {}".format(current_page))
-                    sys.stdout.write('\x1b[1A')  # Move cursor up 2 lines
-                    try:
-                        html = scrapeSite(next_page_url)
-                    except requests.Timeout or requests.Timeout as e:
-                        self._log.error("Getting next Amiami pre-owned page Failed", exc_info=True)
-
-                        raise FigureDataCorrupt
-                        # return None
-
-                    got_multiple_pages = True
-
-                    if html is None:  # if we can not get the web page (unknown reason), do not go to next page and invalidate results.
-                        more_figures = False
-                        self._log.error("Unable to retrieve the next page.")
-                        raise FigureDataCorrupt
-                        # return None
-                else:
-                    more_figures = False
-            if got_multiple_pages:
-                # sys.stdout.write('\x1b[K')  # Clear the line Retrieving page line
-                pass
-        return self._figures
+        def run():
+            last = self._stat()
+            while not stopping.wait(interval):
+                current = self._stat()
+                if current is not None and current != last:
+                    last = current
+                    callback()
 
-    def threaded_get_figures(self, html=None, prototype_url=None, _base_url=None):
+        threading.Thread(target=run, name="ConfigWatcher", daemon=True).start()
 
-        if html is not None and len(self._figures) < 1 and prototype_url is not None:
+    def unwatch(self):
+        if self._watching is not None:
+            self._watching.set()
+            self._watching = None
 
-            # Get all urls for pages to scrape
-            parsed_html = [BeautifulSoup(html, 'html.parser')]
-            urls = self._get_pages(html_soup=parsed_html[0], prototype_url=prototype_url)
-            sites_html = threaded_scrape(urls)
+    def load(self):
+        """
+        @return: The websites described by the configuration file
+        @rtype: list[WebsiteData]
+        """
+        return [WebsiteData(website_xml) for website_xml in ET.parse(self._uri).getroot()]
 
-            for site in sites_html:
-                try:
-                    parsed_html.append(BeautifulSoup(site, 'html.parser'))
-                except:
-                    self._log.error("parsing html failed.", exc_info=True)
-                    raise FigureDataCorrupt
-
-            # Only parse if html is given and the figures array is empty
-            # more_figures = True  # Flag indicating we still have more figs to parse
-            # next_page_url = None  # Stores the URL for the next page. Needs to be initialized to None.
-            # current_page = 1  # The current page number
-            # got_multiple_pages = False  # Flag indicating whether we scraped one page or multiple pages
-            #
-            # while True:
-            #     parsed_html = BeautifulSoup(html, 'html.parser')
-            #     next_page_url = self._get_next_page(parsed_html)
-            #
-            #     if next_page_url is not None:
-            #         # TODO: do not rely on outside function
-            #         current_page += 1
-            #         sys.stdout.write('\x1b[K')  # Clear the line
-            #         print("Retrieving page {}".format(current_page))
-            #         sys.stdout.write('\x1b[1A')  # Move cursor up 2 lines
-            #         try:
-            #             html = scrapeSite(next_page_url)
-            #         except requests.Timeout or requests.Timeout as e:
-            #             self._log.error("Getting next Amiami pre-owned page Failed", exc_info=True)
-            #             raise FigureDataCorrupt
-
-            # while more_figures:
-            for i, site in enumerate(parsed_html):
-                self._log.info("Parsing figures from page {0}.".format(i+1))
-                #  Pares the HTML into soup
-                try:
-                    products_soup = site.find_all(class_="product_box")
-                    # TODO: Find a better way of determining that there are no products on the page
-                    if products_soup is None:
-                        # break
-                        self._log.error("Parsing Amiami pre-owned HTML Failed", exc_info=True)
-                        raise FigureDataCorrupt
-                    for figure_soup in products_soup:
-                        tempFig = FigureData(self, Decoder.amiami_preowned, html)  # type: FigureData
-                        tempFig.condition = ""
-
-                        tmp = figure_soup.find(class_='product_name_list')
-                        tmp2 = tmp.find('a')
-                        tempFig.link = tmp2.get('href')
-                        tempFig.name = tmp2.text  # figure_soup.find(class_='product_name_list').text  # type: str
-
-                        if tempFig.name == "":  # Occasionally, amiami is missing product titles on the listing page
-                            # self.get_extended_name(tempFig, override=True)
-                            self._extended_name_figures.append(tempFig)
-                        tempPrice = figure_soup.find(class_="product_price").text.strip()
-
-                        try:
-                            tempPrice = re.search(r'\d{1,3}?,?\d{1,3}?,?\d{1,3} JPY', tempPrice)
-                            if tempPrice is not None:
-                                tempFig.price = tempPrice.group(0)
-                            else:
-                                tempFig.price = " "
-                        except Exception as e:
-                            self._log.error('re search error: ', exc_info=True)
-
-                        tempFig.pic_link = figure_soup.find('img')['src']
-
-                        # The condition is not listed on the listing page, only the detail page.
-                        # To prevent hammering AmiAmi, we will get condition data only if the item is a match.
-
-                        if i == 0:
-                            _url = _base_url
-                        else:
-                            _url = urls[i-1]
-
-                        tempFig._search_url = _url
-
-                        self._figures.append(tempFig)
-
-                # except requests.Timeout as e:
-
-                except Exception as e:
-                    self._log.error("Parsing Amiami pre-owned HTML Failed", exc_info=True)
-                    raise FigureDataCorrupt
-
-                # if next_page_url is not None:
-                #     # TODO: do not rely on outside function
-                #     current_page += 1
-                #     sys.stdout.write('\x1b[K')  # Clear the line
-                #     print("Retrieving page {}".format(current_page))
-                #     sys.stdout.write('\x1b[1A')  # Move cursor up 2 lines
-                #     try:
-                #         html = scrapeSite(next_page_url)
-                #     except requests.Timeout or requests.Timeout as e:
-                #         self._log.error("Getting next Amiami pre-owned page Failed", exc_info=True)
-                #
-                #         raise FigureDataCorrupt
-                #         # return None
-                #
-                #     got_multiple_pages = True
-                #
-                #     if html is None:  # if we can not get the web page (unknown reason), do not go to next page and invalidate results.
-                #         more_figures = False
-                #         self._log.error("Unable to retrieve the next page.")
-                #         raise FigureDataCorrupt
-                #         # return None
-                # else:
-                #     more_figures = False
-            # if got_multiple_pages:
-            #     # sys.stdout.write('\x1b[K')  # Clear the line Retrieving page line
-            #     pass
-        self.threaded_get_extended_names(self._extended_name_figures)
 
-        return self._figures
+def reload_websites(websites, new_websites, scheduler, store=None):
+    """
+    Merges a freshly parsed configuration into the running one.
+    Sub-sites whose configuration is unchanged are kept as they are. Changed sub-sites with the same identity are
+    rebuilt, taking over the scrape state of the old one, and new sub-sites start without a baseline. Removed
+    sub-sites are unscheduled and their stored state is dropped. A website that no longer loads keeps running with its
+    previous configuration, so a typo does not drop its state: only a website that loads without a sub-site removes it.
+
+    @param websites: The running configuration
+    @type websites: list[WebsiteData]
+    @param new_websites: The configuration that was just parsed
+    @type new_websites: list[WebsiteData]
+    @type scheduler: Scheduler
+    @param store: The state store, so state of removed sub-sites can be dropped
+    @type store: StateStore | None
+    @return: The configuration to run with from now on
+    @rtype: list[WebsiteData]
+    """
+    old_sub_sites = {}
+    for site in websites:
+        for sub_site in site.sub_sites or []:
+            old_sub_sites[sub_site.key] = (site, sub_site)
+
+    # Websites that failed to load are swapped for their running configuration. One that failed before its id was
+    # read could be any of them, so then every website not loaded anew is kept.
+    loaded_ids = set(site.id for site in new_websites if site.sub_sites is not None)
+    old_by_id = dict((site.id, site) for site in websites if site.sub_sites is not None)
+    failed = [site for site in new_websites if site.sub_sites is None]
+    if any(site.id is None for site in failed):
+        keep_ids = set(old_by_id) - loaded_ids
+    else:
+        keep_ids = set(site.id for site in failed if site.id in old_by_id and site.id not in loaded_ids)
+    merged = [site for site in new_websites if site.sub_sites is not None or site.id not in keep_ids]
+    for site_id in sorted(keep_ids):
+        logging.warning("Config reload: {} did not load, keeping its previous configuration".format(
+            old_by_id[site_id].website_name))
+        merged.append(old_by_id[site_id])
+
+    kept = set()
+    for site_id in keep_ids:
+        for sub_site in old_by_id[site_id].sub_sites:
+            kept.add(sub_site.key)
+    for site in new_websites:
+        if site.sub_sites is None:
+            continue
+        for index, sub_site in enumerate(site.sub_sites):
+            old_site, old_sub_site = old_sub_sites.get(sub_site.key, (None, None))
+            if old_sub_site is None or old_sub_site.identity != sub_site.identity or old_site.url != site.url:
+                logging.info("Config reload: {} is new".format(sub_site.key))
+                scheduler.schedule(site, sub_site, datetime.now())
+                continue
+
+            kept.add(sub_site.key)
+            scheduler.remove(old_sub_site)
+            if ET.tostring(old_sub_site.xml) == ET.tostring(sub_site.xml):
+                # Nothing changed, keep the old object along with its compiled matchers.
+                site.sub_sites[index] = old_sub_site
+                scheduler.schedule(site, old_sub_site, old_sub_site.next_run)
+                continue
+
+            logging.info("Config reload: {} changed".format(sub_site.key))
+            sub_site.adopt_state(old_sub_site)
+            due = sub_site.next_due()
+            if old_sub_site.next_run is not None and old_sub_site.next_run < due:
+                due = old_sub_site.next_run
+            scheduler.schedule(site, sub_site, due)
+
+    for key, (old_site, old_sub_site) in old_sub_sites.items():
+        if key not in kept:
+            logging.info("Config reload: {} was removed".format(key))
+            scheduler.remove(old_sub_site)
+            clusters.drop_group(key)
+            stock_index.remove(key)
+            if store is not None and key not in [sub_site.key for site in merged
+                                                 for sub_site in site.sub_sites or []]:
+                store.delete_sub_site(key)
+
+    return merged
+
+
+def run_job(job, sub_sites):
+    """
+    Does the work of one crawl job.
 
-    def threaded_get_extended_names(self, _figures):
-        self._log.info("Getting extended names for {} figures.".format(len(_figures)))
-        pool = Pool(processes=30)
-        args = []
-        for figure in _figures:
-            args.append([figure, True])
-        pool.starmap(self.get_extended_name, args)
-        pool.close()
-        pool.join()
-
-        self._log.info("Got extended names")
-
-    def get_extended_name(self, _figure, override=False):
-        result = None  # re.search(re.escape(r"..."), _figure.name)  # AMIAMI does not use shortened names.
-        if result is not None or override is True:
-            # The entire name is not given on this page. We need the item page to get it.
-            self._log.debug("Need to get extended name for " + _figure.name)
-            # TODO: Do not rely on outside function
-
-            item_html = scrapeSite(_figure.link)
-
-            if item_html is not None:
-                item_soup = BeautifulSoup(item_html, 'html.parser')
-                # TODO: Consider returning the extended name and setting it in the figure so extended_name is read only
-                try:
-                    tmp_extended_name = item_soup.find(class_="heading_10").contents[0]#.text
-                    # Remove (Released) from end of name
-                    _figure.extended_name = re.sub(r'\(Released\)', '', tmp_extended_name)  # This call is safe
-                    # TODO: I am setting the extended name here, but the condition in condition. Does this make sense?
-                    # Remove the condition data from the figure and store it in the figure.
+    @type job: Job
+    @param sub_sites: Sub-site key to its website and sub-site
+    @type sub_sites: dict[str, (WebsiteData, SubSiteData)]
+    @return: The result of the job and the jobs that follow from it
+    @rtype: (dict, list[Job])
+    """
+    site, sub_site = sub_sites[job.sub_site]
+    payload = job.payload
+    decoder = Decoder(site.website_name, get_next_pages=payload.get('get_next_pages', True))
 
-                    _figure._condition, _figure.extended_name = self._condition(_figure.extended_name)
+    if job.kind == Job.listing:
+        if payload.get('local') is not None:
+            html = open(payload['local'], 'r', encoding='UTF8').read()
+        else:
+            html = Decoding.scrapeSite(payload['url'])
+        if html is None:
+            raise FigureDataCorrupt("Unable to retrieve " + payload['url'])
+        figures, next_urls = decoder.parse_page(html, payload['url'], payload.get('prototype_url'))
+        follow_ups = [Job(Job.listing, job.sub_site, job.crawl,
+                          {'url': url, 'page': payload['page'] + 1 + index,
+                           'get_next_pages': payload.get('get_next_pages', True)})
+                      for index, url in enumerate(next_urls)]
+        return {'page': payload['page'], 'figures': [figure.to_record() for figure in figures]}, follow_ups
+
+    if job.kind == Job.detail:
+        figures = [FigureData.from_record(decoder, record) for record in payload['figures']]
+        fetch_details(figures)
+        return {'figures': [[figure.identity, figure.extended_name, figure.condition] for figure in figures]}, []
+
+    if job.kind == Job.match:
+        matches = []
+        for record in payload['figures']:
+            search_data, reported_confidence, match_type = sub_site.match_name(FigureData.from_record(decoder, record))
+            index = sub_site.figure_search_data.index(search_data) if search_data is not None else None
+            matches.append([record['extended_name'] or record['name'], index, reported_confidence, match_type])
+        return {'watchlist_hash': sub_site.watchlist_hash, 'matches': matches}, []
+
+    raise ValueError("Unknown job kind " + job.kind)
+
+
+def sub_sites_by_key(websites):
+    """
+    @rtype: dict[str, (WebsiteData, SubSiteData)]
+    """
+    return {sub_site.key: (site, sub_site) for site in websites for sub_site in site.sub_sites or []}
 
-                    self._log.debug("New Name: " + _figure.extended_name)
-                except Exception as e:
-                    self._log.error("Unable to retrieve item detail page. Using truncated name.", exc_info=True)
-            else:
-                self._log.error("Unable to retrieve item detail page. Using truncated name.", exc_info=True)
-            # We need to extract the condition data from the name.
 
-    def get_condition(self, _figure):
-        #  Condition data is held in the extended name
-        self.get_extended_name(_figure, override=True)
+def work_job(job_queue, sub_sites, worker, lease_seconds=120.0):
+    """
+    Leases one job and does it.
+
+    @type job_queue: JobQueue
+    @type sub_sites: dict[str, (WebsiteData, SubSiteData)]
+    @param worker: Name of this worker
+    @type worker: str
+    @return: False if there was no job to do
+    @rtype: bool
+    """
+    job = job_queue.lease(worker, lease_seconds)
+    if job is None:
+        return False
+    try:
+        result, follow_ups = run_job(job, sub_sites)
+    except Exception as error:
+        logging.warning("{} job of {} failed: {!r}".format(job.kind, job.sub_site, error))
+        job_queue.fail(job, repr(error))
+        return True
+    for follow_up in follow_ups:
+        job_queue.put(follow_up)
+    if not job_queue.complete(job, result):
+        logging.info("{} job of {} was already completed elsewhere".format(job.kind, job.sub_site))
+    return True
+
 
-        # add figure to list, so we can multi-thread the details.
-        # self._extended_name_figures.append(_figure)
+def work_jobs(job_queue, config_uri='sources.xml', worker=None, stopping=None, idle=1.0):
+    """
+    Runs a crawl worker: does jobs from the queue until stopping is set. The configuration is read to know the
+    sub-sites the jobs refer to, and reloaded whenever it changes.
+
+    @type job_queue: JobQueue
+    @type config_uri: str
+    @param worker: Name of this worker. Defaults to the host name and pid.
+    @type worker: str | None
+    @type stopping: threading.Event | None
+    @param idle: Seconds to wait when there is no job
+    @type idle: float
+    """
+    if worker is None:
+        worker = "{}:{}".format(socket.gethostname(), os.getpid())
+    if stopping is None:
+        stopping = threading.Event()
+    config_watcher = ConfigWatcher(config_uri)
+    sub_sites = sub_sites_by_key(config_watcher.load())
+    while not stopping.is_set():
+        if config_watcher.changed():
+            sub_sites = sub_sites_by_key(config_watcher.load())
+        if not work_job(job_queue, sub_sites, worker):
+            stopping.wait(idle)
+
+
+class QueuedCrawl:
+
+    def __init__(self, job_queue, timeout=600.0, poll=0.25, help_out=True):
+        """
+        Crawls sub-sites through a job queue instead of in process, so the fetching can be spread across workers on
+        other machines. Results come back as plain records, and only the first result of a job is kept, so a job that
+        was done twice does not duplicate anything.
+
+        @type job_queue: JobQueue
+        @param timeout: Seconds a crawl may take before it is given up as corrupt
+        @type timeout: float
+        @param poll: Seconds between checks on outstanding jobs
+        @type poll: float
+        @param help_out: Do queued jobs while waiting, so crawls finish without any separate worker
+        @type help_out: bool
+        """
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.job_queue = job_queue
+        self._timeout = timeout
+        self._poll = poll
+        self._help_out = help_out
+        self._worker = "coordinator:{}".format(os.getpid())
+        self.sub_sites = {}  # type: dict[str, (WebsiteData, SubSiteData)]
+
+    def _wait(self, job):
+        """
+        Queues a job and waits until it and every job that follows from it are done or failed.
+        @rtype: list[Job]
+        """
+        self.job_queue.put(job)
+        deadline = time_p.monotonic() + self._timeout
+        while True:
+            jobs = self.job_queue.jobs(job.sub_site, job.crawl)
+            if all(queued.state in (Job.done, Job.failed) for queued in jobs):
+                return jobs
+            if time_p.monotonic() > deadline:
+                raise FigureDataCorrupt("Crawl {} of {} timed out".format(job.crawl, job.sub_site))
+            if not (self._help_out and work_job(self.job_queue, self.sub_sites, self._worker)):
+                time_p.sleep(self._poll)
+
+    def listing(self, site, sub_site, get_next_pages=True):
+        """
+        @return: The id of the crawl and the figures of every listing page
+        @rtype: (str, list[FigureData])
+        """
+        self.sub_sites[sub_site.key] = (site, sub_site)
+        crawl = uuid.uuid4().hex
+        jobs = self._wait(Job(Job.listing, sub_site.key, crawl, {
+            'url': site.url + sub_site.url,
+            'local': sub_site.local_uri,
+            'page': 1,
+            'prototype_url': site.url + sub_site._proto_url if sub_site._proto_url is not None else None,
+            'get_next_pages': get_next_pages}))
+        failed = [job for job in jobs if job.state == Job.failed]
+        if failed:
+            self.job_queue.purge(sub_site.key, crawl)
+            raise FigureDataCorrupt("{} listing pages of {} failed: {}".format(len(failed), sub_site.key,
+                                                                               failed[0].error))
+
+        # Each page has exactly one result, however often its job was done, so the pages are simply put in order.
+        decoder = Decoder(site.website_name)
+        figures = []
+        for job in sorted(jobs, key=lambda job: job.result['page']):
+            figures.extend(FigureData.from_record(decoder, record) for record in job.result['figures'])
+        return crawl, figures
+
+    def details(self, site, sub_site, crawl, figures):
+        """
+        Fetches the detail pages of a batch of figures in one job and fills in their extended names and conditions.
+        @type figures: list[FigureData]
+        """
+        if not figures:
+            return
+        try:
+            jobs = self._wait(Job(Job.detail, sub_site.key, crawl, {'figures': [figure.to_record() for figure in figures]}))
+        except FigureDataCorrupt:
+            self._log.warning("Detail job of {} timed out".format(sub_site.key))
+            return
+        # Keyed by identity, as copies of a figure in different conditions are listed under the same name.
+        details = {}
+        for job in jobs:
+            if job.kind == Job.detail and job.state == Job.done:
+                details.update((identity, (extended_name, condition))
+                               for identity, extended_name, condition in job.result['figures'])
+        for figure in figures:
+            if figure.identity in details:
+                extended_name, condition = details[figure.identity]
+                if extended_name and extended_name != figure.name:
+                    figure.extended_name = extended_name
+                if condition is not None:
+                    figure._condition = condition
+
+    def matches(self, site, sub_site, crawl, figures):
+        """
+        Matches a batch of figures in one job and stores the decisions in the match cache, where
+        SubSiteData.match picks them up.
+        @type figures: list[FigureData]
+        """
+        if not figures:
+            return
+        try:
+            jobs = self._wait(Job(Job.match, sub_site.key, crawl, {'figures': [figure.to_record() for figure in figures]}))
+        except FigureDataCorrupt:
+            self._log.warning("Match job of {} timed out".format(sub_site.key))
+            return
+        for job in jobs:
+            # Decisions made against another version of the watchlist are of no use.
+            if job.kind == Job.match and job.state == Job.done and \
+                    job.result['watchlist_hash'] == sub_site.watchlist_hash:
+                for name, index, reported_confidence, match_type in job.result['matches']:
+                    match_cache.put(name, sub_site.watchlist_hash, (index, reported_confidence, match_type))
+
+    def finish(self, sub_site, crawl):
+        self.job_queue.purge(sub_site.key, crawl)
+
+
+def fetch_details(figures, processes=8):
+    """
+    Reads the detail pages of a batch of figures concurrently, filling in their extended names and conditions.
+    @type figures: list[FigureData]
+    @param processes: Most detail pages fetched at once
+    @type processes: int
+    """
+    if not figures:
+        return
 
+    def fetch(figure):
+        figure.get_extended_name()
+        figure.get_condition()
 
-class FigureDataCorrupt(Exception):
-    pass
+    pool = Pool(processes=max(1, min(processes, len(figures))))
+    pool.map(fetch, figures)
+    pool.close()
+    pool.join()
 
 
-def threaded_scrape(urls, max_retries=10, fake=False):
+def enrich_figures(site, sub_site, figures, crawl=None, crawl_id=None, users=None):
     """
-    A threaded version of scrape site.
-    @param urls:
-    @type urls: list[str]
-    @param max_retries:
-    @type max_retries: int
-    @return: list[str | None | requests.Response]
+    Reads the detail pages of only the new figures that matter. The listing data of each figure is matched against the
+    watchlist, and the watchlists of the users, first. Only the figures that match, and those whose listing name is too
+    incomplete to match at all, have their detail pages fetched, concurrently in one batch. Every other figure keeps
+    its listing data.
+
+    @type site: WebsiteData
+    @type sub_site: SubSiteData
+    @param figures: The new figures
+    @type figures: list[FigureData]
+    @param crawl: Crawls through a job queue. None fetches in this process.
+    @type crawl: QueuedCrawl | None
+    @param crawl_id: The crawl the figures were listed by
+    @type crawl_id: str | None
+    @param users: The watchlists of the users of keys.yaml. None only matches the watchlist of the sub-site.
+    @type users: UserWatchlists | None
+    @return: The figures whose detail pages were fetched
+    @rtype: list[FigureData]
     """
-    if fake is not True:
-        print("Scraping {} more pages.".format(len(urls)))
-        pool = Pool(processes=8)
-        sites = pool.map(scrapeSite, urls)
-        for site in sites:
-            if site is None:
-                logging.error("Unable to retrieve the next page.")
-                pool.close()
-                pool.join()
-                raise FigureDataCorrupt
-        pool.close()
-        pool.join()
-        return sites
-
+    if crawl is not None:
+        # The listing level decisions are made by a match job, and picked up from the match cache below.
+        crawl.matches(site, sub_site, crawl_id, [figure for figure in figures if not figure.needs_details])
+    selected = [figure for figure in figures if figure.needs_details or sub_site.match(figure)[0] is not None or
+                (users is not None and users.matches(figure, sub_site.match_confidence))]
+    if selected:
+        logging.info("Fetching details of {} of {} new figures from {}".format(len(selected), len(figures),
+                                                                              sub_site.description))
+    if crawl is not None:
+        crawl.details(site, sub_site, crawl_id, selected)
     else:
-        sites = []
-        for url in urls:
-            site = scrapeSite(url, retry=max_retries)
-            if site is None:
-                logging.error("Unable to retrieve the next page.")
-                raise FigureDataCorrupt
-            sites.append(site)
-        return sites
+        fetch_details(selected)
+    return selected
 
 
-def scrapeSite(_url, use_progress_bar=False, retry=10):
+def diff_figures(sub_site):
     """
-    Safely retrieves and returns a website using passed URL.
-    If error occurs during retrieval, None will be returned instead
-
-    @param _url: The URL of the website that will be scraped
-    @type _url: str
-    @param retry: Indicates How many retries are left. Starts at 10 by default.
-    @type retry: int
-    @return: website html if successful, otherwise None
-    @rtype: str | None | requests.Response
+    Compares the figures of a scrape against the baseline of a sub-site. New figures are added to discovered_figures.
+    Figures that disappeared get a tombstone, and are deleted once it expires unless they are listed again before.
+
+    @type sub_site: SubSiteData
+    @return: Number of baseline figures that disappeared in this scrape. That is every figure no longer on the pages
+             that were read: sold out ones, but also ones that only moved out of view, e.g. past the last page read.
+             Figures on pages that could not be read are not counted.
+    @rtype: int
     """
-
-    logging.debug("Scraping " + _url)
+    removed_count = 0
+    tombstones = sub_site.tombstones
+    tombstones.tick()
+    sub_site.price_changes = []
+    logging.info("{} figures scraped, {} figures in DB, {} missing".format(len(sub_site.figures),
+                                                                           len(sub_site.old_figures), len(tombstones)))
+    # New Figure Detection
+    old_figures = {}
+    for oldFigure in sub_site.old_figures:
+        old_figures[oldFigure.identity] = oldFigure
+    listed = set()
+    for figure in sub_site.figures:
+        listed.add(figure.identity)
+        oldFigure = old_figures.get(figure.identity)
+        if oldFigure is None and not figure.stale:
+            oldFigure = tombstones.resurrect(figure.identity)
+            if oldFigure is not None:
+                logging.info("Figure: {} @ {} is listed again".format(figure.name, sub_site.description))
+
+        if oldFigure is not None:
+            figure.first_seen = oldFigure.first_seen
+            if figure.price_value is not None and oldFigure.price_value is not None and \
+                    figure.price_value != oldFigure.price_value and not figure.stale:
+                sub_site.price_changes.append((figure, oldFigure))
+        elif not figure.stale:
+            sub_site.discovered_figures.append(figure)
+
+    # Deleted Figure Detection
+    for oldFigure in sub_site.old_figures:
+        if oldFigure.identity in listed:
+            continue
+
+        if sub_site.page_snapshots.is_unknown(oldFigure):
+            # Its page could not be read, so whether it is still listed is unknown. Keep it as it is.
+            sub_site.figures.append(oldFigure)
+            logging.info("Figure: {} @ {} is on a page that could not be read".format(oldFigure.name,
+                                                                                     sub_site.description))
+            continue
+
+        removed_count += 1
+        tombstones.bury(oldFigure)
+        logging.warning("Figure: {} @ {} is missing. TTL: {}".format(oldFigure.name, sub_site.description,
+                                                                    oldFigure.TTL))
+
+    for oldFigure in tombstones.expire(keep=sub_site.page_snapshots.is_unknown):
+        sub_site.unindex_price(oldFigure.identity)
+        logging.info("Figure: {} @ {} was deleted.".format(oldFigure.name, sub_site.description))
+
+    return removed_count
+
+
+def scrape_sub_site(site, sub_site, count, observation_log, get_next_pages=True, crawl=None,
+                    max_buffered_bytes=Decoder.max_buffered_bytes, users=None):
+    """
+    Scrapes a sub-site and compares the result against the previous scrape, filling discovered_figures.
+
+    @param site: The website the sub-site belongs to
+    @type site: WebsiteData
+    @type sub_site: SubSiteData
+    @param count: The scrape number, for display
+    @type count: int
+    @param observation_log: Log the scraped listing is appended to. None keeps no log.
+    @type observation_log: ObservationLog | None
+    @param get_next_pages: Follow the paging links of the listing. False only reads the first page.
+    @type get_next_pages: bool
+    @param crawl: Crawls through a job queue. None fetches and parses in this process.
+    @type crawl: QueuedCrawl | None
+    @param max_buffered_bytes: Most page html held while the listing is fetched and parsed
+    @type max_buffered_bytes: int
+    @param users: The watchlists of the users of keys.yaml, so the details of the figures they match are read too
+    @type users: UserWatchlists | None
+    @return: True if the sub-site was scraped, False if the figure data was corrupt
+    @rtype: bool
+    """
+    url = site.url + sub_site.url
+
+    sys.stdout.write('\x1b[1A')  # Move cursor up 1 lines
+    sys.stdout.write('\x1b[K')  # Clear the line
+    print("Scraping " + sub_site.description + "... Scrape# " + str(count))
+    logging.info("Scraping " + sub_site.description + "... Scrape# " + str(count))
+
+    timings = {}
+    crawl_id = None
+    stage_start = time_p.time()
+    if crawl is not None:
+        pass  # The pages are fetched by the listing jobs.
+    elif sub_site.local_uri is not None:
+        sub_site.website_html = open(sub_site.local_uri, 'r', encoding='UTF8').read()
+    else:
+        sub_site.website_html = Decoding.scrapeSite(url)
+    timings['fetch'] = time_p.time() - stage_start
+    stage_seconds.observe(timings['fetch'], stage="fetch", sub_site=sub_site.key)
+    sub_site.discovered_figures = []  # Clear the array
     try:
-        website = requests.get(_url)
-    except requests.Timeout as e:
-        website = None
-        if retry > 0:
-            logging.warning("Retry #{}".format(11 - retry))
-            time_p.sleep(0.25 * (11 - retry))
-            retry_scrape = scrapeSite(_url, retry=(retry - 1))
-            try:
-                data = retry_scrape.text
-            except:
-                data = retry_scrape
-            return data
+        # TODO: call sub_site.figures = Decoder(service).get_figures(site.website_name, sub_site.website_html, url)
+        # sub_site.figures = Figures(site.website_name, sub_site.website_html, url).figures
+        stage_start = time_p.time()
+        if crawl is not None:
+            crawl_id, sub_site.figures = crawl.listing(site, sub_site, get_next_pages)
         else:
-            logging.error(traceback.format_exc())
-            raise requests.Timeout
-    except Exception as error:
-        website = None
-        # printTKMSG("Uncaught Exception in scrapePlex", traceback.format_exc())
-
-        if retry > 0:
-            logging.warning("Retry #{}".format(11 - retry))
-            time_p.sleep(0.33 * (11 - retry))
-            retry_scrape = scrapeSite(_url, retry=(retry - 1))
-            try:
-                data = retry_scrape.text
-            except:
-                data = retry_scrape
-            return data
-        else:
-            logging.error(traceback.format_exc())
-            raise requests.RequestException
-
-    if website is not None:
-        website_data = website.text
-    else:
-        website_data = None
-
-    return website_data
+            proto_url = site.url + sub_site._proto_url if sub_site._proto_url is not None else None
+            decoder = Decoder(site.website_name, get_next_pages=get_next_pages, max_buffered_bytes=max_buffered_bytes,
+                              snapshots=sub_site.page_snapshots)
+            sub_site.page_snapshots.begin()
+            sub_site.figures = decoder.get_figures(sub_site.website_html, url, prototype_url=proto_url)
+            sub_site.page_snapshots.finish()
+            if sub_site.page_snapshots.stale:
+                # Figures that moved from a stale page to a fresh one are only kept where they were seen fresh.
+                fresh = set(figure.identity for figure in sub_site.figures if not figure.stale)
+                sub_site.figures = [figure for figure in sub_site.figures
+                                    if not figure.stale or figure.identity not in fresh]
+        timings['get_figures'] = time_p.time() - stage_start
+        stage_seconds.observe(timings['get_figures'], stage="get_figures", sub_site=sub_site.key)
+        if observation_log is not None:
+            observation_log.append(sub_site.key,
+                                   [[figure.name, figure.price, figure.condition]
+                                    for figure in sub_site.figures],
+                                   timings)
+    except FigureDataCorrupt:
+        sub_site_failures.inc(sub_site=sub_site.key)
+        if observation_log is not None:
+            observation_log.append(sub_site.key, [], timings, error="FigureDataCorrupt")
+        logging.warning("Figure data is corrupt for {}".format(sub_site.description))
+        if not sub_site.primed:
+            logging.error("Figure data was corrupt for the baseline of {}. Retrying next cycle."
+                          .format(sub_site.description))
+        return False
+
+    listing_hash = hashlib.sha1()
+    for figure in sub_site.figures:
+        listing_hash.update("{}\0{}\0".format(figure.name, figure.price).encode('UTF-8'))
+    listing_changed = sub_site.listing_hash is not None and sub_site.listing_hash != listing_hash.hexdigest()
+    sub_site.listing_hash = listing_hash.hexdigest()
+    removed_count = 0
+    diff_start = time_p.perf_counter()
+    extended_name_seconds = 0.0
+
+    if sub_site.primed:  # if we have a baseline, Search for different figures.
+        removed_count = diff_figures(sub_site)
+
+    if len(sub_site.discovered_figures) > 50:
+        #  Some sort of failure has occurred as a massive number of figures were just detected
+        # TODO: Work out a more robust method of detecting / avoiding this bug. OR JUST FIX IT!
+        logging.error("Too many new figures detected on {}. # of new figs: {}.".format(
+                sub_site.description, len(sub_site.discovered_figures)))
+        sub_site.discovered_figures = []
+    extended_name_start = time_p.perf_counter()
+    enriched = enrich_figures(site, sub_site, sub_site.discovered_figures, crawl, crawl_id, users)
+    extended_name_seconds += time_p.perf_counter() - extended_name_start
+    if crawl is not None:
+        # Detail pages can change the names the figures are matched by.
+        crawl.matches(site, sub_site, crawl_id, enriched)
+        crawl.finish(sub_site, crawl_id)
+    clusters.sync(sub_site.key, dict((figure.identity, (figure.extended_name, offer_of(sub_site, figure)))
+                                     for figure in sub_site.figures if not figure.stale))
+    figure_clusters.set(len(clusters))
+    stock_index.update(sub_site.key, listing_rows(site, sub_site, sub_site.figures))
+    stage_seconds.observe(time_p.perf_counter() - diff_start - extended_name_seconds,
+                          stage="diff", sub_site=sub_site.key)
+    stage_seconds.observe(extended_name_seconds, stage="extended_name", sub_site=sub_site.key)
+    sub_site_figures.set(len(sub_site.figures), sub_site=sub_site.key)
+    sub_site_discovered.set(len(sub_site.discovered_figures), sub_site=sub_site.key)
+    sub_site_last_scrape.set(time_p.time(), sub_site=sub_site.key)
+    if sub_site.primed and sub_site.adaptive is not None:
+        sub_site.adaptive.observe(len(sub_site.discovered_figures), removed_count, listing_changed)
+    sub_site.old_figures[:] = sub_site.figures[:]
+    sub_site.primed = True  # The arrays have been pre-loaded. Enable scanning.
+    return True
+
+
+def listing_rows(site, sub_site, figures):
+    """
+    @return: The figures as the query server returns them
+    @rtype: list[dict]
+    """
+    rows = []
+    for figure in figures:
+        row = figure.to_record()
+        del row['ttl'], row['search_url'], row['extended_name']
+        row.update(name=figure.extended_name, site=site.website_name, sub_site=sub_site.key,
+                   description=sub_site.description, stale=figure.stale)
+        rows.append(row)
+    return rows
 
 
-def load_config(uri="keys.yaml"):
-    import yaml
-    with open(uri, 'r') as stream:
-        try:
-            _config = yaml.load(stream)
-            return _config
-        except yaml.YAMLError:
-            logging.exception("Error loading yaml config")
+def offer_of(sub_site, figure):
+    """
+    @return: What the clusters keep of a listing, to show it next to the other listings of the same figure
+    @rtype: (str, str, str)
+    """
+    return sub_site.description, figure.link, figure.price
 
 
-def save_figures(figures, base_uri="pickled_figs"):
+def other_offers(sub_site, figure):
     """
-
-    @param figures:
-    @type figures: list[FigureData]
-    @param base_uri:
-    @return:
+    @return: The listings of the same figure on the other sub-sites, as html to append to an alert. Empty if none.
+    @rtype: str
     """
-    uri_postfix = figures[0]._service
-    uri = base_uri + uri_postfix + ".pickle"
-    with open(uri, 'wb') as handle:
-        pickle.dump(figures, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    offers = clusters.offers((sub_site.key, figure.identity))
+    if not offers:
+        return ""
+    return " Also at: " + ", ".join('<a href="' + link + '">' + description + '</a> ' + price
+                                    for description, link, price in sorted(offers))
 
 
-def load_figures(service, base_uri="pickled_figs"):
-    uri_postfix = service
-    uri = base_uri + uri_postfix + ".pickle"
-    with open(uri, 'rb') as handle:
-        figures = pickle.load(handle)
-    return figures
+def report_sub_site(site, sub_site, dispatcher, dedup=None, users=None):
+    """
+    Matches the discovered figures of a sub-site against its watchlist and queues the alerts.
+
+    @param site: The website the sub-site belongs to
+    @type site: WebsiteData
+    @type sub_site: SubSiteData
+    @param dispatcher: The dispatcher that sends the alerts. None only returns them.
+    @type dispatcher: NotificationDispatcher | None
+    @param dedup: Suppresses alerts that were already sent recently. None sends everything.
+    @type dedup: AlertDedup | None
+    @param users: The watchlists of the users of keys.yaml, alerted through the destinations named after them. None
+                  only alerts on the watchlist of the sub-site.
+    @type users: UserWatchlists | None
+    @return: The notifications that were queued
+    @rtype: list[Notification]
+    """
+    queued = []
+    found_fig_count = 0
+    ignored_new_figures = []
+    safeURL = urljoin(site.url, sub_site.url)
+    window = sub_site.suppression_window.total_seconds() if sub_site.suppression_window is not None else None
+
+    def is_repeat(_figure, entry):
+        if dedup is None:
+            return False
+        product = _figure.link if _figure.link else _figure.name
+        return not dedup.check(product, entry, _figure.price, _figure.condition, window=window)
+
+    def alerts_of(_figure, entry):
+        # Recorded by the dedup once the notification was actually sent
+        product = _figure.link if _figure.link else _figure.name
+        return [AlertDedup.key(product, entry, _figure.price, _figure.condition)]
+
+    if not sub_site.prices_indexed:
+        # Once, so price drops of figures listed before the checker started are caught as well.
+        for figure in sub_site.old_figures:
+            sub_site.index_price(figure)
+        sub_site.prices_indexed = True
+
+    for figure, previous in sub_site.price_changes:
+        # Only figures that match a watchlist entry are in its price index.
+        index = sub_site.watched_entry(figure.identity)
+        if index is None:
+            continue
+        sub_site.price_indexes[index].update(figure.identity, figure.price_value)
+        search_data = sub_site.figure_search_data[index]
+        if figure.price_value >= previous.price_value or not search_data.accepts(figure)[0]:
+            continue
+        if is_repeat(figure, search_data.name):
+            continue
+        tmp_msg = '<a href="' + figure.link + '">' + figure.extended_name + '</a>' + \
+                  " dropped from " + previous.price + " to " + figure.price
+        if sub_site.matched_reporting == "individually":
+            queued.append(Notification(
+                title="Price Drop at {}".format(sub_site.description),
+                message=tmp_msg + " Condition: " + str(figure.condition or "") + other_offers(sub_site, figure),
+                html=True,
+                alerts=alerts_of(figure, search_data.name),
+                url=figure.pic_link,
+                url_title="Picture",
+                priority=1
+                ))
+        elif sub_site.matched_reporting == "group":
+            queued.append(Notification(
+                title="Price Drops at {}".format(sub_site.description),
+                message=tmp_msg,
+                html=True,
+                alerts=alerts_of(figure, search_data.name),
+                priority=-1,
+                url=safeURL,
+                url_title=sub_site.description,
+                group=sub_site.key + "/price_drop"
+                ))
+        logging.warning("Price drop of {} against {}: {}".format(figure.extended_name, search_data.name, tmp_msg))
+
+    for figure in sub_site.discovered_figures:
+        sub_site.index_price(figure)
+        search_data, reported_confidence, match_type = sub_site.match(figure)
+        fig_found = search_data is not None
+        if fig_found:
+            found_fig_count += 1
+            if is_repeat(figure, search_data.name):
+                continue
+            if sub_site.matched_reporting == "individually":
+                queued.append(Notification(
+                    title="New Figure From {} Available".format(sub_site.description),
+                    message='<a href="' + figure.link + '">' + figure.extended_name + '</a>' +
+                            " in stock. Price: " + str(figure.price or "") +
+                            " Condition: " + str(figure.condition or "") + other_offers(sub_site, figure),
+                    html=True,
+                    alerts=alerts_of(figure, search_data.name),
+                    url=figure.pic_link,
+                    url_title="Picture",
+                    priority=2
+                    ))
+
+                logging.warning("Matched figure {} using {} with {} % confidence against {}.".format(
+                    figure.extended_name, match_type, reported_confidence, search_data.fuzzy_search))
+
+            elif sub_site.matched_reporting == "group":
+                tmp_msg = "" + '<a href="' + figure.link + '">' + figure.extended_name + '</a>'
+                queued.append(Notification(
+                    title="New Matched Figures From {} Available!".format(sub_site.description),
+                    message=tmp_msg,
+                    html=True,
+                    alerts=alerts_of(figure, search_data.name),
+                    priority=-1,
+                    url=safeURL,
+                    url_title=sub_site.description,
+                    group=sub_site.key + "/matched"
+                    ))
+                logging.warning(tmp_msg)
+
+        if not fig_found:
+            ignored_new_figures.append(figure)
+
+    if len(sub_site.discovered_figures) > 0:
+        logging.warning(str(len(sub_site.discovered_figures) - found_fig_count) +
+                        " Other New Figures From {} Detected.".format(sub_site.description))
+        if sub_site.unmatched_reporting == 'group':
+            for figure in ignored_new_figures:
+                if is_repeat(figure, None):
+                    continue
+                tmp_msg = "" + '<a href="' + figure.link + '">' + figure.extended_name + '</a>'
+                queued.append(Notification(
+                    title="New Figures Available from {} that did not match the search criteria"
+                        .format(sub_site.description),
+                    message=tmp_msg,
+                    html=True,
+                    alerts=alerts_of(figure, None),
+                    priority=-1,
+                    url=safeURL,
+                    url_title=sub_site.description,
+                    group=sub_site.key + "/unmatched"
+                    ))
+                logging.warning(tmp_msg)
+        elif sub_site.unmatched_reporting == 'individually':
+            pass
 
+    if users is not None:
+        for figure, previous in sub_site.price_changes:
+            if figure.price_value >= previous.price_value:
+                continue
+            for user, search_data, reported_confidence, match_type in users.matches(figure, sub_site.match_confidence):
+                if not search_data.accepts(figure)[0] or is_repeat(figure, user + "/" + search_data.name):
+                    continue
+                tmp_msg = '<a href="' + figure.link + '">' + figure.extended_name + '</a>' + \
+                          " dropped from " + previous.price + " to " + figure.price
+                if sub_site.matched_reporting == "individually":
+                    queued.append(Notification(
+                        title="Price Drop at {}".format(sub_site.description),
+                        message=tmp_msg + " Condition: " + str(figure.condition or "") +
+                                other_offers(sub_site, figure),
+                        destination=user,
+                        html=True,
+                        alerts=alerts_of(figure, user + "/" + search_data.name),
+                        url=figure.pic_link,
+                        url_title="Picture",
+                        priority=1
+                        ))
+                elif sub_site.matched_reporting == "group":
+                    queued.append(Notification(
+                        title="Price Drops at {}".format(sub_site.description),
+                        message=tmp_msg,
+                        destination=user,
+                        html=True,
+                        alerts=alerts_of(figure, user + "/" + search_data.name),
+                        priority=-1,
+                        url=safeURL,
+                        url_title=sub_site.description,
+                        group=sub_site.key + "/price_drop"
+                        ))
+                logging.warning("Price drop of {} for {} against {}: {}".format(figure.extended_name, user,
+                                                                               search_data.name, tmp_msg))
+
+        for figure in sub_site.discovered_figures:
+            for user, search_data, reported_confidence, match_type in users.matches(figure, sub_site.match_confidence):
+                if not search_data.accepts(figure)[0] or is_repeat(figure, user + "/" + search_data.name):
+                    continue
+                if sub_site.matched_reporting == "individually":
+                    queued.append(Notification(
+                        title="New Figure From {} Available".format(sub_site.description),
+                        message='<a href="' + figure.link + '">' + figure.extended_name + '</a>' +
+                                " in stock. Price: " + str(figure.price or "") +
+                                " Condition: " + str(figure.condition or "") + other_offers(sub_site, figure),
+                        destination=user,
+                        html=True,
+                        alerts=alerts_of(figure, user + "/" + search_data.name),
+                        url=figure.pic_link,
+                        url_title="Picture",
+                        priority=2
+                        ))
+                elif sub_site.matched_reporting == "group":
+                    queued.append(Notification(
+                        title="New Matched Figures From {} Available!".format(sub_site.description),
+                        message='<a href="' + figure.link + '">' + figure.extended_name + '</a>',
+                        destination=user,
+                        html=True,
+                        alerts=alerts_of(figure, user + "/" + search_data.name),
+                        priority=-1,
+                        url=safeURL,
+                        url_title=sub_site.description,
+                        group=sub_site.key + "/matched"
+                        ))
+                logging.warning("Matched figure {} for {} using {} with {} % confidence against {}.".format(
+                    figure.extended_name, user, match_type, reported_confidence, search_data.name))
+
+    if dispatcher is not None:
+        for notification in queued:
+            dispatcher.enqueue(notification)
+    return queued
+
+
+class SubSiteResult:
+
+    def __init__(self, site, sub_site, scraped, notifications):
+        """
+        What one cycle did with a sub-site.
+
+        @type site: WebsiteData
+        @type sub_site: SubSiteData
+        @param scraped: False if the crawl failed and the sub-site was left as it was
+        @type scraped: bool
+        @param notifications: The alerts queued for the sub-site
+        @type notifications: list[Notification]
+        """
+        self.key = sub_site.key  # type: str
+        self.description = sub_site.description  # type: str
+        self.website_name = site.website_name  # type: str
+        self.scraped = scraped
+        self.figure_count = len(sub_site.figures or [])  # type: int  # No figures until a crawl succeeded
+        self.discovered = list(sub_site.discovered_figures) if scraped else []  # type: list[FigureData]
+        self.notifications = notifications
+        self.next_run = sub_site.next_run  # type: datetime
 
-if __name__ == '__main__':
-    firstRun = True  # Switch to false to prevent pre-loading of history arrays
-    get_next_pages = True  # Disable scraping the next page
-    init()  # Init colorama
-    logging.basicConfig(format="[%(asctime)s] %(name)s: %(funcName)s:%(lineno)d %(levelname)s: %(message)s", filename='StockChecker.log', level=logging.INFO)  #
-    # logging.basicConfig(format="[%(asctime)s] %(name)s: %(funcName)s:%(lineno)d %(levelname)s: %(message)s",
-    #                     level=logging.INFO)  #
 
-    logging.getLogger("requests").setLevel(logging.WARNING)
-    logging.info("StockChecker.py has started")
-    push_keys = load_config()
-    push_app = Application(push_keys["AppKey"])
-    push_User = push_app.get_user(push_keys["UserKey"])
+class CycleResult:
 
-    tree = ET.parse('sources.xml')
-    xmlData = tree.getroot()
-    websites = []  # type: list [WebsiteData]
+    def __init__(self, cycle, started):
+        """
+        What one run of StockChecker.run_once did.
 
-    old_figures = []  # type: list[FigureData]
-    resume_freq = None
-    resume_time = None
+        @param cycle: Number of the cycle, or None if nothing was due
+        @type cycle: int | None
+        @param started: time.time() when the cycle started
+        @type started: float
+        """
+        self.cycle = cycle
+        self.started = started
+        self.finished = started  # type: float
+        self.sub_sites = []  # type: list[SubSiteResult]
 
-    running = True
-    count = 0
-    sleep_time = 0.13  # in minutes
-    # Parse XML Config
-    for website_xml in xmlData:
-        websites.append(WebsiteData(website_xml))
+    @property
+    def duration(self):
+        return self.finished - self.started
 
-    while running:
-        # Scrape all websites and convert them to Figures
-        # sys.stdout.write('\x1b[J')  # Clear the Screen
-        click.clear()  # Clear the Screen.
-        count += 1
+    @property
+    def discovered(self):
+        """
+        @return: Every figure that was new in this cycle
+        @rtype: list[FigureData]
+        """
+        return [figure for result in self.sub_sites for figure in result.discovered]
 
-        for site in websites:
+    @property
+    def notifications(self):
+        """
+        @rtype: list[Notification]
+        """
+        return [notification for result in self.sub_sites for notification in result.notifications]
 
-            if site.sub_sites is not None:
-                for sub_site in site.sub_sites:
+    @property
+    def failed(self):
+        """
+        @return: Keys of the sub-sites whose crawl failed
+        @rtype: list[str]
+        """
+        return [result.key for result in self.sub_sites if not result.scraped]
 
-                    # TODO: We need to figure out a way of utilising the resume data from all subsites
-                    resume_freq = sub_site.frequency
-                    resume_time = sub_site.time
 
-                    url = site.url + sub_site.url
+class StockChecker:
 
-                    sys.stdout.write('\x1b[1A')  # Move cursor up 1 lines
-                    sys.stdout.write('\x1b[K')  # Clear the line
-                    print("Scraping " + sub_site.description + "... Scrape# " + str(count))
-                    logging.info("Scraping " + sub_site.description + "... Scrape# " + str(count))
+    def __init__(self, config_uri='sources.xml', dispatcher=None, state_store=None, observation_log=None,
+                 alert_dedup=None, profiler=None, per_host=1, get_next_pages=True, metrics_file=None,
+                 interactive=False, owns=None, job_queue=None, max_buffered_bytes=Decoder.max_buffered_bytes,
+                 user_watchlists=None):
+        """
+        The checker itself: owns the configuration, scrape state, crawl executor and notifier, and runs scrape cycles.
+        Everything but the configuration is optional, so cycles can be driven in-process, e.g. from benchmarks.
+
+        @param config_uri: Path of sources.xml. It is reloaded whenever it changes.
+        @type config_uri: str
+        @param dispatcher: Sends the alerts. Defaults to a dispatcher that keeps them in a StubTransport.
+        @type dispatcher: NotificationDispatcher | None
+        @param state_store: Persists the scrape state across restarts. None keeps it in memory only.
+        @type state_store: StateStore | None
+        @param observation_log: Records every scraped listing. None keeps no log.
+        @type observation_log: ObservationLog | None
+        @param alert_dedup: Suppresses repeated alerts. None sends every alert.
+        @type alert_dedup: AlertDedup | None
+        @param profiler: Profiles the first cycles. None profiles nothing.
+        @type profiler: CycleProfiler | None
+        @param per_host: Concurrent crawls allowed against one host
+        @type per_host: int
+        @param get_next_pages: Follow the paging links of listings. False only reads the first page of each.
+        @type get_next_pages: bool
+        @param metrics_file: File the metrics are written to after every cycle. None writes no file.
+        @type metrics_file: str | None
+        @param interactive: Clear the console and print a countdown, as the command line does
+        @type interactive: bool
+        @param owns: Decides by sub-site key which sub-sites this checker scrapes. None scrapes all of them.
+        @type owns: (str) -> bool
+        @param job_queue: Crawls through this queue, so workers elsewhere can do the fetching. None crawls in process.
+        @type job_queue: JobQueue | None
+        @param max_buffered_bytes: Most page html held while a listing is fetched and parsed
+        @type max_buffered_bytes: int
+        @param user_watchlists: The watchlists of further users, each alerted through the dispatcher destination named
+                                after them. None alerts on the watchlists of the sub-sites only.
+        @type user_watchlists: UserWatchlists | None
+        """
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.config_watcher = ConfigWatcher(config_uri)
+        if dispatcher is None:
+            dispatcher = NotificationDispatcher({"default": StubTransport()}).start()
+        self.dispatcher = dispatcher
+        self.state_store = state_store
+        self.observation_log = observation_log
+        self.alert_dedup = alert_dedup
+        if alert_dedup is not None and getattr(dispatcher, 'on_sent', False) is None:
+            dispatcher.on_sent = alert_dedup.sent  # Alerts only count as sent once they were
+        self.profiler = profiler if profiler is not None else CycleProfiler(0)
+        self.scheduler = Scheduler()
+        self.executor = CycleExecutor(per_host=per_host)
+        self.get_next_pages = get_next_pages
+        self.metrics_file = metrics_file
+        self.interactive = interactive
+        self.owns = owns
+        self.crawl = QueuedCrawl(job_queue) if job_queue is not None else None
+        self.max_buffered_bytes = max_buffered_bytes
+        self.user_watchlists = user_watchlists
+        self.websites = []  # type: list[WebsiteData]
+        self.count = 0  # type: int
+        self._started = False
+        self._running = False
+
+    @classmethod
+    def from_keys(cls, keys, config_uri='sources.xml', **keyword):
+        """
+        Builds a checker from the settings in keys.yaml, sending alerts through Pushover to the user of keys.yaml and
+        to each of its Users.
 
-                    if sub_site.local_uri is not None:
-                        sub_site.website_html = open(sub_site.local_uri, 'r', encoding='UTF8').read()
-                    else:
-                        sub_site.website_html = scrapeSite(url)
-                    try:
-                        # TODO: call sub_site.figures = Decoder(service).get_figures(site.website_name, sub_site.website_html, url)
-                        # sub_site.figures = Figures(site.website_name, sub_site.website_html, url).figures
-                        proto_url = site.url + sub_site._proto_url if sub_site._proto_url is not None else None
-                        sub_site.figures = Decoder(site.website_name).get_figures(sub_site.website_html, url, prototype_url=proto_url)
-                        sub_site.discovered_figures = []  # Clear the array
-                    except FigureDataCorrupt:
-                        logging.warning("Figure data is corrupt for {}".format(sub_site.description))
-                        if firstRun:
-                            raise RuntimeError(
-                                    "FATAL ERROR: Figure data was corrupt on the first run. Can not continue.")
-                        continue  # continue on with the next subsite
-                    if firstRun is False:  # if this is not the first time running, Search for different figures.
-                        # print("Number of figures: " + str(len(figures)))
-                        logging.info("{} figures scraped, {} figures in DB".format(len(sub_site.figures), len(sub_site.old_figures)))
-                        # New Figure Detection
-                        for i, figure in enumerate(sub_site.figures):
-                            figNew = True
-                            logging.debug("Processing New fig detection. Fig {}".format(i))
-                            for j, oldFigure in enumerate(sub_site.old_figures):
-                                if oldFigure.name == figure.name:
-                                    figNew = False
-
-                            if figNew:
-                                figure.get_extended_name()
-                                sub_site.discovered_figures.append(figure)
-                                # for del_fig in sub_site.deleted_figures:
-                                #     if figure.name == del_fig.name:
-                                #         sub_site.deleted_figures.remove(del_fig)
-                                #         logging.info("Deleted Fig Readded: {} @ {}".format())
-
-                        # Deleted Figure Detection
-                        for i, oldFigure in enumerate(sub_site.old_figures):
-                            figDeleted = True
-                            logging.debug("Processing Del fig detection. Fig {}".format(i))
-                            for j, figure in enumerate(sub_site.figures):
-                                if oldFigure.name == figure.name:
-                                    figDeleted = False
-
-                            if figDeleted:
-
-                                if oldFigure.TTL > 0:
-                                    # only re-store the figure if the time to live has not reached 0
-                                    oldFigure.TTL -= 1
-                                    # add the figure to the figures list so it will be there to compare against next time.
-                                    sub_site.figures.append(oldFigure)
-                                    logging.warning("TTL Reduced: {}, Figure: {} @ {} ".format(oldFigure.TTL,
-                                                                                              oldFigure.name,
-                                                                                                sub_site.description))
-
-                                else:
-                                    logging.info("Figure: {} @ {} was deleted. TTL: {}".format(oldFigure.name,
-                                                                                               sub_site.description,
-                                                                                               oldFigure.TTL))
-
-                                    # Add it to deleted figures liat (not used yet.)
-                                    sub_site.deleted_figures.append(oldFigure)
-
-
-                                # logging.info("Figure " + figure.extended_name + " is new!")
-
-                            # if old_figures.count(figure) < 1:
-                            #     #  figure not found!!
-                            #     print("Figure " + figure.name + " is new!")
-
-                    if len(sub_site.discovered_figures) > 50:
-                        #  Some sort of failure has occurred as a massive number of figures were just detected
-                        # TODO: Work out a more robust method of detecting / avoiding this bug. OR JUST FIX IT!
-                        logging.error("Too many new figures detected on {}. # of new figs: {}.".format(
-                                sub_site.description, len(sub_site.discovered_figures)))
-                        sub_site.discovered_figures = []
-                    sub_site.old_figures[:] = sub_site.figures[:]
-
-        firstRun = False  # We have scraped once and the arrays have been pre-loaded. Flip firstRun flag to
-        #                   enable scanning.
-
-        # Send out alerts for new figures.
-        for site in websites:
+        @param keys: The loaded keys.yaml
+        @type keys: dict
+        @param keyword: Passed on to the constructor
+        @rtype: StockChecker
+        """
+        state_store = StateStore(keys.get("StateStore", "StockChecker.db"))
+        if keys.get("MetricsPort") is not None:
+            Metrics.MetricsServer(Metrics.registry, port=keys["MetricsPort"]).start()
+        if keys.get("QueryPort") is not None or keys.get("QuerySocket") is not None:
+            # Prices in queries are read as yen unless they name their currency, as the shops list them in yen.
+            currency = keys.get("QueryCurrency", "JPY")
+            QueryServer(stock_index, port=keys.get("QueryPort"), socket_path=keys.get("QuerySocket"),
+                        parse_price=lambda text: parse_price(text, currency)).start()
+        keyword.setdefault('dispatcher', NotificationDispatcher(pushover_transports(keys)).start())
+        keyword.setdefault('user_watchlists', load_user_watchlists(keys))
+        keyword.setdefault('state_store', state_store)
+        keyword.setdefault('observation_log', ObservationLog(keys.get("ObservationLog", "observations")))
+        keyword.setdefault('alert_dedup', AlertDedup(state_store,
+                                                     window=keys.get("AlertSuppressionHours", 24) * 60 * 60))
+        keyword.setdefault('per_host', keys.get("ConnectionsPerHost", 1))
+        keyword.setdefault('metrics_file', keys.get("MetricsFile", "StockChecker.prom"))
+        keyword.setdefault('max_buffered_bytes', keys.get("MaxBufferedPageBytes", Decoder.max_buffered_bytes))
+        return cls(config_uri, **keyword)
+
+    def _load(self):
+        """
+        @return: The configured websites, holding only the sub-sites this checker owns
+        @rtype: list[WebsiteData]
+        """
+        websites = self.config_watcher.load()
+        if self.owns is not None:
+            for site in websites:
+                if site.sub_sites is not None:
+                    site.sub_sites[:] = [sub_site for sub_site in site.sub_sites if self.owns(sub_site.key)]
+        return websites
+
+    def start(self):
+        """
+        Loads the configuration, resumes from the stored state and schedules every sub-site.
+        Called by run_once if it has not been called yet.
+        """
+        self.websites = self._load()
+        if self.state_store is not None:
+            # Resume from the state of the last run, so detection is live from the first cycle.
+            restore_state(self.state_store, self.websites, prune=self.owns is None)
+        for site in self.websites:
             if site.sub_sites is not None:
                 for sub_site in site.sub_sites:
-                    found_fig_count = 0
-                    ignored_new_figures = []
-
-                    push_msgs = []
-                    num_of_msgs = 0
-                    push_msgs.append('')
-                    for figure in sub_site.discovered_figures:
-                        fig_found = False
-
-                        for search_data in sub_site.figure_search_data:
-                            fig_found, reported_confidence, match_type = search_data.search(figure, sub_site.match_confidence)
-
-                            if not fig_found and reported_confidence > (sub_site.match_confidence - 20):
-                                logging.info("Confidence: {} using {} for {}".
-                                             format(reported_confidence, match_type, figure.extended_name))
-                            if fig_found:
-                                found_fig_count += 1
-                                if sub_site.matched_reporting == "individually":
-                                    message = push_User.send_message(
-                                        title="New Figure From {} Available".format(sub_site.description),
-                                        message='<a href="' + figure.link + '">' + figure.extended_name + '</a>' +
-                                                " in stock. Price: " + figure.price + " Condition: " + figure.condition,
-                                        html=True,
-                                        url=figure.pic_link,
-                                        url_title="Picture",
-                                        priority=2
-                                        )
-
-                                    logging.warning("Matched figure {} using {} with {} % confidence against {}.".format(
-                                        figure.extended_name, match_type, reported_confidence, search_data.fuzzy_search))
-
-                                elif sub_site.matched_reporting == "group":
-                                    tmp_msg = "" + '<a href="' + figure.link + '">' + figure.extended_name + '</a>' + "\n"
-                                    if (len(push_msgs[num_of_msgs]) + len(tmp_msg)) > 1023:
-                                        num_of_msgs += 1
-                                        push_msgs.append('')
-
-                                    push_msgs[num_of_msgs] += tmp_msg
-
-                                break  # No need to keep trying to match the figure
-                        if not fig_found:
-                            ignored_new_figures.append(figure)
-
-                    if sub_site.matched_reporting == "group":
-                        try:
-                            for msg in push_msgs:
-                                safeURL = urljoin(site.url, sub_site.url)
-                                message = push_User.send_message(
-                                    title="New Matched Figures From {} Available!".format(sub_site.description),
-                                    message=msg,
-                                    html=True,
-                                    priority=-1,
-                                    url=safeURL.encode(encoding='UTF-8', errors='strict'),
-                                    url_title=sub_site.description,
-                                    )
-                                logging.warning(msg)
-                        except:
-                            pass
-
-                    if len(sub_site.discovered_figures) > 0:
-                        logging.warning(str(len(sub_site.discovered_figures) - found_fig_count) +
-                                        " Other New Figures From {} Detected.".format(sub_site.description))
-                        if sub_site.unmatched_reporting == 'group':
-                            push_msgs = []
-                            num_of_msgs = 0
-                            push_msgs.append('')
-                            for figure in ignored_new_figures:
-
-                                tmp_msg = "" + '<a href="' + figure.link + '">' + figure.extended_name + '</a>' + "\n"
-                                if (len(push_msgs[num_of_msgs]) + len(tmp_msg)) > 1023:
-                                    num_of_msgs += 1
-                                    push_msgs.append('')
-
-                                push_msgs[num_of_msgs] += tmp_msg
-
-                            for msg in push_msgs:
-                                try:
-                                    safeURL = urljoin(site.url, sub_site.url)
-                                    message = push_User.send_message(
-                                        title="New Figures Available from {} that did not match the search criteria"
-                                            .format(sub_site.description),
-                                        message=msg,
-                                        html=True,
-                                        priority=-1,
-                                        url=safeURL.encode(encoding='UTF-8', errors='strict'),
-                                        url_title=sub_site.description,
-                                        )
-                                    logging.warning(msg)
-
-                                except:
-                                    pass
-                        elif sub_site.unmatched_reporting == 'individually':
-                            pass
-
-        # print("sleeping")
-        # time_p.sleep(1)
-        # sys.stdout.write('\x1b[K')  # Clear the line
-        # iterable = range(int(sleep_time * 60 * 1000))
-        # with click.progressbar(iterable) as bar:
-        #     for i in bar:  # wait 5 seconds before next request to avoid hammering web servers.
-        #         time.sleep(0.001)
-        # sys.stdout.write('\x1b[2A')  # Move cursor up 2 lines
-
-        # We need to wait for a bit before the next series of requests to avoid hammering web servers.
-        if resume_time is None:
-            if resume_freq is not None:
-                resume_time = datetime.now() + resume_freq
-            else:
-                resume_time = datetime.now() + timedelta(minutes=sleep_time)
+                    if sub_site.primed:
+                        # Queries are answered from the restored listings until the first scrape.
+                        stock_index.update(sub_site.key, listing_rows(site, sub_site, sub_site.old_figures))
+                    self.scheduler.schedule(site, sub_site)
+        self._started = True
 
-        pause = True
-        while pause:
-            time_remaining = resume_time - datetime.now()
-            if time_remaining.total_seconds() < 0:
-                pause = False
-            else:
-                hours, remainder = divmod(time_remaining.total_seconds(), 60*60)
+    def reload(self):
+        """
+        Reloads the configuration if it changed on disk.
+        @return: True if a new configuration was loaded
+        @rtype: bool
+        """
+        if not self.config_watcher.changed():
+            return False
+        try:
+            self.websites = reload_websites(self.websites, self._load(), self.scheduler, self.state_store)
+        except ET.ParseError:
+            self._log.error("Unable to parse the configuration. Keeping the previous one.", exc_info=True)
+            return False
+        self._log.info("Reloaded the configuration")
+        return True
+
+    def run_once(self, now=None, force=False):
+        """
+        Runs one cycle: every sub-site that is due is scraped, its alerts are queued and it is rescheduled.
+
+        @param now: The time to compare the schedule against. Defaults to datetime.now()
+        @type now: datetime | None
+        @param force: Scrape every sub-site, whether it is due or not
+        @type force: bool
+        @rtype: CycleResult
+        """
+        if not self._started:
+            self.start()
+        else:
+            self.reload()
+
+        due = self.scheduler.pop_due(datetime.max if force else now)
+        if not due:
+            return CycleResult(None, time_p.time())
+
+        if self.interactive:
+            import click
+            click.clear()  # Clear the Screen.
+        self.count += 1
+        count = self.count
+        result = CycleResult(count, time_p.time())
+        if self.observation_log is not None:
+            self.observation_log.next_cycle()
+        self.profiler.start_cycle(count)
+
+        # Different hosts are crawled concurrently. Alerts are only sent once every crawl has finished.
+        scraped = self.executor.run(due, lambda site, sub_site: scrape_sub_site(
+            site, sub_site, count, self.observation_log, get_next_pages=self.get_next_pages, crawl=self.crawl,
+            max_buffered_bytes=self.max_buffered_bytes, users=self.user_watchlists))
+
+        for (site, sub_site), ok in zip(due, scraped):
+            notifications = []
+            if ok:
+                # Send out alerts for new figures.
+                try:
+                    with stage_seconds.time(stage="report", sub_site=sub_site.key):
+                        notifications = report_sub_site(site, sub_site, self.dispatcher, self.alert_dedup,
+                                                        self.user_watchlists)
+                except Exception:
+                    # One figure that can not be reported must not stop the other sub-sites, or the checker.
+                    self._log.error("Unable to report the figures of {}".format(sub_site.description), exc_info=True)
+
+            # Each sub-site waits for its own schedule before the next request to avoid hammering web servers.
+            self.scheduler.schedule(site, sub_site, sub_site.next_due())
+            sub_site_next_run.set(sub_site.next_run.timestamp(), sub_site=sub_site.key)
+            if sub_site.primed and self.state_store is not None:
+                try:
+                    save_state(self.state_store, sub_site)
+                except sqlite3.Error:
+                    self._log.error("Unable to save the state of {}".format(sub_site.description))
+            result.sub_sites.append(SubSiteResult(site, sub_site, ok, notifications))
+
+        if self.metrics_file:
+            Metrics.registry.write(self.metrics_file)
+        self.profiler.end_cycle()
+        result.finished = time_p.time()
+        return result
+
+    def wait(self, max_wait=None):
+        """
+        Sleeps until the next sub-site is due, the schedule changes or wake() is called, but no longer than max_wait
+        seconds.
+        @param max_wait: None sleeps as long as it takes
+        @type max_wait: float | None
+        """
+        next_deadline = self.scheduler.next_deadline()
+        time_remaining = (next_deadline - datetime.now()).total_seconds() if next_deadline is not None else None
+        if time_remaining is not None and time_remaining > 0:
+            if self.interactive:
+                hours, remainder = divmod(time_remaining, 60*60)
                 minutes, seconds = divmod(remainder, 60)
                 sys.stdout.write('\x1b[1A')  # Move cursor up 1 lines
                 sys.stdout.write('\x1b[K')  # Clear the line
                 print("{0:1.0f} Hours, {1:1.0f} Minutes, and {2:1.0f} Seconds left until the next update."
                       .format(hours, minutes, seconds))
-                time_p.sleep(10)
+        self.scheduler.wait(max_wait)
 
-    input("Press any key to exit")
+    def wake(self):
+        self.scheduler.wake()
 
+    def run_forever(self):
+        """
+        Runs cycles until stop() is called. Between cycles it sleeps until the next sub-site is due, waking early
+        when the configuration file changes.
+        """
+        self._running = True
+        # Nothing is scheduled while the configuration is empty, so without this a change would never be noticed.
+        self.config_watcher.watch(self.wake)
+        try:
+            while self._running:
+                self.run_once()
+                self.wait()
+        finally:
+            self.config_watcher.unwatch()
+
+    def stop(self):
+        self._running = False
+        self.wake()
+
+    def close(self, timeout=60):
+        """
+        Sends the alerts that are still queued and closes the stores.
+        @param timeout: Seconds to wait at most for the alerts
+        @type timeout: float
+        """
+        self.dispatcher.close(timeout=timeout)
+        if self.observation_log is not None:
+            self.observation_log.close()
+        if self.state_store is not None:
+            self.state_store.close()
+        if self.crawl is not None:
+            self.crawl.job_queue.close()
 
+
+if __name__ == '__main__':
+    # Worker processes import this module by name. Make sure they get this copy of it.
+    sys.modules.setdefault('StockChecker', sys.modules[__name__])
+
+    parser = argparse.ArgumentParser(description="Watches figure shops for new stock.")
+    parser.add_argument('--profile', type=int, default=0, metavar='N',
+                        help="profile the first N scrape cycles and write the results next to the log")
+    parser.add_argument('--profile-mode', choices=('sample', 'cprofile'), default='sample',
+                        help="sample all threads at a low overhead, or run cProfile on the main thread")
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help="shard the sub-sites across N worker processes sharing one state store")
+    parser.add_argument('--job-queue', metavar='URI',
+                        help="crawl through a job queue: a SQLite path or a redis:// broker address")
+    parser.add_argument('--job-worker', action='store_true',
+                        help="only do crawl jobs from --job-queue, e.g. on another machine")
+    args = parser.parse_args()
+
+    log_uri = 'StockChecker.log'
+    from colorama import init  # For console manipulation.
+    init()  # Init colorama
+    logging.basicConfig(format="[%(asctime)s] %(name)s: %(funcName)s:%(lineno)d %(levelname)s: %(message)s", filename=log_uri, level=logging.INFO)  #
+    # logging.basicConfig(format="[%(asctime)s] %(name)s: %(funcName)s:%(lineno)d %(levelname)s: %(message)s",
+    #                     level=logging.INFO)  #
+
+    logging.getLogger("requests").setLevel(logging.WARNING)
+    logging.info("StockChecker.py has started")
+    if args.job_worker:
+        if args.job_queue is None:
+            parser.error("--job-worker needs --job-queue")
+        job_queue = open_job_queue(args.job_queue)
+        try:
+            work_jobs(job_queue, 'sources.xml')
+        finally:
+            job_queue.close()
+        sys.exit(0)
+
+    if args.workers > 1:
+        from Sharding import ShardCoordinator
+        push_keys = load_config()
+        if push_keys.get("MetricsPort") is not None:
+            Metrics.MetricsServer(Metrics.registry, port=push_keys["MetricsPort"]).start()
+        dispatcher = NotificationDispatcher(pushover_transports(push_keys)).start()
+        coordinator = ShardCoordinator(args.workers, push_keys, dispatcher, 'sources.xml').start()
+        try:
+            coordinator.run_forever()
+        finally:
+            coordinator.stop()
+            dispatcher.close(timeout=60)
+        sys.exit(0)
+
+    checker = StockChecker.from_keys(load_config(), 'sources.xml', interactive=True,
+                                     job_queue=open_job_queue(args.job_queue) if args.job_queue else None,
+                                     profiler=CycleProfiler(args.profile, base_uri=os.path.splitext(log_uri)[0],
+                                                            mode=args.profile_mode))
+    try:
+        checker.run_forever()
+    finally:
+        checker.close(timeout=60)
+    input("Press any key to exit")
@@ -0,0 +1,69 @@
+"""
+Measures how long it takes to start the checker: importing StockChecker, and importing it plus creating the first
+decoder, which is when the parsing libraries get imported. Every measurement runs in a fresh interpreter.
+
+    python benchmarks/import_time.py --runs 15
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import statistics
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+heavy_modules = ('bs4', 'requests', 'fuzzywuzzy', 'chump', 'colorama', 'click', 'http.server', 'distutils')
+
+scenarios = [
+    ("import StockChecker", "import StockChecker"),
+    ("first Jungle decoder", "import StockChecker\nStockChecker.Decoder('Jungle')"),
+    ("first AmiAmi decoder", "import StockChecker\nStockChecker.Decoder('AmiAmi_preowned')"),
+]
+
+probe = """
+import sys, time, json
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'loaded': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure(code, runs):
+    """
+    @return: Seconds of every run, and the heavy modules loaded by the last one
+    @rtype: (list[float], list[str])
+    """
+    timings = []
+    loaded = []
+    env = dict(os.environ, PYTHONPATH=repo + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', probe.format(code=code, heavy=heavy_modules)], cwd=repo, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+        result = json.loads(output.decode('UTF-8').strip().splitlines()[-1])
+        timings.append(result['seconds'])
+        loaded = result['loaded']
+    return timings, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10, help="fresh interpreters per scenario")
+    parser.add_argument('--json', metavar='PATH', help="also write the results to a JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    print("{:<24} {:>10} {:>10}  {}".format("scenario", "median ms", "min ms", "heavy modules loaded"))
+    for name, code in scenarios:
+        timings, loaded = measure(code, args.runs)
+        results[name] = {'median': statistics.median(timings), 'min': min(timings), 'loaded': loaded}
+        print("{:<24} {:>10.1f} {:>10.1f}  {}".format(name, results[name]['median'] * 1000,
+                                                       results[name]['min'] * 1000, ", ".join(loaded) or "-"))
+    if args.json:
+        with open(args.json, 'w', encoding='UTF-8') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
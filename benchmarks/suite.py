@@ -0,0 +1,310 @@
+"""
+Benchmarks the hot paths of a scrape cycle offline, against the pages in test_pages and synthetic pages scaled up
+from them: listing extraction by each decoder, the new/deleted diff, watchlist matching and saving and loading
+figures in the state store. Reports throughput and peak memory, and compares them against a stored baseline.
+
+    python benchmarks/suite.py --save benchmarks/baseline.json
+    python benchmarks/suite.py --compare benchmarks/baseline.json
+
+A comparison run exits with status 1 if any benchmark got slower, or needs more memory, than the baseline allows.
+The baseline holds absolute timings from the machine it was saved on, so it is only meaningful on that machine: save
+a baseline of your own before comparing elsewhere, or raise --tolerance.
+"""
+import os
+import sys
+import copy
+import json
+import random
+import argparse
+import statistics
+import tracemalloc
+import xml.etree.ElementTree as ET
+from time import perf_counter
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+import Decoding  # noqa: E402
+from StockChecker import Decoder, SubSiteData, SearchParams, Tombstones  # noqa: E402
+from StockChecker import diff_figures, save_figures, load_figures  # noqa: E402
+from StateStore import StateStore  # noqa: E402
+
+pages = os.path.join(repo, 'test_pages')
+
+
+class Benchmark:
+
+    def __init__(self, name, setup, run, items):
+        """
+        @param name: Name in the report and the baseline
+        @type name: str
+        @param setup: Builds the input of one run. Not timed.
+        @type setup: () -> object
+        @param run: The code that is measured, given the input of setup
+        @type run: (object) -> None
+        @param items: Items one run processes, for the throughput
+        @type items: int
+        """
+        self.name = name
+        self.setup = setup
+        self.run = run
+        self.items = items
+
+    def measure(self, runs):
+        """
+        @return: Median and best seconds of a run, items per second and peak bytes allocated by a run
+        @rtype: dict
+        """
+        timings = []
+        for _ in range(runs):
+            argument = self.setup()
+            start = perf_counter()
+            self.run(argument)
+            timings.append(perf_counter() - start)
+
+        # Memory is traced in a run of its own, as tracing slows everything down.
+        argument = self.setup()
+        tracemalloc.start()
+        self.run(argument)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        median = statistics.median(timings)
+        return {'seconds': median, 'best': min(timings), 'items': self.items,
+                'per_second': self.items / median if median else 0.0, 'peak_bytes': peak}
+
+
+def read_page(name):
+    with open(os.path.join(pages, name), 'r', encoding='UTF8') as handle:
+        return handle.read()
+
+
+def scale_page(html, item_selector, name_selector, factor):
+    """
+    Builds a bigger listing from a real one by repeating its products under new names.
+
+    @param item_selector: CSS selector of one product of the listing
+    @param name_selector: CSS selector of the product name, within a product
+    @param factor: Times the products are repeated
+    @type factor: int
+    @rtype: str
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+    items = soup.select(item_selector)
+    for copy_number in range(1, factor):
+        for item in items:
+            clone = copy.copy(item)
+            name = clone.select_one(name_selector)
+            if name is not None and name.string is not None:
+                name.string.replace_with("{} #{}".format(name.string, copy_number))
+            items[-1].insert_after(clone)
+    return str(soup)
+
+
+def extraction(name, service, html, prototype_url=None):
+    url = "http://example.com/list"
+
+    def run(_):
+        figures = list(Decoder(service, get_next_pages=False).iter_figures(html, url, prototype_url))
+        assert figures, "{} extracted no figures".format(name)
+
+    items = len(list(Decoder(service, get_next_pages=False).iter_figures(html, url, prototype_url)))
+    return Benchmark(name, lambda: None, run, items)
+
+
+def listing_figures(size):
+    """
+    @return: A sub-site and the figures of a listing with about size figures, taken from the Jungle test pages
+    @rtype: (SubSiteData, list[Decoding.FigureData])
+    """
+    base = list(Decoder('Jungle', get_next_pages=False).iter_figures(read_page('JungleHero.html'), "http://e.com/"))
+    figures = []
+    while len(figures) < size:
+        for figure in base:
+            clone = copy.copy(figure)
+            clone.name = "{} #{}".format(figure.name, len(figures))
+            figures.append(clone)
+    sub_site = SubSiteData(ET.fromstring('<sub_site id="0" name="Benchmark"><url>/</url></sub_site>'), "Jungle")
+    return sub_site, figures[:size]
+
+
+def diff(size, churn=0.05):
+    """
+    The diff of a listing of size figures where a share of churn figures was replaced since the baseline.
+    """
+    sub_site, figures = listing_figures(size)
+    replaced = int(size * churn)
+    rng = random.Random(size)
+
+    def setup():
+        old = [copy.copy(figure) for figure in figures]
+        new = [copy.copy(figure) for figure in figures[replaced:]]
+        for index in range(replaced):
+            clone = copy.copy(figures[index])
+            clone.name = "New arrival {}".format(index)
+            new.append(clone)
+        rng.shuffle(new)
+        sub_site.old_figures = old
+        sub_site.figures = new
+        sub_site.discovered_figures = []
+        sub_site.tombstones = Tombstones()
+        return sub_site
+
+    def run(_sub_site):
+        diff_figures(_sub_site)
+        assert len(_sub_site.discovered_figures) == replaced
+
+    return Benchmark("diff {} figures".format(size), setup, run, size)
+
+
+def matching(figure_count, watchlist_size):
+    """
+    Every figure of a listing against a generated watchlist, without the match cache.
+    """
+    sub_site, figures = listing_figures(figure_count)
+    rng = random.Random(watchlist_size)
+    words = sorted(set(word for figure in figures for word in figure.name.split() if len(word) > 3))
+    watchlist = []
+    for index in range(watchlist_size):
+        entry = ET.Element('figure', name="Entry {}".format(index))
+        ET.SubElement(entry, 'search', dependence="mandatory").text = rng.choice(words)
+        for word in rng.sample(words, 2):
+            ET.SubElement(entry, 'search', dependence="optional").text = word
+        watchlist.append(SearchParams(entry))
+
+    def run(_):
+        for figure in figures:
+            for search_data in watchlist:
+                search_data.search(figure, sub_site.match_confidence)
+
+    return Benchmark("match {} figures x {} entries".format(figure_count, watchlist_size), lambda: None, run,
+                     figure_count * watchlist_size)
+
+
+def store(size, directory):
+    sub_site, figures = listing_figures(size)
+    path = os.path.join(directory, 'benchmark.db')
+
+    def setup():
+        for leftover in (path, path + '-wal', path + '-shm'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        sub_site.old_figures = figures
+        return StateStore(path)
+
+    def run_save(_store):
+        save_figures(_store, sub_site)
+        _store.close()
+
+    def setup_load():
+        _store = setup()
+        save_figures(_store, sub_site)
+        return _store
+
+    def run_load(_store):
+        assert len(load_figures(_store, sub_site, "Jungle")) == size
+        _store.close()
+
+    return [Benchmark("save {} figures".format(size), setup, run_save, size),
+            Benchmark("load {} figures".format(size), setup_load, run_load, size)]
+
+
+def benchmarks(directory):
+    """
+    @param directory: Scratch directory for the state store
+    @rtype: list[Benchmark]
+    """
+    jungle = read_page('JungleHero.html')
+    amiami = read_page('AmiAmi_preowned.html')
+    suite = [
+        extraction("extract Jungle nendoroids", 'Jungle', read_page('JungleNend.html')),
+        extraction("extract Jungle heroes", 'Jungle', jungle),
+        extraction("extract AmiAmi pre-owned", 'AmiAmi_preowned', amiami,
+                   "http://example.com/list?page=-~PAGENUMBER~-"),
+        extraction("extract Jungle heroes x10", 'Jungle', scale_page(jungle, '#products li', '.wrapword', 10)),
+        extraction("extract AmiAmi pre-owned x10", 'AmiAmi_preowned',
+                   scale_page(amiami, '.product_box', '.product_name_list a', 10),
+                   "http://example.com/list?page=-~PAGENUMBER~-"),
+        diff(500),
+        diff(2000),
+        matching(200, 50),
+    ]
+    suite.extend(store(5000, directory))
+    return suite
+
+
+def compare(results, baseline, tolerance):
+    """
+    @return: The regressions, one line each
+    @rtype: list[str]
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        # The best run is compared, as it is the one least disturbed by whatever else the machine is doing.
+        if result['best'] > before['best'] * (1 + tolerance):
+            regressions.append("{}: best {:.1f} ms, baseline {:.1f} ms".format(
+                name, result['best'] * 1000, before['best'] * 1000))
+        if result['peak_bytes'] > before['peak_bytes'] * (1 + tolerance):
+            regressions.append("{}: peak {:.0f} KiB, baseline {:.0f} KiB".format(
+                name, result['peak_bytes'] / 1024, before['peak_bytes'] / 1024))
+    return regressions
+
+
+def main():
+    import tempfile
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help="timed runs per benchmark")
+    parser.add_argument('--filter', metavar='TEXT', help="only run benchmarks whose name contains TEXT")
+    parser.add_argument('--save', metavar='PATH',
+                        help="write the results as the new baseline. With --filter, only those benchmarks are replaced")
+    parser.add_argument('--compare', metavar='PATH', help="fail if the results regressed against this baseline")
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help="how much slower, or bigger, than the baseline is still accepted (default 0.5)")
+    args = parser.parse_args()
+
+    # Nothing is fetched: detail pages the decoders ask for come back empty.
+    Decoding.scrapeSite = lambda *arguments, **keyword: None
+    import logging
+    import warnings
+    logging.disable(logging.CRITICAL)
+    warnings.simplefilter('ignore')
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        print("{:<34} {:>8} {:>10} {:>12} {:>10}".format("benchmark", "items", "median ms", "items/s", "peak KiB"))
+        for benchmark in benchmarks(directory):
+            if args.filter and args.filter not in benchmark.name:
+                continue
+            result = benchmark.measure(args.runs)
+            results[benchmark.name] = result
+            print("{:<34} {:>8} {:>10.1f} {:>12.0f} {:>10.0f}".format(
+                benchmark.name, result['items'], result['seconds'] * 1000, result['per_second'],
+                result['peak_bytes'] / 1024))
+
+    if args.save:
+        baseline = {}
+        if args.filter and os.path.exists(args.save):
+            # Only the benchmarks that ran are replaced.
+            with open(args.save, 'r', encoding='UTF-8') as handle:
+                baseline = json.load(handle)
+        baseline.update(results)
+        with open(args.save, 'w', encoding='UTF-8') as handle:
+            json.dump(baseline, handle, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, 'r', encoding='UTF-8') as handle:
+            regressions = compare(results, json.load(handle), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against " + args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import logging
+import unittest
+from unittest import mock
+import xml.etree.ElementTree as ET
+
+import StockChecker
+from Clustering import ClusterIndex, MinHasher, normalize_name, shingles
+from Decoding import FigureData
+
+SUB_SITE = """
+<sub_site id="9" name="Figmas">
+    <url>/figma</url>
+    <report><matched>individually</matched><unmatched>group</unmatched></report>
+    <figure name="figma Kirino">
+        <search dependence="mandatory">Figma</search>
+        <search dependence="optional">Figma Kirino Kousaka</search>
+    </figure>
+</sub_site>
+"""
+
+
+class ClusterIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = ClusterIndex()
+
+    def same_cluster(self, first, second):
+        return second in self.index.cluster(first)
+
+    def test_normalize_name(self):
+        self.assertEqual(normalize_name("Nendoroid No.105 Izayoi (Pre-owned ITEM:A/BOX:B) [Released]"),
+                         "nendoroid no 105 izayoi")
+
+    def test_similarity_estimates_jaccard(self):
+        hasher = MinHasher(num_perm=128)
+        first = shingles(normalize_name("Nendoroid No.105 Izayoi"))
+        second = shingles(normalize_name("Nendoroid Izayoi"))
+        estimate = MinHasher.similarity(hasher.signature(first), hasher.signature(second))
+        self.assertAlmostEqual(estimate, len(first & second) / len(first | second), delta=0.15)
+        self.assertEqual(MinHasher.similarity(hasher.signature(first), hasher.signature(first)), 1)
+
+    def test_listings_of_one_figure_across_sub_sites(self):
+        self.assertEqual(self.index.sync("Jungle/0", {"a": ("Nendoroid No.105 Izayoi", "Y3,780")}), (1, 0))
+        self.index.sync("AmiAmi/0", {"b": ("Nendoroid Izayoi (Pre-owned ITEM:A/BOX:B)", "Y3,500")})
+        self.assertTrue(self.same_cluster(("Jungle/0", "a"), ("AmiAmi/0", "b")))
+        self.assertEqual(self.index.offers(("Jungle/0", "a")), ["Y3,500"])
+        self.assertEqual(len(self.index), 1)
+
+    def test_different_figures_are_kept_apart(self):
+        self.index.sync("Jungle/0", {"a": ("Nendoroid No.105 Izayoi", None),
+                                     "b": ("Nendoroid No.375 Eren Jaeger", None),
+                                     "c": ("Shikishi Gino", None),
+                                     "d": ("Shikishi Euphemia", None)})
+        self.assertEqual(len(self.index), 4)
+
+    def test_versions_are_kept_apart(self):
+        self.index.sync("Jungle/0", {"a": ("Figma Kirino Kousaka", None),
+                                     "b": ("Figma Kirino Kousaka Mizugi Ver.", None)})
+        self.assertFalse(self.same_cluster(("Jungle/0", "a"), ("Jungle/0", "b")))
+
+    def test_sync_removes_listings_that_are_gone(self):
+        self.index.sync("Jungle/0", {"a": ("Nendoroid No.105 Izayoi", "Y3,780")})
+        self.index.sync("AmiAmi/0", {"b": ("Nendoroid Izayoi", "Y3,500")})
+        self.assertEqual(self.index.sync("AmiAmi/0", {"c": ("Nendoroid No.375 Eren Jaeger", "Y4,800")}), (1, 1))
+        self.assertEqual(self.index.cluster(("AmiAmi/0", "b")), set())
+        self.assertEqual(self.index.offers(("Jungle/0", "a")), [])
+        self.index.sync("Jungle/0", {"a": ("Nendoroid No.105 Izayoi", "Y3,500")})
+        self.assertEqual(self.index.offers(("Jungle/0", "a")), [])
+        self.assertEqual(len(self.index), 2)
+
+    def test_drop_group(self):
+        self.index.sync("Jungle/0", {"a": ("Nendoroid No.105 Izayoi", None)})
+        self.index.sync("AmiAmi/0", {"b": ("Nendoroid Izayoi", None)})
+        self.index.drop_group("AmiAmi/0")
+        self.assertEqual(self.index.cluster(("Jungle/0", "a")), {("Jungle/0", "a")})
+        self.index.drop_group("Jungle/0")
+        self.assertEqual(len(self.index), 0)
+
+    def test_decisions_are_shared_by_the_cluster(self):
+        self.index.sync("Jungle/0", {"a": ("Nendoroid No.105 Izayoi", None)})
+        self.index.remember(("Jungle/0", "a"), "watchlist", (0, 90, "token"))
+        self.index.sync("AmiAmi/0", {"b": ("Nendoroid Izayoi", None)})
+        self.assertEqual(self.index.decision(("AmiAmi/0", "b"), "watchlist"), (0, 90, "token"))
+        self.assertIsNone(self.index.decision(("AmiAmi/0", "b"), "other watchlist"))
+        self.assertIsNone(self.index.decision(("AmiAmi/0", "unknown"), "watchlist"))
+        # Forgotten once the cluster is empty
+        self.index.drop_group("Jungle/0")
+        self.index.drop_group("AmiAmi/0")
+        self.index.sync("Jungle/0", {"a": ("Nendoroid No.105 Izayoi", None)})
+        self.assertIsNone(self.index.decision(("Jungle/0", "a"), "watchlist"))
+
+    def test_bands_must_divide_num_perm(self):
+        with self.assertRaises(ValueError):
+            ClusterIndex(num_perm=32, bands=5)
+
+
+class MatchNameTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.sub_site = StockChecker.SubSiteData(ET.fromstring(SUB_SITE), "Jungle")
+        self.cache = StockChecker.MatchCache()
+        patcher = mock.patch.object(StockChecker, 'clusters', ClusterIndex())
+        self.clusters = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def figure(self, name, link):
+        result = FigureData(None, 'jungle', None)
+        result.name = name
+        result.link = link
+        return result
+
+    def test_match_is_not_borrowed_without_the_mandatory_parameters(self):
+        full = self.figure("Figma Kirino Kousaka", "http://jungle-scs.co.jp/1")
+        short = self.figure("Kirino Kousaka", "http://jungle-scs.co.jp/2")
+        self.clusters.sync(self.sub_site.key, {full.identity: (full.name, None), short.identity: (short.name, None)})
+        self.assertIn((self.sub_site.key, short.identity), self.clusters.cluster((self.sub_site.key, full.identity)))
+        self.assertIsNotNone(self.sub_site.match_name(full, self.cache)[0])
+        self.assertIsNone(self.sub_site.match_name(short, self.cache)[0])
+
+    def test_match_is_borrowed_from_the_cluster(self):
+        first = self.figure("Figma Kirino Kousaka", "http://jungle-scs.co.jp/1")
+        second = self.figure("Figma Kirino Kousaka (Released)", "http://jungle-scs.co.jp/2")
+        self.clusters.sync(self.sub_site.key, {first.identity: (first.name, None),
+                                               second.identity: (second.name, None)})
+        matched = self.sub_site.match_name(first, self.cache)
+        with mock.patch.object(StockChecker.SearchParams, 'search') as search:
+            self.assertEqual(self.sub_site.match_name(second, self.cache), matched)
+        search.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
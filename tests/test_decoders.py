@@ -0,0 +1,92 @@
+import logging
+import unittest
+from unittest import mock
+
+import Decoding
+from Decoding import Decoder, FigureData, parse_price, format_price
+
+
+def amiami_figure(decoder, name, condition=None):
+    figure = FigureData(decoder, Decoder.amiami_preowned, None)
+    figure.name = name
+    figure.link = "http://slist.amiami.com/top/detail/detail?gcode=FIGURE-0001-R1"
+    if condition is not None:
+        figure.condition = condition
+    return figure
+
+
+class AmiAmiDetailPageTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.decoder = Decoder('AmiAmi_preowned')
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def read_details(self, figure, heading):
+        page = '<html><body><h2 class="heading_10">{}</h2></body></html>'.format(heading)
+        with mock.patch.object(Decoding, 'scrapeSite', return_value=page):
+            self.decoder.get_extended_name(figure, override=True)
+
+    def test_pre_owned_heading(self):
+        figure = amiami_figure(self.decoder, "Figma Kirino...")
+        self.read_details(figure, "(Pre-owned ITEM:A-/BOX:B)Figma Kirino Kousaka(Released)")
+        self.assertEqual(figure.condition, "Item : A- Box: B")
+        self.assertEqual(figure.extended_name, "Figma Kirino Kousaka")
+
+    def test_heading_without_condition_keeps_the_listing_condition(self):
+        figure = amiami_figure(self.decoder, "Figma Kirino...", "Item : A Box: B")
+        self.read_details(figure, "Figma Kirino Kousaka(Released)")
+        self.assertEqual(figure.condition, "Item : A Box: B")
+        self.assertEqual(figure.extended_name, "Figma Kirino Kousaka")
+
+    def test_heading_without_condition_leaves_no_condition(self):
+        figure = amiami_figure(self.decoder, "Figma Kirino...")
+        self.read_details(figure, "Figma Kirino Kousaka(Released)")
+        self.assertIsNone(figure.condition)
+        self.assertEqual(figure.extended_name, "Figma Kirino Kousaka")
+
+
+class ParsePriceTest(unittest.TestCase):
+
+    # (listed, default currency, expected)
+    prices = [
+        ("12,800 JPY", None, (12800, 'JPY')),
+        ("Y1,080", None, (1080, 'JPY')),
+        ("\u00a53,000", None, (3000, 'JPY')),
+        ("3,000\u5186", None, (3000, 'JPY')),
+        ("$12.99", None, (1299, 'USD')),
+        ("USD12", None, (1200, 'USD')),
+        ("\u20ac5", None, (500, 'EUR')),
+        ("EUR 7.25", None, (725, 'EUR')),
+        ("\u00a31,234.5", None, (123450, 'GBP')),
+        ("KRW 15,000", None, (15000, 'KRW')),
+        ("Price: 4,104 JPY (tax incl.)", None, (4104, 'JPY')),
+        ("1,000", 'JPY', (1000, 'JPY')),
+        ("1,000", None, (100000, None)),
+        ("$5", 'JPY', (500, 'USD')),
+        ("", 'JPY', (None, None)),
+        (None, 'JPY', (None, None)),
+        ("Sold out", 'JPY', (None, None)),
+    ]
+
+    def test_parse_price(self):
+        for listed, default_currency, expected in self.prices:
+            with self.subTest(listed=listed, default_currency=default_currency):
+                self.assertEqual(parse_price(listed, default_currency), expected)
+
+    def test_format_price(self):
+        self.assertEqual(format_price(12800, 'JPY'), "12,800 JPY")
+        self.assertEqual(format_price(123450, 'GBP'), "1,234.50 GBP")
+        self.assertEqual(format_price(1000, None), "10.00")
+
+    def test_round_trip(self):
+        for listed, default_currency, expected in self.prices:
+            if expected[0] is not None and expected[1] is not None:
+                with self.subTest(listed=listed):
+                    self.assertEqual(parse_price(format_price(*expected)), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
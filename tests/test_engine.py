@@ -0,0 +1,198 @@
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from unittest import mock
+
+import StockChecker
+import JungleDecoder
+from JobQueue import Job
+from Decoding import Decoder, FigureData
+from Notifier import NotificationDispatcher, StubTransport
+from StateStore import StateStore, AlertDedup
+
+PAGES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_pages')
+
+CONFIG = """<?xml version="1.0"?>
+<data>
+    <website id="0" name="Jungle">
+        <base_url>http://jungle-scs.co.jp</base_url>
+        <sub_site id="0" name="New Nendoroids">
+            <url>/sale_en/?page_id=116&amp;cat=313&amp;vw=nk</url>
+            <local>{page}</local>
+            <schedule mode="frequency">
+                <frequency><days>0</days><hours>0</hours><minutes>1</minutes><seconds>0</seconds></frequency>
+            </schedule>
+            <report><matched>individually</matched><unmatched>group</unmatched></report>
+            <figure name="Izayoi">
+                <search dependence="mandatory">105</search>
+                <search dependence="optional">Nendoroid No.105 Izayoi</search>
+            </figure>
+        </sub_site>
+    </website>
+</data>
+"""
+
+WATCHLIST = """
+            <figure name="Izayoi">
+                <search dependence="mandatory">105</search>
+                <search dependence="optional">Nendoroid No.105 Izayoi</search>
+                <max_price>4,000 JPY</max_price>
+            </figure>
+            <figure name="Eren">
+                <search dependence="mandatory">375</search>
+                <search dependence="optional">Nendoroid No.375 Eren Jaeger</search>
+                <max_price>5,000 JPY</max_price>
+            </figure>
+            <figure name="Rin">
+                <search dependence="mandatory">304b</search>
+                <search dependence="optional">Nendoroid No.304b Rin and Mechwooser Otegaru ver.</search>
+                <condition>Sealed</condition>
+            </figure>"""
+
+
+class RunOnceTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.mkdtemp()
+        config_uri = os.path.join(self.directory, 'sources.xml')
+        with open(config_uri, 'w') as config:
+            config.write(CONFIG.format(page=os.path.join(PAGES, 'JungleNend.html')))
+        self.checker = StockChecker.StockChecker(config_uri, get_next_pages=False)
+
+    def tearDown(self):
+        self.checker.close()
+        shutil.rmtree(self.directory)
+        logging.disable(logging.NOTSET)
+
+    def test_failed_baseline_scrape(self):
+        # The first crawl of a sub-site fails, so it has no figures at all yet.
+        with mock.patch.object(JungleDecoder.JungleDecoder, 'get_figures',
+                               side_effect=StockChecker.FigureDataCorrupt):
+            result = self.checker.run_once(force=True)
+        self.assertEqual(len(result.sub_sites), 1)
+        self.assertFalse(result.sub_sites[0].scraped)
+        self.assertEqual(result.sub_sites[0].figure_count, 0)
+        self.assertEqual(result.sub_sites[0].notifications, [])
+
+        result = self.checker.run_once(force=True)
+        self.assertTrue(result.sub_sites[0].scraped)
+        self.assertGreater(result.sub_sites[0].figure_count, 0)
+
+    def test_figure_without_condition(self):
+        self.checker.run_once(force=True)
+        site = self.checker.websites[0]
+        sub_site = site.sub_sites[0]
+        izayoi = [figure for figure in sub_site.figures if 'Izayoi' in figure.name][0]
+        izayoi._condition = None  # e.g. a detail page that did not give one
+        sub_site.discovered_figures = [izayoi]
+        notifications = StockChecker.report_sub_site(site, sub_site, None)
+        self.assertEqual(len(notifications), 1)
+        self.assertIn("Condition: ", notifications[0].message)
+
+    def test_failed_report_does_not_stop_the_cycle(self):
+        with mock.patch.object(StockChecker, 'report_sub_site', side_effect=TypeError):
+            result = self.checker.run_once(force=True)
+        self.assertTrue(result.sub_sites[0].scraped)
+        self.assertEqual(result.sub_sites[0].notifications, [])
+        self.assertIsNotNone(self.checker.scheduler.next_deadline())
+
+
+class ReportTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.mkdtemp()
+        config_uri = os.path.join(self.directory, 'sources.xml')
+        config = CONFIG.format(page=os.path.join(PAGES, 'JungleNend.html'))
+        start = config.index('            <figure name="Izayoi">')
+        with open(config_uri, 'w') as config_file:
+            config_file.write(config[:start] + WATCHLIST.strip('\n') + config[config.index('</figure>', start) + 9:])
+        self.transport = StubTransport()
+        self.dispatcher = NotificationDispatcher({"default": self.transport}, coalesce_window=0,
+                                                 max_retries=0).start()
+        self.dedup = AlertDedup(StateStore(os.path.join(self.directory, 'state.db')))
+        self.checker = StockChecker.StockChecker(config_uri, get_next_pages=False, dispatcher=self.dispatcher,
+                                                 alert_dedup=self.dedup)
+        self.baseline = self.checker.run_once(force=True)
+        self.sub_site = self.checker.websites[0].sub_sites[0]
+
+    def tearDown(self):
+        self.checker.close()
+        self.dispatcher.close(timeout=5)
+        shutil.rmtree(self.directory)
+        logging.disable(logging.NOTSET)
+
+    def forget(self, *numbers):
+        # The figures are discovered again by the next scrape
+        self.sub_site.old_figures = [figure for figure in self.sub_site.old_figures
+                                     if not any("No.{} ".format(number) in figure.name for number in numbers)]
+
+    def test_baseline_sends_nothing(self):
+        self.assertTrue(self.baseline.sub_sites[0].scraped)
+        self.assertEqual(self.baseline.sub_sites[0].notifications, [])
+
+    def test_new_figures(self):
+        self.forget("105", "375", "304b", "97")
+        notifications = self.checker.run_once(force=True).sub_sites[0].notifications
+        matched = [notification for notification in notifications if notification.group is None]
+        unmatched = [notification for notification in notifications if notification.group is not None]
+        self.assertEqual(len(matched), 1)
+        self.assertEqual(matched[0].title, "New Figure From New Nendoroids Available")
+        self.assertIn("Nendoroid No.105 Izayoi", matched[0].message)
+        self.assertIn("Price: Y3,780 Condition: Sealed", matched[0].message)
+        # Above max_price, in another condition, and not on the watchlist at all
+        self.assertEqual(sorted(notification.message.split('>')[1].split('<')[0] for notification in unmatched),
+                         ["Nendoroid No.304b Rin and Mechwooser Otegaru ver.", "Nendoroid No.375 Eren Jaeger",
+                          "Nendoroid No.97 Snow Miku"])
+
+    def test_price_drop(self):
+        izayoi = [figure for figure in self.sub_site.old_figures if "Izayoi" in figure.name][0]
+        izayoi.price, izayoi.price_value = "Y3,990", 3990
+        notifications = self.checker.run_once(force=True).sub_sites[0].notifications
+        self.assertEqual([notification.title for notification in notifications], ["Price Drop at New Nendoroids"])
+        self.assertIn("dropped from Y3,990 to Y3,780", notifications[0].message)
+
+    def test_sent_alert_is_not_repeated(self):
+        self.forget("105")
+        self.assertEqual(len(self.checker.run_once(force=True).sub_sites[0].notifications), 1)
+        self.assertTrue(self.dispatcher.flush(timeout=5))
+        self.assertEqual(len(self.transport.sent), 1)
+        self.forget("105")
+        self.assertEqual(self.checker.run_once(force=True).sub_sites[0].notifications, [])
+
+    def test_failed_alert_is_repeated(self):
+        self.transport.failures = 1
+        self.forget("105")
+        self.assertEqual(len(self.checker.run_once(force=True).sub_sites[0].notifications), 1)
+        self.assertTrue(self.dispatcher.flush(timeout=5))
+        self.forget("105")
+        self.assertEqual(len(self.checker.run_once(force=True).sub_sites[0].notifications), 1)
+
+
+class QueuedCrawlTest(unittest.TestCase):
+
+    def test_details_of_listings_with_the_same_name(self):
+        decoder = Decoder('AmiAmi_preowned')
+        figures = []
+        for code, condition in (("0001", "Item : A Box: B"), ("0002", "Item : B Box: B")):
+            figure = FigureData(decoder, Decoder.amiami_preowned, None)
+            figure.name = "Figma Kirino..."
+            figure.link = "http://slist.amiami.com/top/detail/detail?gcode=FIGURE-" + code
+            figure.condition = condition
+            figures.append(figure)
+        job = Job(Job.detail, "AmiAmi/0", "crawl", {})
+        job.state = Job.done
+        job.result = {'figures': [[figures[0].identity, "Figma Kirino Kousaka", "Item : A- Box: B"],
+                                  [figures[1].identity, "Figma Kirino Kousaka", None]]}
+        crawl = StockChecker.QueuedCrawl(None)
+        with mock.patch.object(crawl, '_wait', return_value=[job]):
+            crawl.details(None, mock.Mock(key="AmiAmi/0"), "crawl", figures)
+        self.assertEqual([figure.condition for figure in figures], ["Item : A- Box: B", "Item : B Box: B"])
+        self.assertEqual([figure.extended_name for figure in figures], ["Figma Kirino Kousaka"] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
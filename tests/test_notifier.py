@@ -0,0 +1,119 @@
+import time
+import logging
+import unittest
+
+from Notifier import Notification, NotificationDispatcher, StubTransport, RateLimit
+
+
+def grouped(message, group="Jungle/0/matched", destination="default", alerts=None, priority=-1):
+    return Notification("New figure", message, destination=destination, group=group,
+                        group_title="New figures", alerts=alerts, priority=priority)
+
+
+class NotificationDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.transport = StubTransport()
+        self.other = StubTransport()
+        self.delivered = []
+        self.dispatcher = None
+
+    def tearDown(self):
+        if self.dispatcher is not None:
+            self.dispatcher.close(timeout=5)
+        logging.disable(logging.NOTSET)
+
+    def start(self, **keyword):
+        keyword.setdefault('coalesce_window', 60)
+        keyword.setdefault('backoff', 0.01)
+        self.dispatcher = NotificationDispatcher({"default": self.transport, "alice": self.other},
+                                                 on_sent=self.delivered.append, **keyword).start()
+        return self.dispatcher
+
+    def test_sends_in_the_background(self):
+        dispatcher = self.start()
+        dispatcher.enqueue(Notification("Izayoi", "in stock", alerts=["a"]))
+        self.assertTrue(dispatcher.flush(timeout=5))
+        self.assertEqual([notification.title for notification in self.transport.sent], ["Izayoi"])
+        self.assertEqual([notification.alerts for notification in self.delivered], [["a"]])
+        self.assertEqual(dispatcher.sent, 1)
+
+    def test_unknown_destination_is_dropped(self):
+        dispatcher = self.start()
+        dispatcher.enqueue(Notification("Izayoi", "in stock", destination="bob"))
+        self.assertTrue(dispatcher.flush(timeout=5))
+        self.assertEqual(self.transport.sent, [])
+
+    def test_groups_are_coalesced(self):
+        dispatcher = self.start()
+        dispatcher.enqueue(grouped("Izayoi", alerts=["a"]))
+        dispatcher.enqueue(grouped("Taiga", alerts=["b"], priority=1))
+        dispatcher.enqueue(grouped("Neptune", group="Jungle/0/unmatched"))
+        dispatcher.enqueue(grouped("Miku", destination="alice"))
+        self.assertTrue(dispatcher.flush(timeout=5))
+        messages = sorted(notification.message for notification in self.transport.sent)
+        self.assertEqual(messages, ["Izayoi\nTaiga\n", "Neptune"])
+        combined = [notification for notification in self.transport.sent if notification.message.startswith("I")][0]
+        self.assertEqual(combined.title, "New figures")
+        self.assertEqual(combined.priority, 1)
+        self.assertEqual(combined.alerts, ["a", "b"])
+        self.assertEqual([notification.message for notification in self.other.sent], ["Miku"])
+
+    def test_coalesced_messages_are_split_at_the_length_limit(self):
+        dispatcher = self.start()
+        dispatcher.max_message_length = 20
+        for name in ("Izayoi", "Taiga", "Neptune", "Miku"):
+            dispatcher.enqueue(grouped(name, alerts=[name]))
+        self.assertTrue(dispatcher.flush(timeout=5))
+        self.assertEqual([notification.message for notification in self.transport.sent],
+                         ["Izayoi\nTaiga\n", "Neptune\nMiku\n"])
+        self.assertEqual([notification.alerts for notification in self.delivered],
+                         [["Izayoi", "Taiga"], ["Neptune", "Miku"]])
+
+    def test_groups_are_held_for_the_coalesce_window(self):
+        dispatcher = self.start(coalesce_window=0.2)
+        dispatcher.enqueue(grouped("Izayoi"))
+        time.sleep(0.05)
+        dispatcher.enqueue(grouped("Taiga"))
+        time.sleep(0.05)
+        self.assertEqual(self.transport.sent, [])
+        time.sleep(0.4)
+        self.assertEqual([notification.message for notification in self.transport.sent], ["Izayoi\nTaiga\n"])
+
+    def test_retried_with_backoff(self):
+        self.transport.failures = 2
+        dispatcher = self.start(backoff=0.05)
+        start = time.monotonic()
+        dispatcher.enqueue(Notification("Izayoi", "in stock"))
+        self.assertTrue(dispatcher.flush(timeout=5))
+        # 0.05 seconds before the first retry, 0.1 before the second
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+        self.assertEqual(len(self.transport.sent), 1)
+        self.assertEqual(self.transport.sent[0].attempts, 2)
+        self.assertEqual(len(self.delivered), 1)
+
+    def test_dropped_after_max_retries(self):
+        self.transport.failures = 10
+        dispatcher = self.start(max_retries=2)
+        dispatcher.enqueue(Notification("Izayoi", "in stock"))
+        self.assertTrue(dispatcher.flush(timeout=5))
+        self.assertEqual(dispatcher.dropped, 1)
+        self.assertEqual(self.transport.failures, 7)
+        self.assertEqual(self.delivered, [])
+
+
+class RateLimitTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        rate_limit = RateLimit(rate=2, burst=2)
+        now = rate_limit._updated
+        self.assertEqual(rate_limit.acquire(now), 0)
+        self.assertEqual(rate_limit.acquire(now), 0)
+        self.assertAlmostEqual(rate_limit.acquire(now), 0.5)
+        self.assertEqual(rate_limit.acquire(now + 0.5), 0)
+        self.assertAlmostEqual(rate_limit.acquire(now + 0.5), 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import logging
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+import xml.etree.ElementTree as ET
+
+import StockChecker
+from StockChecker import Scheduler, WebsiteData
+from StateStore import StateStore
+
+SUB_SITE = """
+    <sub_site id="{id}" name="{name}">
+        <url>{url}</url>
+        <schedule mode="frequency">
+            <frequency><days>0</days><hours>1</hours><minutes>0</minutes><seconds>0</seconds></frequency>
+        </schedule>
+        <report><matched>individually</matched><unmatched>group</unmatched></report>
+        <figure name="Izayoi"><search dependence="mandatory">105</search>{extra}</figure>
+    </sub_site>"""
+
+JUNGLE = """<website id="0" name="Jungle"><base_url>http://jungle-scs.co.jp</base_url>{}</website>"""
+AMIAMI = """<website id="1" name="amiami_preowned"><{tag}>http://slist.amiami.com</{tag}>{sub_sites}</website>"""
+
+
+def sub_site(sub_site_id, name="Nendoroids", url="/sale_en/?page_id=116", extra=""):
+    return SUB_SITE.format(id=sub_site_id, name=name, url=url, extra=extra)
+
+
+def websites(jungle, amiami_base_url="base_url"):
+    return [WebsiteData(ET.fromstring(JUNGLE.format(jungle))),
+            WebsiteData(ET.fromstring(AMIAMI.format(tag=amiami_base_url, sub_sites=sub_site(0, url="/top/search"))))]
+
+
+class ReloadWebsitesTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.now = datetime.now()
+        self.scheduler = Scheduler()
+        self.store = mock.Mock(spec=StateStore)
+        self.websites = websites(sub_site(0) + sub_site(1, "Figmas") + sub_site(2, "Scales"))
+        for site in self.websites:
+            for scheduled in site.sub_sites:
+                scheduled.old_figures = ["{} figures".format(scheduled.key)]
+                scheduled.primed = True
+                self.scheduler.schedule(site, scheduled, self.now + timedelta(minutes=10))
+        self.old = dict((scheduled.key, scheduled) for site in self.websites for scheduled in site.sub_sites)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def reload(self, new_websites):
+        merged = StockChecker.reload_websites(self.websites, new_websites, self.scheduler, self.store)
+        sub_sites = dict((scheduled.key, scheduled) for site in merged for scheduled in site.sub_sites)
+        due = dict((scheduled.key, scheduled.next_run)
+                   for site, scheduled in self.scheduler.pop_due(self.now + timedelta(days=1)))
+        return sub_sites, due
+
+    def test_unchanged_sub_site_is_kept(self):
+        sub_sites, due = self.reload(websites(sub_site(0) + sub_site(1, "Figmas") + sub_site(2, "Scales")))
+        for key, old in self.old.items():
+            self.assertIs(sub_sites[key], old)
+        self.assertEqual(due, dict((key, self.now + timedelta(minutes=10)) for key in self.old))
+        self.store.delete_sub_site.assert_not_called()
+
+    def test_changed_sub_site_adopts_state(self):
+        extra = "<max_price>4,000 JPY</max_price>"
+        sub_sites, due = self.reload(websites(sub_site(0) + sub_site(1, "Figmas", extra=extra) +
+                                              sub_site(2, "Scales")))
+        changed = sub_sites["Jungle/1"]
+        self.assertIsNot(changed, self.old["Jungle/1"])
+        self.assertEqual(changed.old_figures, ["Jungle/1 figures"])
+        self.assertTrue(changed.primed)
+        # The old deadline is sooner than a full interval from now, so it stands
+        self.assertEqual(due["Jungle/1"], self.now + timedelta(minutes=10))
+        self.assertEqual(len(due), 4)
+
+    def test_new_sub_site_is_scheduled(self):
+        sub_sites, due = self.reload(websites(sub_site(0) + sub_site(1, "Figmas") + sub_site(2, "Scales") +
+                                              sub_site(3, "Prize figures")))
+        self.assertFalse(sub_sites["Jungle/3"].primed)
+        self.assertLessEqual(due["Jungle/3"], datetime.now())
+
+    def test_sub_site_with_another_url_starts_over(self):
+        sub_sites, due = self.reload(websites(sub_site(0) + sub_site(1, "Figmas", url="/sale_en/?page_id=117") +
+                                              sub_site(2, "Scales")))
+        self.assertFalse(sub_sites["Jungle/1"].primed)
+        self.assertLessEqual(due["Jungle/1"], datetime.now())
+
+    def test_removed_sub_site_is_unscheduled(self):
+        sub_sites, due = self.reload(websites(sub_site(0) + sub_site(1, "Figmas")))
+        self.assertNotIn("Jungle/2", sub_sites)
+        self.assertNotIn("Jungle/2", due)
+        self.store.delete_sub_site.assert_called_once_with("Jungle/2")
+
+    def test_website_that_fails_to_load_keeps_its_configuration(self):
+        # base_url was misspelled, so the website does not load at all
+        sub_sites, due = self.reload(websites(sub_site(0) + sub_site(1, "Figmas") + sub_site(2, "Scales"),
+                                              amiami_base_url="baseurl"))
+        self.assertIs(sub_sites["amiami_preowned/0"], self.old["amiami_preowned/0"])
+        self.assertEqual(sub_sites["amiami_preowned/0"].old_figures, ["amiami_preowned/0 figures"])
+        self.assertIn("amiami_preowned/0", due)
+        self.store.delete_sub_site.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
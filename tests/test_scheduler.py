@@ -0,0 +1,96 @@
+import threading
+import unittest
+from types import SimpleNamespace
+from time import perf_counter
+from datetime import datetime, timedelta
+
+from StockChecker import Scheduler
+
+SITE = SimpleNamespace(website_name="Jungle")
+
+
+def sub_site(name):
+    return SimpleNamespace(key=name, next_run=None)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.now = datetime(2016, 5, 1, 18, 0)
+
+    def pop(self, after=0):
+        return [due.key for _site, due in self.scheduler.pop_due(self.now + timedelta(seconds=after))]
+
+    def test_due_in_order(self):
+        for name, seconds in (("B", 20), ("A", 10), ("C", 30), ("D", 10)):
+            self.scheduler.schedule(SITE, sub_site(name), self.now + timedelta(seconds=seconds))
+        self.assertEqual(self.scheduler.next_deadline(), self.now + timedelta(seconds=10))
+        self.assertEqual(self.pop(5), [])
+        # Sub-sites due at the same time come out in the order they were scheduled
+        self.assertEqual(self.pop(20), ["A", "D", "B"])
+        self.assertEqual(len(self.scheduler), 1)
+        self.assertEqual(self.pop(30), ["C"])
+        self.assertIsNone(self.scheduler.next_deadline())
+
+    def test_rescheduling_supersedes(self):
+        a = sub_site("A")
+        self.scheduler.schedule(SITE, a, self.now + timedelta(seconds=10))
+        self.scheduler.schedule(SITE, sub_site("B"), self.now + timedelta(seconds=20))
+        self.scheduler.schedule(SITE, a, self.now + timedelta(seconds=30))
+        self.assertEqual(a.next_run, self.now + timedelta(seconds=30))
+        self.assertEqual(len(self.scheduler), 2)
+        self.assertEqual(self.scheduler.next_deadline(), self.now + timedelta(seconds=20))
+        self.assertEqual(self.pop(25), ["B"])
+        self.assertEqual(self.pop(30), ["A"])
+
+    def test_remove(self):
+        a = sub_site("A")
+        self.scheduler.schedule(SITE, a, self.now)
+        self.scheduler.schedule(SITE, sub_site("B"), self.now)
+        self.scheduler.remove(a)
+        self.assertEqual(self.pop(), ["B"])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_defaults_to_next_run(self):
+        a = sub_site("A")
+        a.next_run = self.now + timedelta(seconds=10)
+        self.scheduler.schedule(SITE, a)
+        self.assertEqual(self.scheduler.next_deadline(), a.next_run)
+
+
+class SchedulerWaitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler()
+
+    def waited(self, timeout=None, during=None):
+        # Seconds a wait() took, calling during from another thread while it waits
+        if during is not None:
+            threading.Timer(0.05, during).start()
+        start = perf_counter()
+        self.scheduler.wait(timeout)
+        return perf_counter() - start
+
+    def test_sleeps_until_the_deadline(self):
+        self.scheduler.schedule(SITE, sub_site("A"), datetime.now() + timedelta(seconds=0.1))
+        self.assertLess(self.waited(5), 1)
+
+    def test_returns_at_once_when_overdue(self):
+        self.scheduler.schedule(SITE, sub_site("A"), datetime.now() - timedelta(seconds=1))
+        self.assertLess(self.waited(5), 0.05)
+
+    def test_timeout(self):
+        self.scheduler.schedule(SITE, sub_site("A"), datetime.now() + timedelta(hours=1))
+        self.assertLess(self.waited(0.1), 1)
+
+    def test_woken_by_a_schedule_change(self):
+        self.scheduler.schedule(SITE, sub_site("A"), datetime.now() + timedelta(hours=1))
+        self.assertLess(self.waited(5, lambda: self.scheduler.schedule(SITE, sub_site("B"), datetime.now())), 1)
+
+    def test_woken_by_wake(self):
+        self.assertLess(self.waited(5, self.scheduler.wake), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
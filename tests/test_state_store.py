@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from Notifier import Notification
+from StateStore import StateStore, AlertDedup
+
+
+class AlertDedupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = StateStore(os.path.join(self.directory, 'state.db'))
+        self.dedup = AlertDedup(self.store, window=100, retention=1000)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_check_does_not_record(self):
+        self.assertTrue(self.dedup.check("link", "Izayoi", "Y3,780", "Sealed", now=0))
+        self.assertTrue(self.dedup.check("link", "Izayoi", "Y3,780", "Sealed", now=1))
+
+    def test_suppressed_within_the_window(self):
+        self.dedup.record(AlertDedup.key("link", "Izayoi", "Y3,780", "Sealed"), now=0)
+        self.assertFalse(self.dedup.check("link", "Izayoi", "Y3,780", "Sealed", now=50))
+        self.assertTrue(self.dedup.check("link", "Izayoi", "Y3,780", "Sealed", now=150))
+        self.assertTrue(self.dedup.check("link", "Izayoi", "Y3,000", "Sealed", now=50))
+        self.assertFalse(self.dedup.check("link", "Izayoi", "Y3,780", "Sealed", window=200, now=150))
+        self.assertEqual(self.dedup.suppressed, 2)
+
+    def test_sent_records_the_alerts_of_a_notification(self):
+        alert = AlertDedup.key("link", "Izayoi", "Y3,780", "Sealed")
+        self.dedup.sent(Notification("title", "message", alerts=[alert]))
+        self.assertFalse(self.dedup.check("link", "Izayoi", "Y3,780", "Sealed"))
+
+    def test_check_is_answered_from_memory(self):
+        with mock.patch.object(self.store, '_conn') as connection:
+            self.dedup.check("link", "Izayoi", "Y3,780", "Sealed")
+        connection.execute.assert_not_called()
+
+    def test_restored_after_restart(self):
+        self.dedup.record(AlertDedup.key("link", "Izayoi", "Y3,780", "Sealed"))
+        restarted = AlertDedup(self.store, window=100)
+        self.assertFalse(restarted.check("link", "Izayoi", "Y3,780", "Sealed"))
+
+    def test_expired_alerts_are_pruned(self):
+        old = AlertDedup.key("old", None, None, None)
+        self.dedup.record(old, now=self.dedup._pruned)
+        self.dedup.record(AlertDedup.key("new", None, None, None), now=self.dedup._pruned + 2 * 60 * 60)
+        self.assertNotIn(old, self.dedup._sent)
+        self.assertNotIn(old, self.store.load_alerts())
+
+
+if __name__ == '__main__':
+    unittest.main()
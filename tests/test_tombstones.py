@@ -0,0 +1,134 @@
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+import StockChecker
+from StockChecker import Tombstones, WebsiteData
+from Decoding import FigureData
+from StateStore import StateStore
+
+WEBSITE = """
+<website id="0" name="Jungle">
+    <base_url>http://jungle-scs.co.jp</base_url>
+    <sub_site id="0" name="New Nendoroids">
+        <url>/sale_en/?page_id=116</url>
+        <report><matched>individually</matched><unmatched>group</unmatched></report>
+        <figure name="Izayoi"><search dependence="mandatory">105</search></figure>
+    </sub_site>
+</website>
+"""
+
+
+def figure(name):
+    result = FigureData(None, 'jungle', None)
+    result.name = name
+    result.price = "Y1,000"
+    return result
+
+
+class TombstonesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tombstones = Tombstones(ttl=3)
+
+    def scrape(self):
+        self.tombstones.tick()
+        return [expired.name for expired in self.tombstones.expire()]
+
+    def test_expires_after_ttl_scrapes(self):
+        self.tombstones.tick()
+        self.tombstones.bury(figure("A"))
+        self.assertIn("A", self.tombstones)
+        self.assertEqual(self.scrape(), [])
+        self.assertEqual(self.scrape(), [])
+        self.assertEqual(self.scrape(), ["A"])
+        self.assertNotIn("A", self.tombstones)
+        self.assertEqual([deleted.name for deleted in self.tombstones.deleted], ["A"])
+
+    def test_expiry_order(self):
+        self.tombstones.tick()
+        self.tombstones.bury(figure("A"))
+        self.tombstones.bury(figure("B"), 1)
+        self.tombstones.bury(figure("C"))
+        self.assertEqual(self.scrape(), ["B"])
+        self.tombstones.bury(figure("D"), 1)
+        self.assertEqual(self.scrape(), ["D"])
+        # Tombstones that expire in the same scrape do so in the order they were made
+        self.assertEqual(self.scrape(), ["A", "C"])
+        self.assertEqual(len(self.tombstones), 0)
+
+    def test_resurrect_within_ttl(self):
+        self.tombstones.tick()
+        self.tombstones.bury(figure("A"))
+        self.assertEqual(self.scrape(), [])
+        self.assertEqual(self.tombstones.resurrect("A").name, "A")
+        self.assertIsNone(self.tombstones.resurrect("A"))
+        self.assertEqual(self.scrape(), [])
+        self.assertEqual(self.scrape(), [])
+        self.assertEqual(len(self.tombstones.deleted), 0)
+
+    def test_buried_again_after_resurrect(self):
+        self.tombstones.tick()
+        self.tombstones.bury(figure("A"))
+        self.tombstones.tick()
+        self.tombstones.resurrect("A")
+        self.tombstones.bury(figure("A"))
+        # The first tombstone was superseded, so A only expires ttl scrapes after the second one
+        self.assertEqual(self.scrape(), [])
+        self.assertEqual(self.scrape(), [])
+        self.assertEqual(self.scrape(), ["A"])
+
+    def test_kept_figures_get_another_scrape(self):
+        self.tombstones.tick()
+        self.tombstones.bury(figure("A"), 1)
+        self.tombstones.tick()
+        self.assertEqual(self.tombstones.expire(keep=lambda kept: True), [])
+        self.assertIn("A", self.tombstones)
+        self.assertEqual(self.scrape(), ["A"])
+
+    def test_figures_count_down_their_ttl(self):
+        self.tombstones.tick()
+        self.tombstones.bury(figure("A"))
+        self.tombstones.tick()
+        self.assertEqual([buried.TTL for buried in self.tombstones.figures()], [1])
+
+
+class RestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.mkdtemp()
+        self.store = StateStore(os.path.join(self.directory, 'state.db'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+        logging.disable(logging.NOTSET)
+
+    def test_restore_from_state_store(self):
+        site = WebsiteData(ET.fromstring(WEBSITE))
+        sub_site = site.sub_sites[0]
+        sub_site.old_figures = [figure("Listed")]
+        sub_site.tombstones.tick()
+        sub_site.tombstones.bury(figure("Missing"))
+        sub_site.tombstones.tick()
+        StockChecker.save_state(self.store, sub_site)
+
+        restored_site = WebsiteData(ET.fromstring(WEBSITE))
+        self.assertEqual(StockChecker.restore_state(self.store, [restored_site]), 1)
+        restored = restored_site.sub_sites[0]
+        self.assertTrue(restored.primed)
+        self.assertEqual([listed.name for listed in restored.old_figures], ["Listed"])
+        self.assertIn("Missing", restored.tombstones)
+        # One of its three scrapes was used up before the restart
+        restored.tombstones.tick()
+        self.assertEqual(restored.tombstones.expire(), [])
+        restored.tombstones.tick()
+        self.assertEqual([expired.name for expired in restored.tombstones.expire()], ["Missing"])
+
+
+if __name__ == '__main__':
+    unittest.main()